@@ -0,0 +1,97 @@
+import asyncio
+
+
+"""
+Helpers for bulk lookups: reading and normalizing uploaded input lists and
+executing a lookup in chunks with bounded concurrency
+"""
+
+
+def normalize_domain(value):
+    value = value.strip().strip('"').strip().lower()
+    if value.endswith('.'):
+        value = value[:-1]
+    return value
+
+
+def normalize_ip(value):
+    return value.strip().strip('"').strip()
+
+
+async def iter_lines(byte_chunks):
+    """ splits an async iterator of byte chunks into decoded lines """
+    rest = b""
+    async for chunk in byte_chunks:
+        rest += chunk
+        lines = rest.split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", "replace")
+    if len(rest) > 0:
+        yield rest.decode("utf-8", "replace")
+
+
+async def read_inputs(byte_chunks, normalize, max_inputs=None, header=None):
+    """ reads one input per line (first column for CSV files) and returns them deduplicated
+
+    empty lines, comments (#) and the header line are skipped, the order of the first
+    occurrence is kept
+    """
+    seen = set()
+    inputs = []
+    async for line in iter_lines(byte_chunks):
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        value = normalize(line.replace(';', ',').split(',')[0])
+        if len(value) == 0 or value == header or value in seen:
+            continue
+        seen.add(value)
+        inputs.append(value)
+        if max_inputs is not None and len(inputs) > max_inputs:
+            raise ValueError("more than %i inputs" % max_inputs)
+    return inputs
+
+
+async def iter_request_body(request, field="file", chunk_size=65536):
+    """ yields the uploaded file of a multipart request or the raw request body in chunks """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        if field not in form:
+            raise ValueError("no '%s' field in the uploaded form" % field)
+        upload = form[field]
+        while True:
+            chunk = await upload.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+    else:
+        async for chunk in request.stream():
+            yield chunk
+
+
+def get_chunks(values, chunk_size):
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+
+async def run_chunked(func, chunks, max_concurrency):
+    """ runs func(chunk) for all chunks with at most max_concurrency calls at a time
+
+    yields (chunk_index, result) in the order of completion
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(i, chunk):
+        async with semaphore:
+            return i, await func(chunk)
+
+    tasks = [asyncio.ensure_future(_run(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # the consumer went away (e.g. the client disconnected) - stop pending chunks
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,483 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import functools
+import sqlite3
+import datetime
+import threading
+from collections import OrderedDict
+
+
+"""
+Result cache for lookups
+
+Entries are keyed by the normalized lookup (type, inputs, interval, limit and
+options). Results of intervals that end before the latest loaded day never
+change, those of intervals that include it are dropped when a new day is
+loaded (see invalidate_from).
+
+The cache has two tiers: a small in-process LRU and, if SHARED_CACHE is
+enabled, a SQLite database in SHARED_CACHE_DIR that is shared by all worker
+processes of a host and survives restarts. Results are stored column-wise
+with typed columns and zlib compressed (see encode_results). Coroutines use the
+*_async methods, which run the queries of the shared tier in the default
+executor. Its total size and number of entries are kept up to date by triggers,
+expired entries and old claims are dropped every SWEEP_INTERVAL seconds.
+"""
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+SWEEP_INTERVAL = 60.0  # seconds
+CLAIM_MAX_AGE = 7 * 86400.0  # seconds, claims are only needed until all workers have seen the claimed work done
+
+
+def normalize_inputs(inputs):
+    if isinstance(inputs, (list, tuple)):
+        return tuple(sorted(set(str(_input) for _input in inputs)))
+    return str(inputs)
+
+
+def make_key(lookup_type, inputs, date_from, date_to, limit, options=None):
+    if options is None:
+        options = {}
+    return (
+        lookup_type,
+        normalize_inputs(inputs),
+        date_from.isoformat(),
+        date_to.isoformat(),
+        int(limit),
+        tuple(sorted((k, str(v)) for k, v in options.items() if v is not None))
+    )
+
+
+def _key_date_to(key):
+    return datetime.date.fromisoformat(key[3])
+
+
+###############################################################################
+# Compact encoding of results
+
+def _encode_object(value):
+    if isinstance(value, datetime.datetime):
+        return {"__dt__": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"__d__": value.isoformat()}
+    return str(value)
+
+
+def _decode_object(obj):
+    if "__dt__" in obj:
+        return datetime.datetime.fromisoformat(obj["__dt__"])
+    if "__d__" in obj:
+        return datetime.date.fromisoformat(obj["__d__"])
+    return obj
+
+
+def _get_column_type(values):
+    types = set(type(v) for v in values if v is not None)
+    if types == {datetime.datetime}:
+        return "datetime"
+    return "json"
+
+
+def encode_results(results):
+    """ encodes a result dict as zlib compressed, column-wise JSON
+
+    rows are stored as lists of values instead of dicts and datetime columns as
+    integer microseconds since the epoch
+    """
+    rows = results.get("rows", [])
+    meta = {k: v for k, v in results.items() if k != "rows"}
+    columns = list(rows[0].keys()) if len(rows) > 0 else []
+    column_types = []
+    data = []
+    for column in columns:
+        values = [row[column] for row in rows]
+        column_type = _get_column_type(values)
+        if column_type == "datetime":
+            values = [
+                None if v is None else (v - _EPOCH) // datetime.timedelta(microseconds=1)
+                for v in values
+            ]
+        column_types.append(column_type)
+        data.append(values)
+    payload = {
+        "meta": meta,
+        "has_rows": "rows" in results,
+        "columns": columns,
+        "types": column_types,
+        "data": data
+    }
+    return zlib.compress(json.dumps(payload, separators=(',', ':'), default=_encode_object).encode("utf-8"))
+
+
+def decode_results(blob):
+    payload = json.loads(zlib.decompress(blob).decode("utf-8"), object_hook=_decode_object)
+    results = payload["meta"]
+    if not payload["has_rows"]:
+        return results
+    columns = payload["columns"]
+    data = payload["data"]
+    for i, column_type in enumerate(payload["types"]):
+        if column_type == "datetime":
+            data[i] = [
+                None if v is None else _EPOCH + datetime.timedelta(microseconds=v)
+                for v in data[i]
+            ]
+    results["rows"] = [dict(zip(columns, values)) for values in zip(*data)]
+    return results
+
+
+###############################################################################
+# Shared tier
+
+class SharedCache(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.max_bytes = int(self.config["SHARED_CACHE_MAX_BYTES"])
+        self.ttl = float(self.config["RESULT_CACHE_TTL"])  # seconds
+        os.makedirs(self.config["SHARED_CACHE_DIR"], exist_ok=True)
+        self.filename = os.path.join(self.config["SHARED_CACHE_DIR"], "results.sqlite")
+
+        # used by the executor threads and the event loop, one at a time
+        self.db = sqlite3.connect(self.filename, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA mmap_size=%i" % self.max_bytes)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                date_to TEXT NOT NULL,
+                created REAL NOT NULL,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL,
+                value BLOB NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_date_to ON results (date_to)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_expires ON results (expires)")
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results_totals "
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL, entries INTEGER NOT NULL)"
+            )
+            self.db.execute(
+                "INSERT OR IGNORE INTO results_totals (id, size, entries) "
+                "SELECT 0, COALESCE(SUM(size), 0), COUNT(*) FROM results"
+            )
+            self.db.execute("""
+                CREATE TRIGGER IF NOT EXISTS results_totals_insert AFTER INSERT ON results
+                BEGIN UPDATE results_totals SET size = size + NEW.size, entries = entries + 1; END
+            """)
+            self.db.execute("""
+                CREATE TRIGGER IF NOT EXISTS results_totals_update AFTER UPDATE OF size ON results
+                BEGIN UPDATE results_totals SET size = size - OLD.size + NEW.size; END
+            """)
+            self.db.execute("""
+                CREATE TRIGGER IF NOT EXISTS results_totals_delete AFTER DELETE ON results
+                BEGIN UPDATE results_totals SET size = size - OLD.size, entries = entries - 1; END
+            """)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("CREATE TABLE IF NOT EXISTS loaded_days (day TEXT PRIMARY KEY, loaded_at REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS claims (name TEXT PRIMARY KEY, claimed_at REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hot_keys (key TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+
+        self.n_hits = 0
+        self.n_evictions = 0
+        self.next_sweep = 0.0
+
+    @staticmethod
+    def _key_to_str(key):
+        return json.dumps(key, separators=(',', ':'), default=str)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, created, last_access FROM results WHERE key = ? AND expires > ?",
+                (self._key_to_str(key), now)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created, last_access = row
+            if last_access < now - 60:
+                # updating the access time on every read would serialize the workers
+                self.db.execute(
+                    "UPDATE results SET last_access = ? WHERE key = ?",
+                    (now, self._key_to_str(key))
+                )
+            self.n_hits += 1
+        return created, decode_results(value)
+
+    def put(self, key, results, created):
+        value = encode_results(results)
+        if len(value) > self.max_bytes // 10:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO results (key, date_to, created, expires, last_access, size, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET date_to = excluded.date_to, created = excluded.created, "
+                "expires = excluded.expires, last_access = excluded.last_access, size = excluded.size, "
+                "value = excluded.value",
+                (self._key_to_str(key), key[3], created, now + self.ttl, now, len(value), value)
+            )
+            self.evict()
+
+    async def _run_async(self, method, *args):
+        """ runs method in the default executor, so the event loop waits neither for the lock nor a busy database """
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(method, *args))
+
+    def get_totals(self):
+        """ returns (size, entries) of the results """
+        with self.lock:
+            return self.db.execute("SELECT size, entries FROM results_totals").fetchone()
+
+    def get_total_size(self):
+        return self.get_totals()[0]
+
+    def evict(self):
+        """ sweeps expired entries and old claims, drops the least recently used entries above the size limit """
+        with self.lock:
+            now = time.time()
+            if now >= self.next_sweep:
+                self.next_sweep = now + SWEEP_INTERVAL
+                self.db.execute("DELETE FROM results WHERE expires <= ?", (now, ))
+                self.db.execute("DELETE FROM claims WHERE claimed_at < ?", (now - CLAIM_MAX_AGE, ))
+            total_size = self.get_total_size()
+            if total_size <= self.max_bytes:
+                return
+            # drop the least recently used entries until 90% of the limit is reached
+            to_free = total_size - int(self.max_bytes * 0.9)
+            freed = 0
+            keys = []
+            for key, size in self.db.execute("SELECT key, size FROM results ORDER BY last_access"):
+                keys.append((key, ))
+                freed += size
+                if freed >= to_free:
+                    break
+            self.db.executemany("DELETE FROM results WHERE key = ?", keys)
+            self.n_evictions += len(keys)
+
+    def mark_day_loaded(self, day):
+        """ records when day was first seen as loaded by any worker and returns that time """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO loaded_days (day, loaded_at) VALUES (?, ?)",
+                (day.isoformat(), time.time())
+            )
+            return self.db.execute(
+                "SELECT loaded_at FROM loaded_days WHERE day = ?",
+                (day.isoformat(), )
+            ).fetchone()[0]
+
+    def invalidate_from(self, day, loaded_at):
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM results WHERE date_to >= ? AND created < ?",
+                (day.isoformat(), loaded_at)
+            )
+
+    def claim(self, name, ttl=None):
+        """ returns True for exactly one caller per name across all workers
+
+        with ttl (seconds) an older claim (e.g. of a worker that died) expires and the name can be claimed again
+        """
+        now = time.time()
+        with self.lock:
+            if ttl is not None:
+                self.db.execute("DELETE FROM claims WHERE name = ? AND claimed_at < ?", (name, now - ttl))
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO claims (name, claimed_at) VALUES (?, ?)",
+                (name, now)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, name):
+        """ gives up a claim, e.g. after a failure, so it can be claimed again """
+        with self.lock:
+            self.db.execute("DELETE FROM claims WHERE name = ?", (name,))
+
+    def prune_claims(self, prefix, max_age):
+        """ deletes the claims with names starting with prefix that are older than max_age seconds """
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM claims WHERE name LIKE ? AND claimed_at < ?",
+                (prefix + "%", time.time() - max_age)
+            )
+
+    def add_hot_keys(self, counts):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for key, count in counts:
+                    self.db.execute(
+                        "INSERT INTO hot_keys (key, count) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+                        (self._key_to_str(key), count)
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def pop_hot_keys(self, k):
+        """ returns the k most popular keys of all workers and resets the counts """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute("SELECT key FROM hot_keys ORDER BY count DESC LIMIT ?", (k, )).fetchall()
+                self.db.execute("DELETE FROM hot_keys")
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return [json.loads(row[0]) for row in rows]
+
+    async def mark_day_loaded_async(self, day):
+        return await self._run_async(self.mark_day_loaded, day)
+
+    async def invalidate_from_async(self, day, loaded_at):
+        await self._run_async(self.invalidate_from, day, loaded_at)
+
+    async def claim_async(self, name, ttl=None):
+        return await self._run_async(self.claim, name, ttl)
+
+    async def release_async(self, name):
+        await self._run_async(self.release, name)
+
+    async def prune_claims_async(self, prefix, max_age):
+        await self._run_async(self.prune_claims, prefix, max_age)
+
+    async def add_hot_keys_async(self, counts):
+        await self._run_async(self.add_hot_keys, counts)
+
+    async def pop_hot_keys_async(self, k):
+        return await self._run_async(self.pop_hot_keys, k)
+
+    async def stats_async(self):
+        return await self._run_async(self.stats)
+
+    def stats(self):
+        total_size, n_entries = self.get_totals()
+        return {
+            "entries": n_entries,
+            "bytes": total_size,
+            "max_bytes": self.max_bytes,
+            "hits": self.n_hits,
+            "evictions": self.n_evictions
+        }
+
+
+###############################################################################
+# Two tier cache
+
+class ResultCache(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.enabled = bool(self.config["RESULT_CACHE"])
+        self.max_entries = int(self.config["RESULT_CACHE_SIZE"])
+        self.max_rows = int(self.config["RESULT_CACHE_MAX_ROWS"])
+        self.ttl = float(self.config["RESULT_CACHE_TTL"])  # seconds
+        self._entries = OrderedDict()  # key -> (expires, created, results)
+
+        self.shared = None
+        if self.enabled and self.config["SHARED_CACHE"]:
+            self.shared = SharedCache(logger, config)
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _put_local(self, key, results, created):
+        self._entries[key] = (time.time() + self.ttl, created, dict(results))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            del self._entries[key]
+            entry = None
+        return entry
+
+    def _get_shared(self, key):
+        try:
+            return self.shared.get(key)
+        except sqlite3.Error as e:
+            self.logger.warning("shared cache lookup failed - %s" % str(e))
+            return None
+
+    def _put_shared(self, key, results, created):
+        try:
+            self.shared.put(key, results, created)
+        except sqlite3.Error as e:
+            self.logger.warning("storing result in shared cache failed - %s" % str(e))
+
+    async def get_async(self, key):
+        """ returns a copy of the cached results or None, the shared tier is read in the default executor """
+        if not self.enabled:
+            return None
+        entry = self._get_local(key)
+        if entry is None and self.shared is not None:
+            shared_entry = await asyncio.get_event_loop().run_in_executor(None, self._get_shared, key)
+            if shared_entry is not None:
+                created, results = shared_entry
+                self._put_local(key, results, created)
+                entry = self._entries[key]
+        if entry is None:
+            self.n_misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.n_hits += 1
+        # callers modify the top level of the result dict
+        return dict(entry[2])
+
+    async def put_async(self, key, results):
+        """ stores the results, the shared tier is written in the default executor """
+        if not self.enabled or len(results.get("rows", [])) > self.max_rows:
+            return
+        created = time.time()
+        self._put_local(key, results, created)
+        if self.shared is not None:
+            await asyncio.get_event_loop().run_in_executor(None, self._put_shared, key, dict(results), created)
+
+    async def mark_day_loaded_async(self, day):
+        if self.shared is not None:
+            return await self.shared.mark_day_loaded_async(day)
+        return time.time()
+
+    async def invalidate_from_async(self, day, loaded_at=None):
+        """ drops all entries whose interval ends on or after day and that were created before loaded_at """
+        if loaded_at is None:
+            loaded_at = time.time()
+        for key in list(self._entries.keys()):
+            if _key_date_to(key) >= day and self._entries[key][1] < loaded_at:
+                del self._entries[key]
+        if self.shared is not None:
+            await self.shared.invalidate_from_async(day, loaded_at)
+
+    async def stats_async(self):
+        stats = {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.n_hits,
+            "misses": self.n_misses
+        }
+        if self.shared is not None:
+            stats["shared"] = await self.shared.stats_async()
+        return stats
@@ -10,6 +10,13 @@ Config file
 load_dotenv(find_dotenv(), verbose=True)
 
 
+def _getenv_bool(key, default=False):
+    value = os.getenv(key)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 config = dict()
 config.update(dict(
     version="1.1.0",
@@ -17,8 +24,130 @@ config.update(dict(
     DB=os.getenv('DB'),
     DBHOST=os.getenv('DBHOST'),
     DBPORT=os.getenv('DBPORT'),
-    N_RECONNECT_TRIES=5,
-    RECONNECT_DELAY=1.0,  # seconds
+    # comma separated list of coordinators (host or host:port, default port DBPORT), overrides DBHOST
+    DBHOSTS=os.getenv('DBHOSTS', ''),
+    DB_HEALTH_CHECK_INTERVAL=float(os.getenv('DB_HEALTH_CHECK_INTERVAL', 30)),  # seconds
+    DB_EJECT_AFTER=int(os.getenv('DB_EJECT_AFTER', 3)),  # consecutive connection errors
+    DB_STICKY_SLACK=int(os.getenv('DB_STICKY_SLACK', 2)),  # outstanding queries
+    # 'impala' or 'stub' (synthetic results, for load tests without a cluster)
+    DBBACKEND=os.getenv('DBBACKEND', 'impala'),
+    STUB_QUERY_DELAY=float(os.getenv('STUB_QUERY_DELAY', 0.2)),  # seconds
+    STUB_QUERY_DELAY_JITTER=float(os.getenv('STUB_QUERY_DELAY_JITTER', 0.1)),  # seconds
+    STUB_N_ROWS=int(os.getenv('STUB_N_ROWS', 100)),
+    STUB_FIRST_DAY=os.getenv('STUB_FIRST_DAY', '2020-01-01'),  # the stub has partitions from this day to yesterday
+    N_RECONNECT_TRIES=int(os.getenv('N_RECONNECT_TRIES', 5)),
+    RECONNECT_DELAY=float(os.getenv('RECONNECT_DELAY', 0.5)),  # seconds, doubled with every retry (with jitter)
+    RECONNECT_MAX_DELAY=float(os.getenv('RECONNECT_MAX_DELAY', 8.0)),  # seconds
+    # circuit breaker: fail fast for DB_BREAKER_RESET_TIMEOUT seconds after that many connection errors in a row
+    DB_BREAKER_FAILURE_THRESHOLD=int(os.getenv('DB_BREAKER_FAILURE_THRESHOLD', 5)),
+    DB_BREAKER_RESET_TIMEOUT=float(os.getenv('DB_BREAKER_RESET_TIMEOUT', 30)),  # seconds
+    # impala query options per query name, profiles are JSON ({"profile": {"OPTION": value, ...}, ...}), selected
+    # with "query_name:profile,..."; QUERY_PROFILES_B is used for a share of QUERY_PROFILES_B_SHARE (A/B tests)
+    QUERY_OPTION_PROFILES=os.getenv('QUERY_OPTION_PROFILES', ''),
+    QUERY_PROFILES=os.getenv('QUERY_PROFILES', ''),
+    QUERY_PROFILES_B=os.getenv('QUERY_PROFILES_B', ''),
+    QUERY_PROFILES_B_SHARE=float(os.getenv('QUERY_PROFILES_B_SHARE', 0.5)),
+    DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', 4)),  # idle connections kept open per worker and coordinator
+    FETCH_BATCH_SIZE=int(os.getenv('FETCH_BATCH_SIZE', 10000)),  # rows
+    # running queries are polled after DB_POLL_MIN_INTERVAL seconds, growing by half up to DB_POLL_MAX_INTERVAL
+    DB_POLL_MIN_INTERVAL=float(os.getenv('DB_POLL_MIN_INTERVAL', 0.05)),
+    DB_POLL_MAX_INTERVAL=float(os.getenv('DB_POLL_MAX_INTERVAL', 1.0)),
+    # texts of the lookup queries per shape (IN list lengths padded to powers of two), per worker
+    SQL_TEMPLATE_CACHE_SIZE=int(os.getenv('SQL_TEMPLATE_CACHE_SIZE', 256)),
+    # negative cache: remember inputs without rows on a day, only for days that are
+    # at least NEGATIVE_CACHE_MIN_AGE_DAYS old (i.e. whose partition is complete)
+    NEGATIVE_CACHE_SIZE=int(os.getenv('NEGATIVE_CACHE_SIZE', 1000000)),  # values
+    NEGATIVE_CACHE_TTL=float(os.getenv('NEGATIVE_CACHE_TTL', 7 * 86400)),  # seconds
+    NEGATIVE_CACHE_MIN_AGE_DAYS=int(os.getenv('NEGATIVE_CACHE_MIN_AGE_DAYS', 2)),
+    # per-day Bloom filters of observed query_name, ip4_address and ip6_address values
+    EXISTENCE_FILTERS=_getenv_bool('EXISTENCE_FILTERS', False),
+    EXISTENCE_FILTER_DIR=os.getenv('EXISTENCE_FILTER_DIR', '/tmp/openintel-lookup/filters'),
+    EXISTENCE_FILTER_DAYS=int(os.getenv('EXISTENCE_FILTER_DAYS', 7)),
+    EXISTENCE_FILTER_CAPACITY=int(os.getenv('EXISTENCE_FILTER_CAPACITY', 10000000)),  # values per day, 12 MB at 1%
+    EXISTENCE_FILTER_ERROR_RATE=float(os.getenv('EXISTENCE_FILTER_ERROR_RATE', 0.01)),
+    EXISTENCE_FILTER_REFRESH_INTERVAL=float(os.getenv('EXISTENCE_FILTER_REFRESH_INTERVAL', 3600)),  # seconds
+    # fair-share scheduling per worker: at most SCHEDULER_MAX_CONCURRENCY queries at the same time, at most
+    # CLIENT_MAX_CONCURRENCY per client, API requests are limited to CLIENT_RATE per second (bursts of
+    # CLIENT_BURST, 0: unlimited); clients are identified by API key ("name:key,...") or source address
+    SCHEDULER_MAX_CONCURRENCY=int(os.getenv('SCHEDULER_MAX_CONCURRENCY', 8)),
+    SCHEDULER_MAX_CLIENTS=int(os.getenv('SCHEDULER_MAX_CLIENTS', 10000)),
+    CLIENT_MAX_CONCURRENCY=int(os.getenv('CLIENT_MAX_CONCURRENCY', 4)),
+    CLIENT_RATE=float(os.getenv('CLIENT_RATE', 0)),  # requests per second and worker
+    CLIENT_BURST=int(os.getenv('CLIENT_BURST', 50)),
+    CLIENT_WEIGHTS=os.getenv('CLIENT_WEIGHTS', ''),  # "name:weight,...", default weight 1
+    CLIENT_API_KEYS=os.getenv('CLIENT_API_KEYS', ''),
+    TRUST_FORWARDED_FOR=_getenv_bool('TRUST_FORWARDED_FOR', False),  # behind a reverse proxy
+    # bulk lookups: inputs are split into chunks of BULK_CHUNK_SIZE and at most
+    # BULK_MAX_CONCURRENCY chunks are queried at the same time per request
+    BULK_CHUNK_SIZE=int(os.getenv('BULK_CHUNK_SIZE', 1000)),
+    BULK_MAX_CHUNK_SIZE=int(os.getenv('BULK_MAX_CHUNK_SIZE', 10000)),
+    BULK_MAX_CONCURRENCY=int(os.getenv('BULK_MAX_CONCURRENCY', 4)),
+    BULK_MAX_INPUTS=int(os.getenv('BULK_MAX_INPUTS', 500000)),
+    # batches of lookups: at most BATCH_MAX_LOOKUPS per request, BATCH_MAX_CONCURRENCY of them at the same time
+    BATCH_MAX_LOOKUPS=int(os.getenv('BATCH_MAX_LOOKUPS', 100)),
+    BATCH_MAX_CONCURRENCY=int(os.getenv('BATCH_MAX_CONCURRENCY', 4)),
+    # time-sliced lookups: at most SLICE_MAX_CONCURRENCY slices are queried at the same time per request
+    SLICE_MAX_CONCURRENCY=int(os.getenv('SLICE_MAX_CONCURRENCY', 4)),
+    # resolution graphs: at most GRAPH_MAX_DEPTH levels and GRAPH_MAX_NODES nodes
+    GRAPH_MAX_DEPTH=int(os.getenv('GRAPH_MAX_DEPTH', 8)),
+    GRAPH_MAX_NODES=int(os.getenv('GRAPH_MAX_NODES', 10000)),
+    # memory budget for the rows of results (estimated bytes, 0: unlimited), larger results are moved to SPILL_DIR
+    RESULT_MEMORY_REQUEST_LIMIT=int(os.getenv('RESULT_MEMORY_REQUEST_LIMIT', 256 * 1024 ** 2)),
+    RESULT_MEMORY_WORKER_LIMIT=int(os.getenv('RESULT_MEMORY_WORKER_LIMIT', 1024 ** 3)),
+    SPILL_DIR=os.getenv('SPILL_DIR', '/tmp/openintel-lookup/spill'),
+    # profiling of single requests with profile=true by the clients of PROFILE_CLIENTS ("name,..." of
+    # CLIENT_API_KEYS), a share of PROFILE_SAMPLE_RATE of the API requests is profiled into PROFILE_DIR
+    PROFILE_CLIENTS=os.getenv('PROFILE_CLIENTS', ''),
+    PROFILE_SAMPLE_RATE=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+    PROFILE_DIR=os.getenv('PROFILE_DIR', '/tmp/openintel-lookup/profiles'),
+    PROFILE_MAX_REPORTS=int(os.getenv('PROFILE_MAX_REPORTS', 100)),
+    PROFILE_TOP_N=int(os.getenv('PROFILE_TOP_N', 60)),  # functions per report
+    # HTTP caching: ETags for the lookups, results of intervals that end before the latest loaded day
+    # are immutable for HTTP_CACHE_MAX_AGE seconds, others for HTTP_CACHE_RECENT_MAX_AGE (0: revalidate)
+    HTTP_CACHE=_getenv_bool('HTTP_CACHE', True),
+    HTTP_CACHE_MAX_AGE=int(os.getenv('HTTP_CACHE_MAX_AGE', 30 * 86400)),
+    HTTP_CACHE_RECENT_MAX_AGE=int(os.getenv('HTTP_CACHE_RECENT_MAX_AGE', 0)),
+    # daily rollups of the records for the records summaries (needs write access to ROLLUP_TABLE), the latest
+    # ROLLUP_MAX_DAYS days that are at least ROLLUP_MIN_AGE_DAYS old, ROLLUP_DAYS_PER_RUN per catalog refresh
+    ROLLUP=_getenv_bool('ROLLUP', False),
+    ROLLUP_TABLE=os.getenv('ROLLUP_TABLE', ''),  # defaults to <DB>_records_daily
+    ROLLUP_MIN_AGE_DAYS=int(os.getenv('ROLLUP_MIN_AGE_DAYS', 2)),
+    ROLLUP_MAX_DAYS=int(os.getenv('ROLLUP_MAX_DAYS', 400)),
+    ROLLUP_DAYS_PER_RUN=int(os.getenv('ROLLUP_DAYS_PER_RUN', 2)),
+    ROLLUP_CLAIM_TTL=float(os.getenv('ROLLUP_CLAIM_TTL', 21600)),  # seconds, a worker builds a day at most once
+    # background jobs, state and results are shared by all workers via JOB_DIR
+    JOB_DIR=os.getenv('JOB_DIR', '/tmp/openintel-lookup/jobs'),
+    JOB_TTL=float(os.getenv('JOB_TTL', 86400)),  # seconds
+    JOB_STALE_AFTER=float(os.getenv('JOB_STALE_AFTER', 3600)),  # seconds without progress
+    # result snapshots for server-side paging in the web UI
+    SNAPSHOT_DIR=os.getenv('SNAPSHOT_DIR', '/tmp/openintel-lookup/results'),
+    SNAPSHOT_TTL=float(os.getenv('SNAPSHOT_TTL', 3600)),  # seconds
+    SNAPSHOT_CACHE_SIZE=int(os.getenv('SNAPSHOT_CACHE_SIZE', 8)),  # snapshots kept in memory per worker
+    # result cache, a small per worker LRU in front of a SQLite database shared by
+    # all workers of the host (SHARED_CACHE) that is kept across restarts
+    RESULT_CACHE=_getenv_bool('RESULT_CACHE', True),
+    SHARED_CACHE=_getenv_bool('SHARED_CACHE', True),
+    SHARED_CACHE_DIR=os.getenv('SHARED_CACHE_DIR', '/tmp/openintel-lookup/cache'),
+    SHARED_CACHE_MAX_BYTES=int(os.getenv('SHARED_CACHE_MAX_BYTES', 1024 ** 3)),
+    RESULT_CACHE_SIZE=int(os.getenv('RESULT_CACHE_SIZE', 1000)),  # entries per worker
+    RESULT_CACHE_MAX_ROWS=int(os.getenv('RESULT_CACHE_MAX_ROWS', 10000)),  # larger results are not cached
+    RESULT_CACHE_TTL=float(os.getenv('RESULT_CACHE_TTL', 86400)),  # seconds
+    # catalog of the loaded partitions, used for the default interval and to skip queries for days without data
+    PARTITION_REFRESH_INTERVAL=float(os.getenv('PARTITION_REFRESH_INTERVAL', 600)),  # seconds
+    # cost estimation of lookups, above the thresholds (scanned rows, 0: disabled) the limit is lowered to
+    # COST_FORCED_LIMIT, the lookup runs as background job or is rejected
+    COST_DEFAULT_PARTITION_ROWS=int(os.getenv('COST_DEFAULT_PARTITION_ROWS', 100000000)),  # partitions without stats
+    COST_INPUTS_PER_SCAN=int(os.getenv('COST_INPUTS_PER_SCAN', 1000)),
+    COST_LIMIT_THRESHOLD=float(os.getenv('COST_LIMIT_THRESHOLD', 1e11)),
+    COST_BACKGROUND_THRESHOLD=float(os.getenv('COST_BACKGROUND_THRESHOLD', 1e12)),
+    COST_REJECT_THRESHOLD=float(os.getenv('COST_REJECT_THRESHOLD', 1e13)),
+    COST_FORCED_LIMIT=int(os.getenv('COST_FORCED_LIMIT', 1000)),
+    # warm-up at startup and pre-population of the cache with popular lookups once a new day is loaded
+    WARMUP=_getenv_bool('WARMUP', True),
+    WARMUP_TIMEOUT=float(os.getenv('WARMUP_TIMEOUT', 60)),  # seconds
+    HOT_KEYS_CAPACITY=int(os.getenv('HOT_KEYS_CAPACITY', 1000)),
+    PREFETCH_TOP_K=int(os.getenv('PREFETCH_TOP_K', 100)),
+    PREFETCH_CONCURRENCY=int(os.getenv('PREFETCH_CONCURRENCY', 2)),
     baseurl='http://localhost:8989'
 ))
 
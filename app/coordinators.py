@@ -0,0 +1,120 @@
+import random
+import hashlib
+
+
+"""
+Routing of queries over several impala coordinators
+
+Every coordinator has its own pool of idle connections. A query goes to the
+coordinator with the fewest outstanding queries, identical queries stick to
+the same coordinator (rendezvous hashing) as long as it is not more than
+DB_STICKY_SLACK queries busier than the least loaded one, so they can profit
+from the coordinator's caches. Coordinators failing DB_EJECT_AFTER times in a
+row are ejected until a health check succeeds again.
+"""
+
+
+def parse_hosts(hosts, default_port):
+    """ parses 'host1:port1,host2,...' into a list of (host, port) """
+    coordinators = []
+    for host in hosts.split(","):
+        host = host.strip()
+        if len(host) == 0:
+            continue
+        if host.startswith("["):
+            # [IPv6 address]:port
+            address, _, port = host[1:].partition("]")
+            port = port.lstrip(":")
+            coordinators.append((address, int(port) if port else int(default_port)))
+        elif host.count(":") == 1:
+            address, port = host.split(":")
+            coordinators.append((address, int(port)))
+        else:
+            coordinators.append((host, int(default_port)))
+    return coordinators
+
+
+class Coordinator(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+        self.pool = []  # idle connections
+        self.n_connections = 0
+        self.outstanding = 0  # queries running on this coordinator
+        self.n_queries = 0
+        self.n_failures = 0  # consecutive failures
+        self.healthy = True
+        self.n_ejections = 0
+
+    @property
+    def name(self):
+        return "%s:%i" % (self.host, self.port)
+
+    def stats(self):
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "queries": self.n_queries,
+            "open_connections": self.n_connections,
+            "idle_connections": len(self.pool),
+            "consecutive_failures": self.n_failures,
+            "ejections": self.n_ejections
+        }
+
+
+class CoordinatorRouter(object):
+    def __init__(self, logger, config, coordinators):
+        self.logger = logger
+        self.config = config
+        self.coordinators = coordinators
+
+        self.eject_after = int(self.config["DB_EJECT_AFTER"])
+        self.sticky_slack = int(self.config["DB_STICKY_SLACK"])
+
+    def get_candidates(self):
+        healthy = [coordinator for coordinator in self.coordinators if coordinator.healthy]
+        if len(healthy) == 0:
+            # better try an ejected coordinator than fail right away
+            return self.coordinators
+        return healthy
+
+    @staticmethod
+    def _get_weight(sticky_key, coordinator):
+        return hashlib.blake2b(
+            ("%s|%s" % (coordinator.name, sticky_key)).encode("utf-8"),
+            digest_size=8
+        ).digest()
+
+    def choose(self, sticky_key=None):
+        candidates = self.get_candidates()
+        least_loaded = min(candidates, key=lambda coordinator: (coordinator.outstanding, random.random()))
+        if sticky_key is None:
+            return least_loaded
+        sticky = max(candidates, key=lambda coordinator: self._get_weight(sticky_key, coordinator))
+        if sticky.outstanding <= least_loaded.outstanding + self.sticky_slack:
+            return sticky
+        return least_loaded
+
+    def record_success(self, coordinator):
+        coordinator.n_failures = 0
+
+    def record_failure(self, coordinator):
+        """ returns True if the coordinator has been ejected """
+        coordinator.n_failures += 1
+        if coordinator.healthy and coordinator.n_failures >= self.eject_after:
+            self.eject(coordinator)
+            return True
+        return False
+
+    def eject(self, coordinator):
+        if coordinator.healthy:
+            self.logger.warning("ejecting coordinator %s" % coordinator.name)
+            coordinator.healthy = False
+            coordinator.n_ejections += 1
+
+    def readmit(self, coordinator):
+        coordinator.n_failures = 0
+        if not coordinator.healthy:
+            self.logger.info("readmitting coordinator %s" % coordinator.name)
+            coordinator.healthy = True
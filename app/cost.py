@@ -0,0 +1,107 @@
+import datetime
+
+
+"""
+Cost estimation for lookups
+
+The estimate is the number of rows the cluster has to read: the rows of the
+partitions in the interval (from the partition catalog, i.e. the #Rows
+statistics of SHOW PARTITIONS) times the number of table scans of the query
+template, weighted by the number of inputs that have to be matched against
+every row. The thresholds (0: disabled) decide whether a lookup is run, run
+with a lower limit, run as background job or rejected. Days that a lookup reads
+from a rollup (see rollup.py) are not counted.
+"""
+
+# table scans per partition of the query templates in openintel_sql_calls
+SCANS_PER_PARTITION = {
+    "domains_by_ips": 7,
+    "ips_by_domains": 7,
+    "ips_by_mx_pattern": 2,
+    "measurements_by_domain": 1,
+    "references": 1,
+    "changes": 1,
+    "records_summary": 1,
+}
+
+# lookups that compare their first and last day, the days in between are not read
+TWO_DAY_LOOKUPS = ("changes", )
+
+ACTIONS = ("run", "limit", "background", "reject")
+
+
+class CostEstimator(object):
+    def __init__(self, logger, config, catalog):
+        self.logger = logger
+        self.config = config
+        self.catalog = catalog
+
+        self.default_partition_rows = int(self.config["COST_DEFAULT_PARTITION_ROWS"])
+        self.inputs_per_scan = int(self.config["COST_INPUTS_PER_SCAN"])
+        self.limit_threshold = float(self.config["COST_LIMIT_THRESHOLD"])
+        self.background_threshold = float(self.config["COST_BACKGROUND_THRESHOLD"])
+        self.reject_threshold = float(self.config["COST_REJECT_THRESHOLD"])
+        self.forced_limit = int(self.config["COST_FORCED_LIMIT"])
+
+        self.rollups = dict()  # lookup type -> rollup of the lookup
+
+        self.n_actions = {action: 0 for action in ACTIONS}
+
+    def get_partition_rows(self, date_from, date_to):
+        """ returns the number of partitions and their rows within the interval """
+        if not self.catalog.loaded:
+            n_partitions = max(0, (date_to - date_from).days + 1)
+            return n_partitions, n_partitions * self.default_partition_rows
+        row_counts = [self.catalog.row_counts[day] for day in self.catalog.get_days(date_from, date_to)]
+        known = [n_rows for n_rows in row_counts if n_rows >= 0]
+        if len(known) > 0:
+            mean_rows = sum(known) / len(known)
+        else:
+            mean_rows = self.default_partition_rows
+        return len(row_counts), int(sum(known) + mean_rows * (len(row_counts) - len(known)))
+
+    def estimate(self, lookup_type, inputs, date_from, date_to, limit):
+        n_inputs = len(inputs) if isinstance(inputs, (list, tuple)) else 1
+        if lookup_type in TWO_DAY_LOOKUPS:
+            n_before, rows_before = self.get_partition_rows(date_from, date_from)
+            n_after, rows_after = self.get_partition_rows(date_to, date_to)
+            n_partitions, partition_rows = n_before + n_after, rows_before + rows_after
+        else:
+            rollup = self.rollups.get(lookup_type)
+            rolled_up_to = None if rollup is None else rollup.get_rolled_up(date_from, date_to)
+            if rolled_up_to is not None:
+                date_from = rolled_up_to + datetime.timedelta(days=1)
+            n_partitions, partition_rows = self.get_partition_rows(date_from, date_to)
+        n_scans = SCANS_PER_PARTITION.get(lookup_type, 1)
+        cost = partition_rows * n_scans * (1.0 + float(n_inputs) / self.inputs_per_scan)
+        return {
+            "inputs": n_inputs,
+            "partitions": n_partitions,
+            "partition_rows": partition_rows,
+            "scans_per_partition": n_scans,
+            "cost": int(cost),
+            "action": self.get_action(cost, limit)
+        }
+
+    def get_action(self, cost, limit):
+        if 0 < self.reject_threshold <= cost:
+            return "reject"
+        if 0 < self.background_threshold <= cost:
+            return "background"
+        if 0 < self.limit_threshold <= cost and (limit <= 0 or limit > self.forced_limit):
+            return "limit"
+        return "run"
+
+    def count(self, action):
+        self.n_actions[action] += 1
+
+    def stats(self):
+        return {
+            "thresholds": {
+                "limit": self.limit_threshold,
+                "background": self.background_threshold,
+                "reject": self.reject_threshold
+            },
+            "forced_limit": self.forced_limit,
+            "actions": dict(self.n_actions)
+        }
@@ -1,53 +1,177 @@
 import time
 import asyncio
+import functools
+import logging
 
 from impala.dbapi import connect, InterfaceError
 
+from coordinators import Coordinator, CoordinatorRouter, parse_hosts
+from resilience import CircuitBreaker, Backoff, DBUnavailable, is_retryable
+from query_options import QueryOptionProfiles
+
+
+def iter_poll_delays(min_delay, max_delay, factor=1.5):
+    """ delays between the polls of a running query: short for fast queries, growing up to max_delay """
+    delay = min_delay
+    while True:
+        yield delay
+        delay = min(max_delay, delay * factor)
+
 
 class HadoopDBConnection(object):
     def __init__(self, logger, config):
         self.logger = logger
         self.config = config
-        self.conn = None
 
         self.n_reconnect_tries = int(self.config["N_RECONNECT_TRIES"])
-        self.reconnect_delay = float(self.config["RECONNECT_DELAY"])  # seconds
-
-    def connect_to_db(self):
-        self.logger.info(
-            "connecting to database %s:%s" % (
-                self.config["DBHOST"],
-                self.config["DBPORT"]
-            )
+        self.backoff = Backoff(
+            float(self.config["RECONNECT_DELAY"]),
+            float(self.config["RECONNECT_MAX_DELAY"])
         )
-        self.conn = connect(
-            host=str(self.config["DBHOST"]),
-            port=int(self.config["DBPORT"])
+        self.breaker = CircuitBreaker(logger, config)
+        self.query_options = QueryOptionProfiles(logger, config)
+        self.health_check_interval = float(self.config["DB_HEALTH_CHECK_INTERVAL"])  # seconds
+        self.poll_min_interval = float(self.config["DB_POLL_MIN_INTERVAL"])  # seconds
+        self.poll_max_interval = float(self.config["DB_POLL_MAX_INTERVAL"])  # seconds
+
+        # idle connections per coordinator, every query takes one exclusively and returns it afterwards
+        self.pool_size = int(self.config["DB_POOL_SIZE"])
+        hosts = self.config["DBHOSTS"] or str(self.config["DBHOST"])
+        self.coordinators = [
+            Coordinator(host, port) for host, port in parse_hosts(hosts, self.config["DBPORT"])
+        ]
+        self.router = CoordinatorRouter(logger, config, self.coordinators)
+
+    def connect_to_db(self, coordinator):
+        self.logger.info("connecting to database %s" % coordinator.name)
+        conn = connect(
+            host=coordinator.host,
+            port=coordinator.port
         )
+        coordinator.n_connections += 1
+        return conn
 
-    def reconnect_to_db(self):
-        if self.conn is None:
-            raise RuntimeError("no connection established")
-        if self.conn is None:
-            raise RuntimeError("no connection has previously been established")
-        else:
-            self.conn.reconnect()
+    def disconnect_from_db(self, coordinator, conn):
+        coordinator.n_connections -= 1
+        try:
+            conn.close()
+        except Exception as e:
+            self.logger.debug("error while closing connection - %s", e)
 
-    def disconnect_from_db(self):
-        if self.conn is None:
-            raise RuntimeError("no connection established")
-        self.conn.close()
-        self.conn = None
+    def _route(self, sticky_key):
+        coordinator = self.router.choose(sticky_key)
+        coordinator.outstanding += 1
+        coordinator.n_queries += 1
+        return coordinator
 
-    def execute_query(self, *args, **kwargs):
-        if self.conn is None:
-            raise RuntimeError("no connection established")
-        if 'query_name' in kwargs:
-            query_name = kwargs.pop('query_name')
+    def _connection_failed(self, coordinator, e):
+        coordinator.outstanding -= 1
+        self.router.record_failure(coordinator)
+        return InterfaceError("could not connect to %s - %s" % (coordinator.name, str(e)))
+
+    def acquire_connection(self, sticky_key=None):
+        """ returns (coordinator, connection) of the coordinator the query is routed to """
+        coordinator = self._route(sticky_key)
+        if len(coordinator.pool) > 0:
+            return coordinator, coordinator.pool.pop()
+        try:
+            return coordinator, self.connect_to_db(coordinator)
+        except Exception as e:
+            raise self._connection_failed(coordinator, e)
+
+    async def acquire_connection_async(self, sticky_key=None):
+        """ like acquire_connection, new connections are opened in the default executor as connect() blocks """
+        coordinator = self._route(sticky_key)
+        if len(coordinator.pool) > 0:
+            return coordinator, coordinator.pool.pop()
+        future = asyncio.get_event_loop().run_in_executor(None, self.connect_to_db, coordinator)
+        try:
+            return coordinator, await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the connection is still being opened, it is closed once it is there
+            coordinator.outstanding -= 1
+            future.add_done_callback(functools.partial(self._close_opened, coordinator))
+            raise
+        except Exception as e:
+            raise self._connection_failed(coordinator, e)
+
+    def _close_opened(self, coordinator, future):
+        """ closes a connection that has been opened for a cancelled query """
+        if not future.cancelled() and future.exception() is None:
+            self.disconnect_from_db(coordinator, future.result())
+
+    def release_connection(self, coordinator, conn, discard=False):
+        coordinator.outstanding -= 1
+        if discard or not coordinator.healthy or len(coordinator.pool) >= self.pool_size:
+            self.disconnect_from_db(coordinator, conn)
         else:
-            query_name = None
+            coordinator.pool.append(conn)
 
-        self.logger.debug("executing query '%s'" % query_name)
+    def _fail_connection(self, coordinator, conn):
+        """ discards conn after a connection error, the idle connections are dropped with an ejected coordinator """
+        self.release_connection(coordinator, conn, discard=True)
+        if self.router.record_failure(coordinator):
+            self.close_pool(coordinator)
+
+    async def open_pool(self, n_connections=None):
+        """ opens connections until the pool of every healthy coordinator holds n_connections idle connections """
+        if n_connections is None:
+            n_connections = self.pool_size
+        loop = asyncio.get_event_loop()
+        for coordinator in self.router.get_candidates():
+            try:
+                while len(coordinator.pool) < min(n_connections, self.pool_size):
+                    conn = await loop.run_in_executor(None, self.connect_to_db, coordinator)
+                    coordinator.pool.append(conn)
+            except Exception as e:
+                self.logger.error("could not connect to %s - %s" % (coordinator.name, str(e)))
+                self.router.record_failure(coordinator)
+
+    def close_pool(self, coordinator=None):
+        for _coordinator in (self.coordinators if coordinator is None else [coordinator]):
+            while len(_coordinator.pool) > 0:
+                self.disconnect_from_db(_coordinator, _coordinator.pool.pop())
+
+    def check_coordinator(self, coordinator):
+        """ runs a trivial query on a new connection, raises on failure """
+        conn = connect(host=coordinator.host, port=coordinator.port)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+        finally:
+            conn.close()
+
+    async def run_health_checks(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for coordinator in self.coordinators:
+                try:
+                    await loop.run_in_executor(None, self.check_coordinator, coordinator)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning("health check of %s failed - %s" % (coordinator.name, str(e)))
+                    self.router.eject(coordinator)
+                    self.close_pool(coordinator)
+                    continue
+                self.router.readmit(coordinator)
+
+    def stats(self):
+        return {
+            "open_connections": sum(coordinator.n_connections for coordinator in self.coordinators),
+            "idle_connections": sum(len(coordinator.pool) for coordinator in self.coordinators),
+            "pool_size": self.pool_size,
+            "circuit_breaker": self.breaker.stats(),
+            "query_options": self.query_options.stats(),
+            "coordinators": {coordinator.name: coordinator.stats() for coordinator in self.coordinators}
+        }
+
+    def _log_query(self, query_name, args, kwargs):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         if 'operation' in kwargs:
             self.logger.debug(kwargs['operation'])
         else:
@@ -58,36 +182,88 @@ class HadoopDBConnection(object):
         elif len(args) >= 2:
             self.logger.debug(args[1])
 
-        for _ in range(self.n_reconnect_tries):
+    def _get_retry_delay(self, attempt):
+        if attempt + 1 >= self.n_reconnect_tries:
+            # no further attempt
+            return 0
+        return self.backoff.get_delay(attempt)
+
+    def _apply_query_options(self, query_name, args, kwargs):
+        """ merges the options of the profile of the query into the configuration argument, returns the variant """
+        if len(args) >= 3:
+            configuration, variant = self.query_options.get_configuration(query_name, args[2])
+            args = args[:2] + (configuration,) + args[3:]
+        else:
+            configuration, variant = self.query_options.get_configuration(query_name, kwargs.get('configuration'))
+            if configuration is not None:
+                kwargs['configuration'] = configuration
+        return args, kwargs, variant
+
+    @staticmethod
+    def _get_sticky_key(args, kwargs):
+        """ identical queries with identical parameters are routed to the same coordinator """
+        query = kwargs.get('operation', args[0] if len(args) > 0 else None)
+        parameters = kwargs.get('parameters', args[1] if len(args) > 1 else None)
+        return "%s|%r" % (query, parameters)
+
+    def execute_query(self, *args, **kwargs):
+        if 'query_name' in kwargs:
+            query_name = kwargs.pop('query_name')
+        else:
+            query_name = None
+
+        self.logger.debug("executing query '%s'", query_name)
+        self._log_query(query_name, args, kwargs)
+        args, kwargs, variant = self._apply_query_options(query_name, args, kwargs)
+
+        sticky_key = self._get_sticky_key(args, kwargs)
+        for attempt in range(self.n_reconnect_tries):
+            self.breaker.before_call()
             try:
-                return self._do_query(query_name, *args, **kwargs)
-            except InterfaceError:
-                self.logger.debug("trying to reconnect to hadoop")
-                time.sleep(self.reconnect_delay)
-                self.reconnect_to_db()
-        raise RuntimeError("could not connect to DB")
-
-    def _do_query(self, query_name, *args, **kwargs):
-        self.connect_to_db()
-        if self.conn is None:
-            raise RuntimeError("no connection established")
-        cursor = self.conn.cursor(dictify=True)
+                coordinator, conn = self.acquire_connection(sticky_key)
+            except InterfaceError as e:
+                self.breaker.record_failure()
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+                time.sleep(self._get_retry_delay(attempt))
+                continue
+            try:
+                results = self._do_query(conn, query_name, *args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # the cluster is there, the query is wrong
+                    self.breaker.record_success()
+                    self.release_connection(coordinator, conn)
+                    raise
+                self.breaker.record_failure()
+                self._fail_connection(coordinator, conn)
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+                time.sleep(self._get_retry_delay(attempt))
+                continue
+            self.breaker.record_success()
+            self.router.record_success(coordinator)
+            self.release_connection(coordinator, conn)
+            self.query_options.record(query_name, variant, results['query_time'])
+            return results
+        raise DBUnavailable("could not connect to DB", self.breaker.get_retry_after())
+
+    def _do_query(self, conn, query_name, *args, **kwargs):
+        cursor = conn.cursor(dictify=True)
         query_time_start = time.time()
         cursor.execute(*args, **kwargs)
         dt_query = time.time() - query_time_start
         if query_name is None:
-            self.logger.debug("query time: %f" % dt_query)
+            self.logger.debug("query time: %f", dt_query)
         else:
-            self.logger.debug("query time (%s): %f" % (query_name, dt_query))
+            self.logger.debug("query time (%s): %f", query_name, dt_query)
         fetch_time_start = time.time()
-        results = cursor.fetchall()
+        # e.g. DDL and INSERT have no result set
+        results = cursor.fetchall() if cursor.has_result_set else []
         dt_fetch = time.time() - fetch_time_start
         if query_name is None:
-            self.logger.debug("fetch time: %f" % dt_fetch)
+            self.logger.debug("fetch time: %f", dt_fetch)
         else:
-            self.logger.debug("fetch time (%s): %f" % (query_name, dt_fetch))
+            self.logger.debug("fetch time (%s): %f", query_name, dt_fetch)
         cursor.close()
-        self.disconnect_from_db()
         return {
             'rows': results,
             'query_time': dt_query,
@@ -95,50 +271,68 @@ class HadoopDBConnection(object):
         }
 
     async def execute_query_async(self, *args, **kwargs):
-        self.connect_to_db()
-        if self.conn is None:
-            raise RuntimeError("no connection established")
         if 'query_name' in kwargs:
             query_name = kwargs.pop('query_name')
         else:
             query_name = None
 
-        self.logger.debug("executing query (async) '%s'" % query_name)
-        if 'operation' in kwargs:
-            self.logger.debug(kwargs['operation'])
-        else:
-            self.logger.debug(args[0])
-
-        if 'parameters' in kwargs:
-            self.logger.debug(kwargs['parameters'])
-        elif len(args) >= 2:
-            self.logger.debug(args[1])
+        self.logger.debug("executing query (async) '%s'", query_name)
+        self._log_query(query_name, args, kwargs)
+        args, kwargs, variant = self._apply_query_options(query_name, args, kwargs)
 
-        for _ in range(self.n_reconnect_tries):
+        sticky_key = self._get_sticky_key(args, kwargs)
+        for attempt in range(self.n_reconnect_tries):
+            self.breaker.before_call()
+            try:
+                coordinator, conn = await self.acquire_connection_async(sticky_key)
+            except InterfaceError as e:
+                self.breaker.record_failure()
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+                await asyncio.sleep(self._get_retry_delay(attempt))
+                continue
+            except BaseException:
+                # cancelled while connecting
+                self.breaker.release()
+                raise
             try:
-                return await self._do_query_async(query_name, *args, **kwargs)
-            except InterfaceError:
-                self.logger.debug("trying to reconnect to hadoop")
-                time.sleep(self.reconnect_delay)
-                self.reconnect_to_db()
-        raise RuntimeError("could not connect to DB")
-        self.disconnect_from_db()
-
-    async def _do_query_async(self, query_name, *args, **kwargs):
-        if self.conn is None:
-            raise RuntimeError("no connection established")
+                results = await self._do_query_async(conn, query_name, *args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # the cluster is there, the query is wrong
+                    self.breaker.record_success()
+                    self.release_connection(coordinator, conn)
+                    raise
+                self.breaker.record_failure()
+                self._fail_connection(coordinator, conn)
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+                await asyncio.sleep(self._get_retry_delay(attempt))
+                continue
+            except BaseException:
+                # cancellation, the state of the session is unknown
+                self.breaker.release()
+                self.release_connection(coordinator, conn, discard=True)
+                raise
+            self.breaker.record_success()
+            self.router.record_success(coordinator)
+            self.release_connection(coordinator, conn)
+            self.query_options.record(query_name, variant, results['query_time'])
+            return results
+        raise DBUnavailable("could not connect to DB", self.breaker.get_retry_after())
+
+    async def _do_query_async(self, conn, query_name, *args, **kwargs):
         self.logger.debug("fetching cursor")
-        cursor = self.conn.cursor(dictify=True)
+        cursor = conn.cursor(dictify=True)
         self.logger.debug("executing query")
         query_time_start = time.time()
         cursor.execute_async(*args, **kwargs)
 
-        counter = 0
+        last_log = 0.0
+        delays = iter_poll_delays(self.poll_min_interval, self.poll_max_interval)
         while cursor.is_executing():
-            if (counter % 60) == 0:
+            if time.time() - last_log >= 60.0:
                 self.logger.debug("waiting for result...")
-            await asyncio.sleep(1.0)
-            counter += 1
+                last_log = time.time()
+            await asyncio.sleep(next(delays))
 
         # Populate the fields in cursor (hack to make dict-cursor work with async)
         # see https://github.com/cloudera/impyla/issues/292
@@ -149,19 +343,126 @@ class HadoopDBConnection(object):
 
         dt_query = time.time() - query_time_start
         if query_name is None:
-            self.logger.debug("query time: %f" % dt_query)
+            self.logger.debug("query time: %f", dt_query)
         else:
-            self.logger.debug("query time (%s): %f" % (query_name, dt_query))
+            self.logger.debug("query time (%s): %f", query_name, dt_query)
         fetch_time_start = time.time()
-        results = cursor.fetchall()
+        # e.g. DDL and INSERT have no result set
+        results = cursor.fetchall() if cursor.has_result_set else []
         dt_fetch = time.time() - fetch_time_start
         if query_name is None:
-            self.logger.debug("fetch time: %f" % dt_fetch)
+            self.logger.debug("fetch time: %f", dt_fetch)
         else:
-            self.logger.debug("fetch time (%s): %f" % (query_name, dt_fetch))
+            self.logger.debug("fetch time (%s): %f", query_name, dt_fetch)
         cursor.close()
         return {
             'rows': results,
             'query_time': dt_query,
             'fetch_time': dt_fetch
         }
+
+    @staticmethod
+    def _get_progress(cursor, start):
+        progress = {"state": "running", "elapsed": time.time() - start}
+        try:
+            summary = cursor.get_summary()
+        except Exception:
+            # not all servers provide an exec summary
+            return progress
+        if summary is None:
+            return progress
+        if getattr(summary, "is_queued", False):
+            progress["state"] = "queued"
+            progress["queued_reason"] = summary.queued_reason
+        if getattr(summary, "progress", None) is not None:
+            progress["completed_scan_ranges"] = summary.progress.num_completed_scan_ranges
+            progress["total_scan_ranges"] = summary.progress.total_scan_ranges
+        return progress
+
+    async def stream_query_async(self, query, parameters=None, configuration=None, batch_size=None, query_name=None):
+        """ async generator yielding ("progress", progress) while the query executes and ("rows", rows) batches
+
+        Fetching runs in the default executor to keep the event loop responsive.
+        Like execute_query_async, errors of the connection or the cluster are
+        retried, but only until the first batch of rows has been yielded.
+        If the generator is closed or cancelled early, the query is cancelled
+        on the cluster.
+        """
+        if batch_size is None:
+            batch_size = int(self.config["FETCH_BATCH_SIZE"])
+        self.logger.debug("executing query (stream) '%s'", query_name)
+        loop = asyncio.get_event_loop()
+        configuration, variant = self.query_options.get_configuration(query_name, configuration)
+        sticky_key = self._get_sticky_key((query, parameters), {})
+        for attempt in range(self.n_reconnect_tries):
+            self.breaker.before_call()
+            try:
+                coordinator, conn = await self.acquire_connection_async(sticky_key)
+            except InterfaceError as e:
+                self.breaker.record_failure()
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+                await asyncio.sleep(self._get_retry_delay(attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            cursor = None
+            finished = False
+            failed = False
+            yielded_rows = False
+            try:
+                cursor = conn.cursor(dictify=True)
+                start = time.time()
+                cursor.execute_async(query, parameters, configuration)
+                delays = iter_poll_delays(self.poll_min_interval, self.poll_max_interval)
+                while cursor.is_executing():
+                    yield "progress", self._get_progress(cursor, start)
+                    await asyncio.sleep(next(delays))
+                self.query_options.record(query_name, variant, time.time() - start)
+                if cursor.description is not None:
+                    cursor.fields = [d[0] for d in cursor.description]
+                else:
+                    cursor.fields = None
+                while True:
+                    rows = await loop.run_in_executor(None, cursor.fetchmany, batch_size)
+                    if len(rows) == 0:
+                        break
+                    yielded_rows = True
+                    yield "rows", rows
+                finished = True
+                cursor.close()
+            except Exception as e:
+                if not is_retryable(e):
+                    # the cluster is there, the query is wrong
+                    self.breaker.record_success()
+                    raise
+                failed = True
+                self.breaker.record_failure()
+                if yielded_rows:
+                    raise
+                self.logger.debug("trying to reconnect to hadoop - %s", e)
+            finally:
+                if cursor is not None and not finished:
+                    self.logger.info("cancelling query '%s'" % query_name)
+                    try:
+                        cursor.cancel_operation()
+                    except Exception as e:
+                        self.logger.debug("error while cancelling query - %s", e)
+                self.breaker.release()
+                if failed:
+                    self._fail_connection(coordinator, conn)
+                else:
+                    self.release_connection(coordinator, conn, discard=not finished)
+            if finished:
+                self.breaker.record_success()
+                self.router.record_success(coordinator)
+                return
+            await asyncio.sleep(self._get_retry_delay(attempt))
+        raise DBUnavailable("could not connect to DB", self.breaker.get_retry_after())
+
+    async def execute_query_batches_async(self, query, parameters=None, batch_size=None, query_name=None):
+        """ async generator yielding the result rows in batches of batch_size """
+        async for event, value in self.stream_query_async(
+                query, parameters, batch_size=batch_size, query_name=query_name):
+            if event == "rows":
+                yield value
@@ -0,0 +1,306 @@
+import os
+import math
+import mmap
+import time
+import fcntl
+import asyncio
+import hashlib
+import datetime
+from collections import OrderedDict
+
+from bitarray import bitarray
+
+
+"""
+Negative result cache and per-day existence (Bloom) filters
+
+Both answer the question "can X appear in the data of day D?" so that
+lookups can drop inputs which certainly have no rows from the IN-lists or
+skip the DB call altogether:
+
+- NegativeCache remembers for (kind, value) the day ranges in which a
+  previous lookup returned no rows, so a lookup over years takes one entry
+  per value.
+- BloomFilter holds the values of one column (query_name, ip4_address or
+  ip6_address) observed on one day. The filters are built by a background
+  job (hashing in an executor thread) and stored in EXISTENCE_FILTER_DIR,
+  so all workers of a host share one build. The workers memory-map the
+  stored filters, so they share one copy in the page cache as well.
+
+A value is only considered absent for an interval if it is known to be
+absent on every day of that interval.
+"""
+
+KINDS = ("query_name", "ip4_address", "ip6_address")
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def iter_days(date_from, date_to):
+    day = date_from
+    while day <= date_to:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate, bits=None, n_bits=None, n_hashes=None, offset=0):
+        if bits is None:
+            n_bits = max(int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+            bits = bitarray(n_bits, endian="big")
+            bits.setall(False)
+        self.bits = bits  # bitarray while building, read-only mmap of the file once loaded
+        self.mapped = isinstance(bits, mmap.mmap)
+        self.offset = offset  # of the bits in the mmap
+        self.n_bits = n_bits if n_bits is not None else len(bits)
+        if n_hashes is None:
+            n_hashes = int(round(self.n_bits / float(max(capacity, 1)) * math.log(2)))
+        self.n_hashes = max(1, n_hashes)
+
+    def _indexes(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def _is_set(self, i):
+        if self.mapped:
+            return (self.bits[self.offset + (i >> 3)] & (0x80 >> (i & 7))) != 0
+        return self.bits[i]
+
+    def add(self, value):
+        for i in self._indexes(value):
+            self.bits[i] = True
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        return all(self._is_set(i) for i in self._indexes(value))
+
+    def save(self, filename):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(b"%i %i\n" % (self.n_bits, self.n_hashes))
+            self.bits.tofile(f)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ maps the file read-only, the bits are paged in on demand and shared by all processes """
+        with open(filename, "rb") as f:
+            header = f.readline()
+            n_bits, n_hashes = map(int, header.split())
+            bits = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(None, None, bits=bits, n_bits=n_bits, n_hashes=n_hashes, offset=len(header))
+
+    def close(self):
+        if self.mapped:
+            self.bits.close()
+
+
+class NegativeCache(object):
+    MAX_RANGES = 8  # per value, the oldest are dropped
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (kind, value) -> [(date_from, date_to, expires), ...]
+
+    def add(self, kind, value, date_from, date_to):
+        key = (kind, value)
+        now = time.time()
+        ranges = [
+            r for r in self._entries.get(key, ())
+            if r[2] >= now and not (date_from <= r[0] and r[1] <= date_to)
+        ]
+        ranges.append((date_from, date_to, now + self.ttl))
+        self._entries[key] = ranges[-self.MAX_RANGES:]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_ranges(self, kind, value):
+        """ the day ranges in which the value is known to be absent, sorted by their first day """
+        key = (kind, value)
+        ranges = self._entries.get(key)
+        if ranges is None:
+            return []
+        now = time.time()
+        ranges = [r for r in ranges if r[2] >= now]
+        if len(ranges) == 0:
+            del self._entries[key]
+            return []
+        return sorted((date_from, date_to) for date_from, date_to, expires in ranges)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ExistenceFilter(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.negative_cache = NegativeCache(
+            int(self.config["NEGATIVE_CACHE_SIZE"]),
+            float(self.config["NEGATIVE_CACHE_TTL"])
+        )
+        self.min_age_days = int(self.config["NEGATIVE_CACHE_MIN_AGE_DAYS"])
+
+        self.filters_enabled = bool(self.config["EXISTENCE_FILTERS"])
+        self.filter_dir = self.config["EXISTENCE_FILTER_DIR"]
+        self.filter_days = int(self.config["EXISTENCE_FILTER_DAYS"])
+        self.filter_capacity = int(self.config["EXISTENCE_FILTER_CAPACITY"])
+        self.filter_error_rate = float(self.config["EXISTENCE_FILTER_ERROR_RATE"])
+        self.refresh_interval = float(self.config["EXISTENCE_FILTER_REFRESH_INTERVAL"])  # seconds
+        self.filters = dict()  # (kind, day) -> BloomFilter
+
+        self.n_checked = 0
+        self.n_dropped = 0
+        self.n_skipped_queries = 0
+
+    def is_final(self, day):
+        """ days younger than NEGATIVE_CACHE_MIN_AGE_DAYS may still be loaded """
+        return day <= datetime.date.today() - datetime.timedelta(days=self.min_age_days)
+
+    def _absent_in_filters(self, kind, value, date_from, date_to):
+        for day in iter_days(date_from, date_to):
+            bloom = self.filters.get((kind, day))
+            if bloom is None or value in bloom:
+                return False
+        return True
+
+    def is_absent(self, kind, value, date_from, date_to):
+        """ the days that are not covered by the negative cache have to be covered by the Bloom filters """
+        day = date_from
+        for start, end in self.negative_cache.get_ranges(kind, value):
+            if start > day and not self._absent_in_filters(kind, value, day, min(start - ONE_DAY, date_to)):
+                return False
+            day = max(day, end + ONE_DAY)
+            if day > date_to:
+                return True
+        return self._absent_in_filters(kind, value, day, date_to)
+
+    def split_absent(self, kind, values, date_from, date_to):
+        """ splits values into the ones that may be present and the ones that are certainly absent """
+        present = []
+        absent = []
+        for value in values:
+            if self.is_absent(kind, value, date_from, date_to):
+                absent.append(value)
+            else:
+                present.append(value)
+        self.n_checked += len(values)
+        self.n_dropped += len(absent)
+        return present, absent
+
+    def record_absent(self, kind, values, date_from, date_to):
+        """ remembers the values as absent in the final days of the interval, one entry per value """
+        date_to = min(date_to, datetime.date.today() - datetime.timedelta(days=self.min_age_days))
+        if date_from > date_to:
+            return
+        for value in values:
+            self.negative_cache.add(kind, value, date_from, date_to)
+
+    def stats(self):
+        return {
+            "negative_cache_entries": len(self.negative_cache),
+            "filters_enabled": self.filters_enabled,
+            "filters_loaded": sorted("%s/%s" % (kind, day.isoformat()) for kind, day in self.filters.keys()),
+            "inputs_checked": self.n_checked,
+            "inputs_dropped": self.n_dropped,
+            "skipped_queries": self.n_skipped_queries
+        }
+
+    ###########################################################################
+    # Bloom filter background job
+
+    def _get_filename(self, kind, day):
+        return os.path.join(self.filter_dir, "%s_%s.bloom" % (day.isoformat(), kind))
+
+    def _days_to_filter(self):
+        last_day = datetime.date.today() - datetime.timedelta(days=self.min_age_days)
+        return [last_day - datetime.timedelta(days=i) for i in range(self.filter_days)]
+
+    async def build_filter(self, DBConnection, kind, day):
+        bloom = BloomFilter(self.filter_capacity, self.filter_error_rate)
+        query = """
+            SELECT DISTINCT %(kind)s AS value
+            FROM %(db)s
+            WHERE
+                (%(kind)s IS NOT NULL)
+                AND (CAST(year AS integer) = %%(year)s)
+                AND (CAST(month AS integer) = %%(month)s)
+                AND (CAST(day AS integer) = %%(day)s)
+        """ % {
+            'db': self.config["DB"],
+            'kind': kind
+        }
+        params = {'year': day.year, 'month': day.month, 'day': day.day}
+        n_values = 0
+        loop = asyncio.get_event_loop()
+        async for rows in DBConnection.execute_query_batches_async(
+            query,
+            params,
+            query_name='existence_filter_%s' % kind
+        ):
+            # hashing millions of values would block the event loop
+            await loop.run_in_executor(None, bloom.update, [row["value"] for row in rows])
+            n_values += len(rows)
+        if n_values == 0:
+            # the partition has not been loaded (yet) - an empty filter would drop every input
+            self.logger.info("no %s values found for %s - not storing an existence filter" % (kind, day))
+            return None
+        if n_values > self.filter_capacity:
+            self.logger.warning(
+                "%i distinct %s values on %s exceed the filter capacity of %i" % (
+                    n_values, kind, day, self.filter_capacity
+                )
+            )
+        return bloom
+
+    def load_filters(self):
+        """ loads the filters for the days of interest that have been built by any worker """
+        wanted = set()
+        for day in self._days_to_filter():
+            for kind in KINDS:
+                wanted.add((kind, day))
+                filename = self._get_filename(kind, day)
+                if (kind, day) not in self.filters and os.path.exists(filename):
+                    self.filters[(kind, day)] = BloomFilter.load(filename)
+        for key in list(self.filters.keys()):
+            if key not in wanted:
+                self.filters.pop(key).close()
+
+    async def build_missing_filters(self, DBConnection):
+        os.makedirs(self.filter_dir, exist_ok=True)
+        with open(os.path.join(self.filter_dir, ".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is building the filters
+                return
+            for day in self._days_to_filter():
+                for kind in KINDS:
+                    filename = self._get_filename(kind, day)
+                    if os.path.exists(filename):
+                        continue
+                    self.logger.info("building existence filter %s" % filename)
+                    bloom = await self.build_filter(DBConnection, kind, day)
+                    if bloom is not None:
+                        bloom.save(filename)
+            for filename in os.listdir(self.filter_dir):
+                if filename.endswith(".bloom") and filename[:10] < self._days_to_filter()[-1].isoformat():
+                    os.remove(os.path.join(self.filter_dir, filename))
+
+    async def run_background_job(self, DBConnection):
+        while True:
+            try:
+                await self.build_missing_filters(DBConnection)
+                self.load_filters()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error("error while building existence filters - %s" % str(e))
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,75 @@
+import io
+import csv
+import json
+
+from fastapi.encoders import jsonable_encoder
+
+from spill import iter_batches
+
+
+"""
+Helpers to export query results
+"""
+
+
+def write_csv(stream, rows, delimiter=';', quotechar='"'):
+    """ writes the dict rows returned by the DB layer as CSV to stream
+
+    the header is taken from the keys of the first row, an empty result
+    produces an empty file
+    """
+    csv_writer = csv.writer(
+        stream,
+        delimiter=delimiter,
+        quotechar=quotechar
+    )
+
+    fields = None
+    for line in rows:
+        if fields is None:
+            fields = list(line.keys())
+            csv_writer.writerow(fields)
+        csv_writer.writerow([line[key] for key in fields])
+
+    return stream
+
+
+class CSVChunkWriter(object):
+    """ formats batches of dict rows as CSV text, the header is written with the first batch """
+    def __init__(self, delimiter=';', quotechar='"'):
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.fields = None
+
+    def write(self, rows):
+        stream = io.StringIO()
+        csv_writer = csv.writer(
+            stream,
+            delimiter=self.delimiter,
+            quotechar=self.quotechar
+        )
+        for line in rows:
+            if self.fields is None:
+                self.fields = list(line.keys())
+                csv_writer.writerow(self.fields)
+            csv_writer.writerow([line[key] for key in self.fields])
+        return stream.getvalue()
+
+
+def iter_csv(rows, batch_size=10000):
+    """ yields a list of rows or SpilledRows as CSV text in batches """
+    csv_writer = CSVChunkWriter()
+    for batch in iter_batches(rows, batch_size):
+        yield csv_writer.write(batch)
+
+
+def iter_json(results, rows_key="data", batch_size=10000):
+    """ yields the JSON text of a result dict, the rows under rows_key are encoded in batches """
+    meta = {key: value for key, value in results.items() if key != rows_key}
+    head = json.dumps(jsonable_encoder(meta))
+    yield head[:-1] + (", " if len(meta) > 0 else "") + json.dumps(rows_key) + ": ["
+    separator = ""
+    for batch in iter_batches(results[rows_key], batch_size):
+        yield separator + ", ".join(json.dumps(row) for row in jsonable_encoder(batch))
+        separator = ", "
+    yield "]}"
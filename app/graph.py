@@ -0,0 +1,84 @@
+"""
+Resolution graphs
+
+The graph of a set of domains is built breadth-first over the CNAME, DNAME,
+MX and NS references and the A/AAAA records: all names of a depth level are
+looked up with a single query (which is cached per level like any other
+lookup), their targets form the next level. Every name is expanded only once,
+edges to names that are already in the graph are kept, those pointing to a
+name of the same or a lower depth may close a cycle and are listed in cycles.
+"""
+
+ADDRESS_TYPES = ("A", "AAAA")
+
+
+async def resolve_graph(lookup, roots, max_depth, max_nodes):
+    """ lookup(names) returns the result of a references lookup of the names, at most max_nodes rows
+
+    returns the nodes (name or address, with the depth at which they were found),
+    the edges and per level the number of names and of rows of the lookup
+    """
+    depths = {}  # node -> depth
+    nodes = []
+    edges = []
+    cycles = []
+    levels = []
+    truncated = False
+
+    level = []
+    for root in roots:
+        if root not in depths:
+            depths[root] = 0
+            nodes.append({"id": root, "type": "name", "depth": 0})
+            level.append(root)
+
+    depth = 0
+    while len(level) > 0:
+        if depth >= max_depth:
+            # names that are not expanded anymore
+            truncated = True
+            break
+        results = await lookup(level)
+        levels.append({
+            "depth": depth,
+            "names": len(level),
+            "rows": len(results["rows"]),
+            "query_time": results.get("query_time", 0.0)
+        })
+        if len(results["rows"]) >= max_nodes:
+            # the lookup of the level was limited to max_nodes rows
+            truncated = True
+        next_level = []
+        for row in results["rows"]:
+            target = row.get("target")
+            if target is None or row.get("name") not in depths:
+                continue
+            is_address = row["record_type"] in ADDRESS_TYPES
+            if target not in depths:
+                if len(depths) >= max_nodes:
+                    truncated = True
+                    continue
+                depths[target] = depth + 1
+                nodes.append({"id": target, "type": "address" if is_address else "name", "depth": depth + 1})
+                if not is_address:
+                    next_level.append(target)
+            edge = {
+                "source": row["name"],
+                "target": target,
+                "record_type": row["record_type"],
+                "first_ts": row.get("first_ts"),
+                "last_ts": row.get("last_ts")
+            }
+            edges.append(edge)
+            if not is_address and depths[target] <= depths[row["name"]]:
+                cycles.append(edge)
+        level = next_level
+        depth += 1
+
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "cycles": cycles,
+        "levels": levels,
+        "truncated": truncated
+    }
@@ -0,0 +1,136 @@
+import json
+import hashlib
+import datetime
+import contextvars
+from urllib.parse import urlencode
+
+
+"""
+HTTP caching of lookup results
+
+Responses of the lookups get a (weak) ETag that is derived from the request
+alone: method, path, the sorted query parameters, the normalized JSON body
+and the version of the data (see PartitionCatalog.version, it changes
+whenever partitions are loaded or reloaded). A request with a matching
+If-None-Match is answered with 304 Not Modified without running the lookup.
+Results of intervals that end before the latest loaded day do not change
+anymore and are sent with "Cache-Control: public, max-age=HTTP_CACHE_MAX_AGE,
+immutable", all others have to be revalidated (HTTP_CACHE_RECENT_MAX_AGE).
+Responses that depend on more than the request, e.g. results with failed
+slices or snapshots, are marked with mark_uncacheable() and sent without
+validators.
+"""
+
+CACHEABLE_PATHS = (
+    "/api/v1/domains_by_ip/",
+    "/api/v1/domains_by_ips/",
+    "/api/v1/ips_by_domain/",
+    "/api/v1/ips_by_domains/",
+    "/api/v1/ips_by_mx_pattern/",
+    "/api/v1/graph/",
+    "/api/v1/changes/",
+    "/api/v1/batch",
+    "/api/v1/measurements_by_domain/",
+    "/api/v1/records_summary/"
+)
+# the last day of the interval of a request
+DATE_TO_PARAMETERS = ("date_to", "date_after")
+# requests that are not answered from their parameters alone
+UNCACHEABLE_PARAMETERS = ("profile", "snapshot")
+
+response_state = contextvars.ContextVar("http_cache_state", default=None)
+
+
+def mark_uncacheable():
+    """ the response of the current request must not get an ETag """
+    state = response_state.get()
+    if state is not None:
+        state["cacheable"] = False
+
+
+def normalize_body(body):
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode("utf-8")
+    except ValueError:
+        return body
+
+
+def parse_if_none_match(value):
+    """ returns the opaque tags of an If-None-Match header, weak or not ("*" matches all) """
+    tags = set()
+    for tag in value.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if len(tag) > 0:
+            tags.add(tag)
+    return tags
+
+
+class HTTPCachePolicy(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.enabled = self.config["HTTP_CACHE"]
+        self.max_age = int(self.config["HTTP_CACHE_MAX_AGE"])  # seconds, historical intervals
+        self.recent_max_age = int(self.config["HTTP_CACHE_RECENT_MAX_AGE"])  # seconds, 0: revalidate
+
+        self.n_tagged = 0
+        self.n_not_modified = 0
+
+    def applies(self, request):
+        if not self.enabled or request.method not in ("GET", "POST"):
+            return False
+        if not request.url.path.startswith(CACHEABLE_PATHS):
+            return False
+        return all(request.query_params.get(name) != "true" for name in UNCACHEABLE_PARAMETERS)
+
+    @staticmethod
+    def get_etag(request, body, data_version):
+        query = urlencode(sorted(request.query_params.multi_items()))
+        digest = hashlib.sha1()
+        for part in (request.method, request.url.path, query, data_version):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\n")
+        digest.update(normalize_body(body))
+        # weak: the body differs in the timings
+        return 'W/"%s"' % digest.hexdigest()
+
+    @staticmethod
+    def is_historical(request, latest_day):
+        """ True if the requested interval ends before the latest loaded day """
+        for name in DATE_TO_PARAMETERS:
+            value = request.query_params.get(name)
+            if value is None:
+                continue
+            try:
+                return datetime.date.fromisoformat(value) < latest_day
+            except ValueError:
+                return False
+        # the default interval is the latest loaded day
+        return False
+
+    def get_cache_control(self, historical):
+        if historical:
+            return "public, max-age=%i, immutable" % self.max_age
+        if self.recent_max_age > 0:
+            return "public, max-age=%i" % self.recent_max_age
+        return "no-cache"
+
+    def is_not_modified(self, request, etag):
+        value = request.headers.get("if-none-match")
+        if value is None:
+            return False
+        tags = parse_if_none_match(value)
+        if "*" in tags or etag[2:] in tags:
+            self.n_not_modified += 1
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "tagged": self.n_tagged,
+            "not_modified": self.n_not_modified
+        }
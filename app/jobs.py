@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import uuid
+
+
+"""
+Background jobs
+
+Job state and results are stored in JOB_DIR, so that any worker process can
+report the progress and serve the result of a job started by another one.
+"""
+
+
+class JobStore(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.job_dir = self.config["JOB_DIR"]
+        self.job_ttl = float(self.config["JOB_TTL"])  # seconds
+        self.stale_after = float(self.config["JOB_STALE_AFTER"])  # seconds
+        os.makedirs(self.job_dir, exist_ok=True)
+
+    def _get_filename(self, job_id, suffix="json"):
+        # job ids are generated by create(), anything else is rejected
+        if not all(c in "0123456789abcdef" for c in job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.job_dir, "%s.%s" % (job_id, suffix))
+
+    def _write(self, job_id, state):
+        filename = self._get_filename(job_id)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(state, f, default=str)
+        os.rename(tmp_filename, filename)
+
+    def create(self, job_type, parameters, result_format):
+        self.cleanup()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._write(job_id, {
+            "job_id": job_id,
+            "type": job_type,
+            "parameters": parameters,
+            "status": "pending",
+            "progress": {},
+            "result_format": result_format,
+            "created": now,
+            "updated": now,
+            "error": None
+        })
+        return job_id
+
+    def get(self, job_id):
+        try:
+            with open(self._get_filename(job_id)) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise KeyError(job_id)
+        if state["status"] in ("pending", "running") and state["updated"] < time.time() - self.stale_after:
+            # the worker running the job has been restarted
+            state["status"] = "abandoned"
+        return state
+
+    def update(self, job_id, **kwargs):
+        state = self.get(job_id)
+        state.update(kwargs)
+        state["updated"] = time.time()
+        self._write(job_id, state)
+        return state
+
+    def get_result_filename(self, job_id):
+        return self._get_filename(job_id, "result")
+
+    def cleanup(self):
+        limit = time.time() - self.job_ttl
+        for filename in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, filename)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
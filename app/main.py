@@ -2,11 +2,10 @@
 
 import time
 import json
+import asyncio
 import logging
 import ipaddress
 import datetime
-import io
-import csv
 
 from typing import Optional, List
 from pydantic import IPvAnyAddress, BaseModel
@@ -14,18 +13,46 @@ from pydantic import IPvAnyAddress, BaseModel
 from fastapi import FastAPI, Query, HTTPException, Request, Form
 from fastapi.exceptions import ValidationError
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, FileResponse, PlainTextResponse, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from config import config
 
 from db import HadoopDBConnection
+from stub_db import StubDBConnection
+from existence import ExistenceFilter
+from starlette.background import BackgroundTask
+
+from export import CSVChunkWriter, iter_csv, iter_json
+from spill import ResultMemory, SpillingConnection, SpilledRows
+from bulk import normalize_domain, read_inputs, iter_request_body, get_chunks, run_chunked
+from jobs import JobStore
+from snapshots import SnapshotStore
+from cache import ResultCache, make_key
+from warmup import HotKeyTracker, Warmer
+from partitions import PartitionCatalog
+from cost import CostEstimator
+from resilience import DBUnavailable
+from streaming import StreamingConnection, format_sse, QUEUE_SIZE
+from slicing import MERGE_SPECS, RowMerger, get_slices, run_sliced
+from graph import resolve_graph
+from scheduler import FairScheduler, ScheduledConnection, RateLimited, current_client, get_client_id
+from profiling import RequestProfiler
+from httpcache import HTTPCachePolicy, response_state, mark_uncacheable
+from rollup import RecordsRollup
+from sql_templates import templates as sql_templates
 from openintel_sql_calls import (
     openintel_select_domains_by_ips,
     openintel_select_ips_by_domains,
     openintel_select_ips_by_mx_records,
-    openintel_select_measurements_by_name_and_ip_or_type
+    openintel_select_measurements_by_name_and_ip_or_type,
+    openintel_select_references,
+    openintel_select_changes,
+    openintel_select_records_summary,
+    parse_ip_input,
+    group_rows_by_input
 )
 
 
@@ -40,6 +67,40 @@ class CSVModel(BaseModel):
 DBConnection = None
 cursor = None
 
+# Negative cache and existence filters
+existence_filter = None
+background_tasks = []
+
+# Bulk lookups
+job_store = None
+
+# Result snapshots for the web UI
+snapshot_store = None
+
+# Fair-share scheduling of the queries of the clients
+scheduler = None
+
+# Profiling of single requests
+profiler = None
+
+# ETags and Cache-Control of the lookups
+http_cache_policy = None
+
+# Memory budget of results
+result_memory = None
+
+# Catalog of the loaded partitions and cost estimation
+catalog = None
+cost_estimator = None
+
+# Result cache, warm-up and pre-population
+result_cache = None
+hot_keys = None
+warmer = None
+
+# Daily rollups of the records
+records_rollup = None
+
 # Fast API
 version = config['version']
 description = """
@@ -89,10 +150,62 @@ logger.addHandler(logger_sh)
 
 
 @app.on_event('startup')
-def startup():
+async def startup():
     global DBConnection
+    global existence_filter
+    global job_store
+    global result_cache
+    global hot_keys
+    global warmer
+    global catalog
+    global cost_estimator
+    global snapshot_store
+    global scheduler
+    global result_memory
+    global profiler
+    global http_cache_policy
+    global records_rollup
     logger.info("starting up")
-    DBConnection = HadoopDBConnection(logger, config)
+    scheduler = FairScheduler(logger, config)
+    profiler = RequestProfiler(logger, config)
+    http_cache_policy = HTTPCachePolicy(logger, config)
+    if config["DBBACKEND"] == "stub":
+        logger.warning("using stub DB backend - all results are synthetic")
+        DBConnection = ScheduledConnection(StubDBConnection(logger, config), scheduler)
+    else:
+        DBConnection = ScheduledConnection(HadoopDBConnection(logger, config), scheduler)
+    background_tasks.append(asyncio.ensure_future(DBConnection.run_health_checks()))
+    existence_filter = ExistenceFilter(logger, config)
+    if config["EXISTENCE_FILTERS"]:
+        background_tasks.append(
+            asyncio.ensure_future(existence_filter.run_background_job(DBConnection))
+        )
+    job_store = JobStore(logger, config)
+    snapshot_store = SnapshotStore(logger, config)
+    result_memory = ResultMemory(logger, config)
+    catalog = PartitionCatalog(logger, config)
+    try:
+        await asyncio.wait_for(catalog.refresh(DBConnection), float(config["WARMUP_TIMEOUT"]))
+    except Exception as e:
+        logger.error("loading the partition catalog failed - %s" % str(e))
+    cost_estimator = CostEstimator(logger, config, catalog)
+    result_cache = ResultCache(logger, config)
+    hot_keys = HotKeyTracker(int(config["HOT_KEYS_CAPACITY"]))
+    warmer = Warmer(logger, config, DBConnection, LOOKUPS, execute_lookup, result_cache, hot_keys, catalog)
+    catalog.listeners.append(warmer.on_catalog_refresh)
+    records_rollup = RecordsRollup(logger, config, DBConnection, catalog, result_cache)
+    try:
+        await asyncio.wait_for(records_rollup.start(), float(config["WARMUP_TIMEOUT"]))
+    except Exception as e:
+        logger.error("loading the records rollup failed - %s" % str(e))
+    cost_estimator.rollups["records_summary"] = records_rollup
+    catalog.listeners.append(records_rollup.on_catalog_refresh)
+    background_tasks.append(asyncio.ensure_future(catalog.run_scheduler(DBConnection)))
+    if config["WARMUP"]:
+        try:
+            await asyncio.wait_for(warmer.warm_up(), float(config["WARMUP_TIMEOUT"]))
+        except Exception as e:
+            logger.error("warm-up failed - %s" % str(e))
     return
 
 
@@ -101,6 +214,321 @@ def shutdown():
     global DBConnection
     # do shutdown stuff like closing a DB connection
     logger.info('shutting down....')
+    for task in background_tasks:
+        task.cancel()
+    records_rollup.stop()
+    DBConnection.close_pool()
+
+
+LOOKUPS = {
+    "domains_by_ips": openintel_select_domains_by_ips,
+    "ips_by_domains": openintel_select_ips_by_domains,
+    "ips_by_mx_pattern": openintel_select_ips_by_mx_records,
+    "measurements_by_domain": openintel_select_measurements_by_name_and_ip_or_type,
+    "references": openintel_select_references,
+    "changes": openintel_select_changes,
+    "records_summary": openintel_select_records_summary
+}
+
+
+def resolve_interval(date_from, date_to):
+    """ fills in the default interval (the latest loaded day) and clamps it to the loaded partitions
+
+    returns None if no loaded partition intersects the interval
+    """
+    if date_from is None:
+        date_from = catalog.default_day()
+    if date_to is None:
+        date_to = catalog.default_day()
+    return catalog.clamp(date_from, date_to)
+
+
+class LookupRerouted(Exception):
+    """ raised when an expensive lookup has been started as background job """
+    def __init__(self, job_id, estimate):
+        super(LookupRerouted, self).__init__(job_id)
+        self.job_id = job_id
+        self.estimate = estimate
+
+
+@app.exception_handler(LookupRerouted)
+async def lookup_rerouted_handler(request: Request, exc: LookupRerouted):
+    return JSONResponse(
+        status_code=202,
+        content=jsonable_encoder({
+            "job_id": exc.job_id,
+            "status_url": "/api/v1/jobs/%s" % exc.job_id,
+            "estimate": exc.estimate
+        })
+    )
+
+
+@app.exception_handler(DBUnavailable)
+async def db_unavailable_handler(request: Request, exc: DBUnavailable):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "%i" % max(1, int(round(exc.retry_after)))}
+    )
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "%i" % max(1, int(round(exc.retry_after + 0.5)))}
+    )
+
+
+@app.middleware("http")
+async def http_cache(request: Request, call_next):
+    """ ETag, Cache-Control and 304 Not Modified for the lookups (see httpcache.py)
+
+    runs inside identify_client, so revalidations are rate limited like any other request
+    """
+    if not http_cache_policy.applies(request) or catalog is None or not catalog.loaded:
+        return await call_next(request)
+    body = b""
+    if request.method == "POST":
+        body = await request.body()
+        body_sent = False
+
+        async def receive():
+            # the body has been read here, it is passed on once, then e.g. the disconnect
+            nonlocal body_sent
+            if body_sent:
+                return await original_receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        original_receive = request.receive
+        request = Request(request.scope, receive)
+    etag = http_cache_policy.get_etag(request, body, catalog.version)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": http_cache_policy.get_cache_control(
+            http_cache_policy.is_historical(request, catalog.latest_day)
+        )
+    }
+    if http_cache_policy.is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    state = {"cacheable": True}
+    token = response_state.set(state)
+    try:
+        response = await call_next(request)
+    finally:
+        response_state.reset(token)
+    if response.status_code == 200 and state["cacheable"]:
+        http_cache_policy.n_tagged += 1
+        response.headers.update(headers)
+    return response
+
+
+@app.middleware("http")
+async def identify_client(request: Request, call_next):
+    """ attributes the request (and the queries and background tasks it starts) to a client """
+    client_id = get_client_id(request, scheduler.api_keys, config["TRUST_FORWARDED_FOR"])
+    if request.url.path.startswith("/api/"):
+        try:
+            scheduler.check_rate(client_id)
+        except RateLimited as e:
+            return await rate_limited_handler(request, e)
+    token = current_client.set(client_id)
+    try:
+        if request.query_params.get("profile") == "true":
+            if not profiler.is_admin(client_id):
+                return JSONResponse(status_code=403, content={"detail": "profiling is not allowed"})
+            if profiler.active:
+                return JSONResponse(status_code=409, content={"detail": "another request is being profiled"})
+            response, body, report = await profiler.profile(request, call_next, drain_streamed=True)
+            return PlainTextResponse(
+                report,
+                headers={"Content-Disposition": "attachment; filename=profile_%i.txt" % time.time()}
+            )
+        if profiler.should_sample(request):
+            response, body, report = await profiler.profile(request, call_next)
+            if report is None:
+                return response
+            profiler.store(report)
+            return Response(body, status_code=response.status_code, headers=dict(response.headers))
+        return await call_next(request)
+    finally:
+        current_client.reset(token)
+
+
+async def execute_lookup(lookup_type, inputs, date_from, date_to, limit, options=None, track=True,
+                         explain=False, guard=True, connection=None):
+    """ runs a lookup through the result cache
+
+    the interval is resolved with resolve_interval, lookups for days that are
+    not loaded are answered with an empty result without querying the DB
+
+    with guard, lookups that are not cached are checked against the cost
+    thresholds, with explain only the estimate is returned
+
+    connection replaces the DB connection for the query (see StreamingConnection)
+    """
+    if options is None:
+        options = {}
+    requested_interval = [
+        catalog.default_day() if date_from is None else date_from,
+        catalog.default_day() if date_to is None else date_to
+    ]
+    interval = resolve_interval(date_from, date_to)
+    if interval is None:
+        return {
+            'queried_interval': requested_interval,
+            'rows': [],
+            'query_time': 0.0,
+            'fetch_time': 0.0,
+            'no_partitions': True
+        }
+    date_from, date_to = interval
+    key = make_key(lookup_type, inputs, date_from, date_to, limit, options)
+    if explain:
+        return {
+            'queried_interval': [date_from, date_to],
+            'estimate': cost_estimator.estimate(lookup_type, inputs, date_from, date_to, limit),
+            'cached': await result_cache.get_async(key) is not None,
+            'rows': []
+        }
+    if track:
+        hot_keys.record(lookup_type, inputs, date_from, date_to, limit, options, warmer.latest_day)
+    results = await result_cache.get_async(key)
+    forced_limit = None
+    if results is None and guard:
+        estimate = cost_estimator.estimate(lookup_type, inputs, date_from, date_to, limit)
+        cost_estimator.count(estimate["action"])
+        if estimate["action"] == "reject":
+            logger.warning("rejected %s lookup with estimated cost %i" % (lookup_type, estimate["cost"]))
+            raise HTTPException(
+                status_code=422,
+                detail={"message": "the lookup is too expensive, please narrow the interval or the inputs",
+                        "estimate": jsonable_encoder(estimate)}
+            )
+        if estimate["action"] == "background":
+            job_id = job_store.create(
+                lookup_type,
+                {"inputs": inputs, "date_from": date_from, "date_to": date_to, "limit": limit, "options": options},
+                "json"
+            )
+            task = asyncio.ensure_future(
+                run_lookup_job(job_id, lookup_type, inputs, date_from, date_to, limit, options)
+            )
+            background_tasks.append(task)
+            task.add_done_callback(background_tasks.remove)
+            raise LookupRerouted(job_id, estimate)
+        if estimate["action"] == "limit":
+            forced_limit = limit = cost_estimator.forced_limit
+            key = make_key(lookup_type, inputs, date_from, date_to, limit, options)
+            results = await result_cache.get_async(key)
+    if results is None:
+        results = await run_lookup(lookup_type, inputs, date_from, date_to, limit, options, connection)
+        if 'failed_slices' not in results and not results.get('spilled'):
+            await result_cache.put_async(key, results)
+    if 'failed_slices' in results:
+        mark_uncacheable()
+    if forced_limit is not None:
+        results['forced_limit'] = forced_limit
+    if list(interval) != requested_interval:
+        results['requested_interval'] = requested_interval
+    return results
+
+
+async def run_lookup(lookup_type, inputs, date_from, date_to, limit, options, connection=None):
+    kwargs = dict(options)
+    window = kwargs.pop("window", None)
+    if lookup_type in ("domains_by_ips", "ips_by_domains"):
+        kwargs["existence_filter"] = existence_filter
+    elif lookup_type == "records_summary":
+        kwargs["rollup"] = records_rollup
+    if window is not None:
+        return await run_sliced_lookup(lookup_type, inputs, date_from, date_to, limit, window, kwargs, connection)
+    return await LOOKUPS[lookup_type](
+        DBConnection if connection is None else connection,
+        logger,
+        inputs,
+        date_from,
+        date_to,
+        limit,
+        **kwargs
+    )
+
+
+async def run_sliced_lookup(lookup_type, inputs, date_from, date_to, limit, window, kwargs, connection=None):
+    """ runs the lookup in time slices of window (day, week or month) and merges their rows
+
+    slices without loaded partitions are skipped, limit applies to every slice and to the merged rows,
+    truncated is set if any of them reached it
+    """
+    on_event = None
+    progressive = False
+    if connection is not None:
+        # the progress of the slices replaces the events of their single queries
+        on_event = connection.publish
+        progressive = connection.progressive
+        connection = connection.DBConnection
+    slices = []
+    for slice_from, slice_to in get_slices(date_from, date_to, window):
+        interval = catalog.clamp(slice_from, slice_to)
+        if interval is not None:
+            slices.append(interval)
+
+    async def lookup(slice_from, slice_to):
+        try:
+            return await LOOKUPS[lookup_type](
+                DBConnection if connection is None else connection,
+                logger,
+                inputs,
+                slice_from,
+                slice_to,
+                limit,
+                **kwargs
+            )
+        except Exception as e:
+            logger.warning("slice %s - %s of %s lookup failed - %s" % (slice_from, slice_to, lookup_type, str(e)))
+            raise
+
+    results = await run_sliced(
+        lookup,
+        slices,
+        config["SLICE_MAX_CONCURRENCY"],
+        RowMerger(limit=limit, **MERGE_SPECS[lookup_type]),
+        on_event=on_event,
+        progressive=progressive
+    )
+    results.update({
+        'queried_domains': list(map(str, inputs)),
+        'queried_interval': [date_from, date_to]
+    })
+    return results
+
+
+async def run_lookup_job(job_id, lookup_type, inputs, date_from, date_to, limit, options):
+    job_store.update(job_id, status="running")
+    try:
+        results = await execute_lookup(
+            lookup_type, inputs, date_from, date_to, limit, options,
+            track=False, guard=False
+        )
+        results["data"] = results.pop("rows")
+        with open(job_store.get_result_filename(job_id), "w") as f:
+            json.dump(jsonable_encoder(results), f)
+    except Exception as e:
+        logger.error("lookup job %s failed - %s" % (job_id, str(e)))
+        job_store.update(job_id, status="failed", error=str(e))
+        return
+    job_store.update(job_id, status="done")
+
+
+async def store_snapshot(results):
+    """ replaces the rows of results by a snapshot for server-side processing """
+    mark_uncacheable()
+    results["result_id"] = await snapshot_store.create_async(results)
+    results["records_total"] = len(results["rows"])
+    del(results["rows"])
+    return results
 
 
 ###############################################################################
@@ -122,7 +550,7 @@ async def showDomain2IP(request: Request, queryType: str = "ips_by_domains"):
         columns = select_domains_by_ips_get_columns()
         inputTextLabel = "IPs"
         headline = "IPs --> Domains"
-        inputplaceholder = "1.2.3.4 \n2001:67c:10b8::98"
+        inputplaceholder = "1.2.3.4 \n2001:67c:10b8::98 \n192.0.2.0/24"
         inputfieldtype = "textarea"
     elif queryType == "ips_by_mx_pattern":
         columns = select_ips_by_mx_pattern_get_columns()
@@ -143,8 +571,8 @@ async def showDomain2IP(request: Request, queryType: str = "ips_by_domains"):
             "inputplaceholder": inputplaceholder,
             "inputfieldtype": inputfieldtype,
             "todayString": datetime.date.today(),
-            "startDate": datetime.date.today() - datetime.timedelta(days=1),
-            "endDate": datetime.date.today() - datetime.timedelta(days=1)
+            "startDate": catalog.default_day(),
+            "endDate": catalog.default_day()
         }
     )
 
@@ -162,6 +590,42 @@ async def meta_version():
     return {"version": "%s" % config['version']}
 
 
+@app.get("/meta/stats", tags=["Meta"])
+async def meta_stats():
+    return {
+        "db": DBConnection.stats(),
+        "scheduler": scheduler.stats(),
+        "profiler": profiler.stats(),
+        "http_cache": http_cache_policy.stats(),
+        "result_memory": result_memory.stats(),
+        "partitions": catalog.stats(),
+        "cost": cost_estimator.stats(),
+        "existence_filter": existence_filter.stats(),
+        "result_cache": await result_cache.stats_async(),
+        "warmer": warmer.stats(),
+        "rollup": records_rollup.stats(),
+        "sql_templates": sql_templates.stats()
+    }
+
+
+@app.get("/debug/profiles", tags=["Meta"])
+async def list_profiles():
+    """ Lists the stored reports of sampled requests (only for the clients of `PROFILE_CLIENTS`). """
+    if not profiler.is_admin(current_client.get()):
+        raise HTTPException(status_code=403, detail="profiling is not allowed")
+    return {"reports": profiler.list_reports()}
+
+
+@app.get("/debug/profiles/{name}", tags=["Meta"])
+async def get_profile(name: str):
+    if not profiler.is_admin(current_client.get()):
+        raise HTTPException(status_code=403, detail="profiling is not allowed")
+    try:
+        return FileResponse(profiler.get_report_filename(name), media_type="text/plain", filename=name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="unknown report")
+
+
 @app.get("/test/ping",
          name="Ping test",
          summary="Run a ping test, to check if the service is running",
@@ -199,18 +663,19 @@ async def selftest():
 )
 async def select_domains_by_ip(
     ip: IPvAnyAddress,
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    limit: int = 100
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    explain: Optional[bool] = False
 ):
     start = time.time()
-    results = await openintel_select_domains_by_ips(
-        DBConnection,
-        logger,
+    results = await execute_lookup(
+        "domains_by_ips",
         [ip, ],
         date_from,
         date_to,
-        limit
+        limit,
+        explain=explain
     )
     results["data"] = results["rows"]
     del(results["rows"])
@@ -222,26 +687,40 @@ async def select_domains_by_ip(
 @app.post(
     "/api/v1/domains_by_ips/",
     name="Find domains pointing to a list of IPs",
-    summary="Finds the domains that point to the posted IPs",
+    summary="Finds the domains that point to the posted IPs, CIDR prefixes (192.0.2.0/24) or IP ranges (192.0.2.1-192.0.2.9)",
     tags=["Find domains"]
 )
 async def select_domains_by_ips(
-    ips: List[IPvAnyAddress],
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    limit: int = 100
+    ips: List[str],
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    group_by_input: Optional[bool] = False,
+    explain: Optional[bool] = False,
+    snapshot: Optional[bool] = False
 ):
     start = time.time()
-    results = await openintel_select_domains_by_ips(
-        DBConnection,
-        logger,
+    for _ip in ips:
+        try:
+            parse_ip_input(_ip)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    results = await execute_lookup(
+        "domains_by_ips",
         ips,
         date_from,
         date_to,
-        limit
+        limit,
+        explain=explain
     )
-    results["data"] = results["rows"]
-    del(results["rows"])
+    if snapshot:
+        await store_snapshot(results)
+    elif group_by_input:
+        results["data"] = group_rows_by_input(results["rows"], ips)
+        del(results["rows"])
+    else:
+        results["data"] = results["rows"]
+        del(results["rows"])
     dt = time.time() - start
     logger.info("/api/v1/domains_by_ips/ completed lookup if %i domains in %f s" % (len(ips), dt))
     return results
@@ -270,18 +749,22 @@ def select_domains_by_ips_get_columns():
 )
 async def select_ips_by_domain(
     domain: str,
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    limit: int = 100
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    explain: Optional[bool] = False,
+    window: Optional[str] = Query(None, regex="^(day|week|month)$")
 ):
+    """ With `window` the interval is queried in slices of a day, week or month that run concurrently. """
     start = time.time()
-    results = await openintel_select_ips_by_domains(
-        DBConnection,
-        logger,
+    results = await execute_lookup(
+        "ips_by_domains",
         [domain, ],
         date_from,
         date_to,
-        limit
+        limit,
+        options={"window": window} if window is not None else None,
+        explain=explain
     )
     results["data"] = results["rows"]
     del(results["rows"])
@@ -298,26 +781,389 @@ async def select_ips_by_domain(
 )
 async def select_ips_by_domains(
     domains: List[str],
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    limit: int = 100
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    explain: Optional[bool] = False,
+    snapshot: Optional[bool] = False,
+    window: Optional[str] = Query(None, regex="^(day|week|month)$")
 ):
+    """ With `window` the interval is queried in slices of a day, week or month that run concurrently. """
     start = time.time()
-    results = await openintel_select_ips_by_domains(
-        DBConnection,
-        logger,
+    results = await execute_lookup(
+        "ips_by_domains",
         domains,
         date_from,
         date_to,
-        limit
+        limit,
+        options={"window": window} if window is not None else None,
+        explain=explain
     )
-    results["data"] = results["rows"]
-    del(results["rows"])
+    if snapshot:
+        await store_snapshot(results)
+    else:
+        results["data"] = results["rows"]
+        del(results["rows"])
     dt = time.time() - start
     logger.info("/api/v1/domains_by_ip/{ip} completed lookup of %i domains in %f s" % (len(domains), dt))
     return results
 
 
+async def run_bulk_ips_by_domains(domains, date_from, date_to, limit, chunk_size, max_concurrency,
+                                  forced_limit=None):
+    """ async generator yielding ("rows", rows) and ("progress", progress) events
+
+    the chunks are run through the result cache, the cost of the whole upload is
+    checked by the caller (see estimate_bulk), so the chunks are not guarded again
+    """
+    chunks = get_chunks(domains, chunk_size)
+    progress = {
+        "inputs_total": len(domains),
+        "inputs_done": 0,
+        "chunks_total": len(chunks),
+        "chunks_done": 0,
+        "rows": 0
+    }
+    if forced_limit is not None:
+        limit = progress["forced_limit"] = forced_limit
+
+    async def lookup(chunk):
+        return await execute_lookup(
+            "ips_by_domains", chunk, date_from, date_to, limit, track=False, guard=False
+        )
+
+    yield "progress", dict(progress)
+    async for i, results in run_chunked(lookup, chunks, max_concurrency):
+        progress["inputs_done"] += len(chunks[i])
+        progress["chunks_done"] += 1
+        progress["rows"] += len(results.get("rows", []))
+        yield "rows", results.get("rows", [])
+        yield "progress", dict(progress)
+
+
+def estimate_bulk(lookup_type, inputs, date_from, date_to, limit):
+    """ applies the cost thresholds to a whole upload, returns its estimate or None if nothing is read
+
+    raises 422 if the upload is too expensive
+    """
+    interval = resolve_interval(date_from, date_to)
+    if interval is None:
+        return None
+    estimate = cost_estimator.estimate(lookup_type, inputs, interval[0], interval[1], limit)
+    cost_estimator.count(estimate["action"])
+    if estimate["action"] == "reject":
+        logger.warning("rejected bulk %s lookup with estimated cost %i" % (lookup_type, estimate["cost"]))
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "the lookup is too expensive, please narrow the interval or the inputs",
+                    "estimate": jsonable_encoder(estimate)}
+        )
+    return estimate
+
+
+async def format_bulk_events(events, result_format, on_progress=None):
+    """ formats bulk events as NDJSON (rows and progress) or CSV (rows only) """
+    csv_writer = CSVChunkWriter()
+    async for event, value in events:
+        if event == "progress":
+            if on_progress is not None:
+                on_progress(value)
+            if result_format == "ndjson":
+                yield json.dumps({"progress": value}) + "\n"
+        elif result_format == "ndjson":
+            yield "".join(json.dumps(row) + "\n" for row in jsonable_encoder(value))
+        else:
+            yield csv_writer.write(value)
+
+
+async def run_bulk_job(job_id, events, result_format):
+    job_store.update(job_id, status="running")
+    try:
+        with open(job_store.get_result_filename(job_id), "w") as f:
+            async for text in format_bulk_events(
+                events,
+                result_format,
+                on_progress=lambda progress: job_store.update(job_id, progress=progress)
+            ):
+                f.write(text)
+    except Exception as e:
+        logger.error("bulk job %s failed - %s" % (job_id, str(e)))
+        job_store.update(job_id, status="failed", error=str(e))
+        return
+    job_store.update(job_id, status="done")
+
+
+@app.post(
+    "/api/v1/bulk/ips_by_domains/",
+    name="Find IPs listed under an uploaded list of domains",
+    summary="Finds the IPs that are pointed to by the domains of an uploaded text/CSV file (one domain per line).",
+    tags=["Find IPs"],
+    responses={
+        200: {
+            "description": "Results as NDJSON (rows and progress records) or CSV",
+            "content": {
+                "application/x-ndjson": {},
+                "text/csv": {}
+            },
+        },
+        202: {"description": "The lookup has been started as background job"}
+    }
+)
+async def bulk_select_ips_by_domains(
+    request: Request,
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 0,
+    chunk_size: int = Query(config["BULK_CHUNK_SIZE"], gt=0, le=config["BULK_MAX_CHUNK_SIZE"]),
+    concurrency: int = Query(config["BULK_MAX_CONCURRENCY"], gt=0, le=config["BULK_MAX_CONCURRENCY"]),
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    background: Optional[bool] = False
+):
+    """ The domains are posted either as multipart form field `file` or as plain request body.
+    Empty lines and lines starting with # are skipped, for CSV files the first column is used.
+    `limit` applies per chunk (0: no limit). Uploads that exceed the cost thresholds are rejected, run
+    as background job or with a lower limit, like single lookups. """
+    try:
+        domains = await read_inputs(
+            iter_request_body(request),
+            normalize_domain,
+            max_inputs=config["BULK_MAX_INPUTS"],
+            header="domain_name"
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    logger.info("/api/v1/bulk/ips_by_domains/ received %i distinct domains" % len(domains))
+    if date_from is None:
+        date_from = catalog.default_day()
+    if date_to is None:
+        date_to = catalog.default_day()
+
+    estimate = estimate_bulk("ips_by_domains", domains, date_from, date_to, limit)
+    forced_limit = None
+    if estimate is not None and estimate["action"] == "limit":
+        forced_limit = cost_estimator.forced_limit
+    events = run_bulk_ips_by_domains(
+        domains, date_from, date_to, limit, chunk_size, concurrency, forced_limit=forced_limit
+    )
+
+    if background or (estimate is not None and estimate["action"] == "background"):
+        job_id = job_store.create(
+            "ips_by_domains",
+            {"n_domains": len(domains), "date_from": date_from, "date_to": date_to, "limit": limit},
+            format
+        )
+        task = asyncio.ensure_future(run_bulk_job(job_id, events, format))
+        background_tasks.append(task)
+        task.add_done_callback(background_tasks.remove)
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder({
+                "job_id": job_id,
+                "status_url": "/api/v1/jobs/%s" % job_id,
+                "estimate": estimate
+            })
+        )
+
+    return StreamingResponse(
+        format_bulk_events(events, format),
+        media_type="application/x-ndjson" if format == "ndjson" else "text/csv"
+    )
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}",
+    name="Job status",
+    summary="Returns status and progress of a background job",
+    tags=["Jobs"]
+)
+async def get_job(job_id: str):
+    try:
+        return job_store.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="unknown job")
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}/result",
+    name="Job result",
+    summary="Returns the result of a finished background job",
+    tags=["Jobs"]
+)
+async def get_job_result(job_id: str):
+    try:
+        state = job_store.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="unknown job")
+    if state["status"] != "done":
+        raise HTTPException(status_code=409, detail="job is %s" % state["status"])
+    if state["result_format"] == "csv":
+        return FileResponse(
+            job_store.get_result_filename(job_id),
+            media_type="text/csv",
+            filename="openintel_job_%s.csv" % job_id
+        )
+    if state["result_format"] == "json":
+        return FileResponse(job_store.get_result_filename(job_id), media_type="application/json")
+    return FileResponse(job_store.get_result_filename(job_id), media_type="application/x-ndjson")
+
+
+@app.get(
+    "/api/v1/results/{result_id}/datatables",
+    name="Page of a result snapshot",
+    summary="Answers DataTables server-side processing requests (paging, sorting, searching) on a result snapshot",
+    tags=["Results"]
+)
+async def get_result_page(result_id: str, request: Request):
+    """ Snapshots are created by the lookup endpoints with `snapshot=true`. """
+    try:
+        return await snapshot_store.datatables_page_async(result_id, dict(request.query_params))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="unknown or expired result")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.get(
+    "/api/v1/results/{result_id}/csv",
+    name="Result snapshot as CSV",
+    summary="Returns all rows of a result snapshot as CSV file",
+    tags=["Results"],
+    response_class=StreamingResponse
+)
+async def get_result_csv(result_id: str):
+    try:
+        rows = await snapshot_store.get_rows_async(result_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="unknown or expired result")
+
+    response = StreamingResponse(iter_csv(rows), media_type="text/csv")
+    response.headers["Content-Disposition"] = "attachment; filename=openintel_result_%s.csv" % result_id
+    return response
+
+
+async def stream_lookup_events(request, lookup_type, inputs, date_from, date_to, limit, snapshot,
+                               window=None, progressive=False):
+    """ runs a lookup and yields its progress, rows and final state as Server-Sent Events
+
+    the lookup is cancelled when the client disconnects
+    """
+    queue = asyncio.Queue(QUEUE_SIZE)
+    # snapshots are paged, their rows are not sent
+    connection = StreamingConnection(DBConnection, queue, progressive=progressive, send_rows=not snapshot)
+    task = asyncio.ensure_future(
+        execute_lookup(
+            lookup_type, inputs, date_from, date_to, limit,
+            options={"window": window} if window is not None else None,
+            connection=connection
+        )
+    )
+    try:
+        while not (task.done() and queue.empty()):
+            try:
+                event, value = await asyncio.wait_for(queue.get(), 1.0)
+            except asyncio.TimeoutError:
+                event = None
+            if await request.is_disconnected():
+                logger.info("client abandoned %s lookup" % lookup_type)
+                return
+            if event is not None:
+                yield format_sse(event, value)
+        try:
+            results = task.result()
+        except LookupRerouted as e:
+            yield format_sse("job", {"job_id": e.job_id, "status_url": "/api/v1/jobs/%s" % e.job_id, "estimate": e.estimate})
+            return
+        except HTTPException as e:
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except DBUnavailable as e:
+            yield format_sse("error", {"status_code": 503, "detail": str(e), "retry_after": e.retry_after})
+            return
+        except Exception as e:
+            logger.error("streamed %s lookup failed - %s" % (lookup_type, str(e)))
+            yield format_sse("error", {"status_code": 500, "detail": "the lookup failed"})
+            return
+        rows = results["rows"]
+        if connection.n_rows == 0 and not snapshot:
+            # the result came from the cache
+            batch_size = int(config["FETCH_BATCH_SIZE"])
+            for i in range(0, len(rows), batch_size):
+                yield format_sse("rows", rows[i:i + batch_size])
+        if snapshot:
+            await store_snapshot(results)
+        else:
+            results["records_total"] = len(rows)
+            del(results["rows"])
+        yield format_sse("done", results)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+@app.post(
+    "/api/v1/stream/{lookup_type}/",
+    name="Lookup with live progress",
+    summary="Runs a lookup and streams its progress and the rows as Server-Sent Events",
+    tags=["Results"],
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": "Events 'progress', 'rows' (list of rows, with snapshot 'fetched' with the number of "
+                           "rows instead), 'merged' (time-sliced lookups), and finally "
+                           "'done' (the result without rows), "
+                           "'job' (the lookup runs as background job) or 'error'",
+            "content": {
+                "text/event-stream": {}
+            },
+        },
+    }
+)
+async def stream_lookup(
+    request: Request,
+    lookup_type: str,
+    inputs: List[str],
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    snapshot: Optional[bool] = False,
+    window: Optional[str] = Query(None, regex="^(day|week|month)$"),
+    progressive: Optional[bool] = False
+):
+    """ `lookup_type` is one of domains_by_ips, ips_by_domains or ips_by_mx_pattern (the first input is the pattern).
+    With `snapshot=true` the rows are not sent, 'fetched' events count them and the 'done' event contains the
+    `result_id` of a result snapshot to page through. Closing the connection
+    cancels the lookup. With `window` (ips_by_domains only) the interval is queried in slices of a day, week or
+    month, the 'progress' events count the completed slices and with `progressive=true` 'merged' events contain
+    the rows merged so far. """
+    if lookup_type not in ("domains_by_ips", "ips_by_domains", "ips_by_mx_pattern"):
+        raise HTTPException(status_code=404, detail="unknown lookup type")
+    if window is not None and lookup_type not in MERGE_SPECS:
+        raise HTTPException(status_code=422, detail="%s lookups cannot be sliced" % lookup_type)
+    if len(inputs) == 0:
+        raise HTTPException(status_code=422, detail="no inputs")
+    if lookup_type == "domains_by_ips":
+        for _ip in inputs:
+            try:
+                parse_ip_input(_ip)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+    return StreamingResponse(
+        stream_lookup_events(
+            request,
+            lookup_type,
+            inputs[0] if lookup_type == "ips_by_mx_pattern" else inputs,
+            date_from,
+            date_to,
+            limit,
+            snapshot,
+            window=window,
+            progressive=progressive
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 def select_ips_by_domains_get_columns():
     return [
         "domain_name",
@@ -339,21 +1185,26 @@ def select_ips_by_domains_get_columns():
 )
 async def select_ips_by_mx_pattern(
     pattern:  List[str],
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    limit: int = 100
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    explain: Optional[bool] = False,
+    snapshot: Optional[bool] = False
 ):
     start = time.time()
-    results = await openintel_select_ips_by_mx_records(
-        DBConnection,
-        logger,
+    results = await execute_lookup(
+        "ips_by_mx_pattern",
         pattern[0],
         date_from,
         date_to,
-        limit
+        limit,
+        explain=explain
     )
-    results["data"] = results["rows"]
-    del(results["rows"])
+    if snapshot:
+        await store_snapshot(results)
+    else:
+        results["data"] = results["rows"]
+        del(results["rows"])
     dt = time.time() - start
     logger.info("/api/v1/ips_by_mx_pattern/ completed in %f s" % dt)
     return results
@@ -371,6 +1222,289 @@ def select_ips_by_mx_pattern_get_columns():
     ]
 
 
+async def run_graph(domains, date_from, date_to, max_depth):
+    start = time.time()
+    domains = [normalize_domain(_name) for _name in domains]
+    interval = resolve_interval(date_from, date_to)
+    if interval is None:
+        return {
+            'queried_domains': domains,
+            'queried_interval': [date_from, date_to],
+            'nodes': [],
+            'edges': [],
+            'no_partitions': True
+        }
+    max_nodes = config["GRAPH_MAX_NODES"]
+
+    async def lookup(names):
+        estimate = cost_estimator.estimate("references", names, interval[0], interval[1], max_nodes)
+        if estimate["action"] in ("background", "reject"):
+            raise HTTPException(
+                status_code=422,
+                detail={"message": "the graph is too expensive, please narrow the interval or the depth",
+                        "estimate": jsonable_encoder(estimate)}
+            )
+        return await execute_lookup(
+            "references", sorted(names), interval[0], interval[1], max_nodes, track=False, guard=False
+        )
+
+    results = await resolve_graph(lookup, domains, max_depth, max_nodes)
+    results.update({
+        'queried_domains': domains,
+        'queried_interval': list(interval),
+        'query_time': time.time() - start
+    })
+    logger.info("resolution graph of %i domains with %i nodes completed in %f s" % (
+        len(domains), len(results["nodes"]), results["query_time"]))
+    return results
+
+
+@app.get(
+    "/api/v1/graph/{domain}",
+    name="Resolution graph of a domain",
+    summary="Follows the CNAME, DNAME, MX and NS references of domain {domain} down to the IP addresses.",
+    tags=["Find IPs"]
+)
+async def select_graph_by_domain(
+    domain: str,
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    max_depth: int = Query(config["GRAPH_MAX_DEPTH"], gt=0, le=config["GRAPH_MAX_DEPTH"])
+):
+    """ The graph is walked breadth-first, one query per depth level. Edges that may close a cycle are listed in
+    `cycles`, `truncated` is set if the depth or the `GRAPH_MAX_NODES` limit was reached. """
+    return await run_graph([domain, ], date_from, date_to, max_depth)
+
+
+@app.post(
+    "/api/v1/graph/",
+    name="Resolution graph of a list of domains",
+    summary="Follows the CNAME, DNAME, MX and NS references of a list of domains down to the IP addresses.",
+    tags=["Find IPs"]
+)
+async def select_graph_by_domains(
+    domains: List[str],
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    max_depth: int = Query(config["GRAPH_MAX_DEPTH"], gt=0, le=config["GRAPH_MAX_DEPTH"])
+):
+    """ See `/api/v1/graph/{domain}`, all domains share the graph. """
+    if len(domains) == 0:
+        raise HTTPException(status_code=422, detail="no domains")
+    return await run_graph(domains, date_from, date_to, max_depth)
+
+
+@app.post(
+    "/api/v1/changes/",
+    name="Changes between two days",
+    summary="Lists the IP addresses and CNAME, DNAME, MX and NS targets of a list of domains or of a zone "
+            "that were added or removed from one day to another.",
+    tags=["Changes"]
+)
+async def select_changes(
+    domains: List[str],
+    date_before: Optional[datetime.date] = None,
+    date_after: Optional[datetime.date] = None,
+    zone: Optional[str] = Query(None, regex="^[a-zA-Z0-9-]+(\\.[a-zA-Z0-9-]+)*\\.?$"),
+    limit: int = 0,
+    chunk_size: int = Query(config["BULK_CHUNK_SIZE"], gt=0, le=config["BULK_MAX_CHUNK_SIZE"]),
+    explain: Optional[bool] = False
+):
+    """ `date_after` defaults to the latest loaded day, `date_before` to the day before. With `zone` all domains
+    of the zone are compared and the posted list is ignored (post `[]`). Domains without changes are filtered out
+    on the cluster, a domain without data on one of the days has all its records added or removed.
+    `limit` applies per chunk of `chunk_size` domains (0: no limit). """
+    start = time.time()
+    if date_after is None:
+        date_after = catalog.default_day()
+    if date_before is None:
+        date_before = date_after - datetime.timedelta(days=1)
+    if date_before >= date_after:
+        raise HTTPException(status_code=422, detail="date_before must be before date_after")
+    if catalog.loaded:
+        for day in (date_before, date_after):
+            if len(catalog.get_days(day, day)) == 0:
+                raise HTTPException(status_code=422, detail="no data for %s" % day)
+    if zone is not None:
+        zone = zone.strip(".").lower()
+        chunks = [[]]
+        options = {"zone": zone}
+    else:
+        domains = list(dict.fromkeys(normalize_domain(_name) for _name in domains if len(_name.strip()) > 0))
+        if len(domains) == 0:
+            raise HTTPException(status_code=422, detail="no domains")
+        chunks = get_chunks(domains, chunk_size)
+        options = {}
+
+    estimate = cost_estimator.estimate("changes", domains if zone is None else [], date_before, date_after, limit)
+    if explain:
+        return {'queried_interval': [date_before, date_after], 'estimate': estimate, 'data': []}
+    if estimate["action"] in ("background", "reject"):
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "the comparison is too expensive, please compare fewer domains",
+                    "estimate": jsonable_encoder(estimate)}
+        )
+
+    async def lookup(chunk):
+        return await execute_lookup(
+            "changes", chunk, date_before, date_after, limit, options=options, guard=False
+        )
+
+    rows = []
+    async for i, results in run_chunked(lookup, chunks, config["BULK_MAX_CONCURRENCY"]):
+        rows.extend(results["rows"])
+    rows.sort(key=lambda row: row["domain_name"])
+    dt = time.time() - start
+    logger.info("/api/v1/changes/ compared %s in %f s" % (
+        "zone %s" % zone if zone is not None else "%i domains" % len(domains), dt))
+    return {
+        'queried_interval': [date_before, date_after],
+        'queried_zone': zone,
+        'queried_domains': len(domains) if zone is None else None,
+        'changed_domains': len(set(row["domain_name"] for row in rows)),
+        'query_time': dt,
+        'data': rows
+    }
+
+
+class BatchLookup(BaseModel):
+    type: str
+    inputs: List[str]
+    date_from: Optional[datetime.date] = None
+    date_to: Optional[datetime.date] = None
+    limit: int = 100
+
+
+BATCH_LOOKUP_TYPES = ("ips_by_domains", "domains_by_ips", "ips_by_mx_pattern")
+
+
+def get_batch_inputs(lookup):
+    """ returns the inputs of a lookup of a batch as execute_lookup takes them, raises ValueError """
+    if lookup.type not in BATCH_LOOKUP_TYPES:
+        raise ValueError("unknown lookup type '%s'" % lookup.type)
+    if len(lookup.inputs) == 0:
+        raise ValueError("no inputs")
+    if lookup.type == "domains_by_ips":
+        for _ip in lookup.inputs:
+            parse_ip_input(_ip)
+    elif lookup.type == "ips_by_mx_pattern":
+        if len(lookup.inputs) != 1:
+            raise ValueError("ips_by_mx_pattern takes a single pattern")
+        return lookup.inputs[0]
+    return lookup.inputs
+
+
+async def run_batch_lookup(lookup, inputs):
+    """ returns the results of a lookup of a batch, errors are returned with their status instead of raised """
+    try:
+        results = await execute_lookup(lookup.type, inputs, lookup.date_from, lookup.date_to, lookup.limit)
+    except LookupRerouted as e:
+        mark_uncacheable()
+        return {
+            "status": 202,
+            "job_id": e.job_id,
+            "status_url": "/api/v1/jobs/%s" % e.job_id,
+            "estimate": e.estimate
+        }
+    except HTTPException as e:
+        mark_uncacheable()
+        return {"status": e.status_code, "detail": e.detail}
+    except DBUnavailable as e:
+        mark_uncacheable()
+        return {"status": 503, "detail": str(e)}
+    except Exception as e:
+        # the other lookups of the batch are still answered
+        mark_uncacheable()
+        logger.error("%s lookup of a batch failed - %s" % (lookup.type, str(e)))
+        return {"status": 500, "detail": "the lookup failed"}
+    results["data"] = results["rows"]
+    del(results["rows"])
+    results["status"] = 200
+    return results
+
+
+@app.post(
+    "/api/v1/batch",
+    name="Batch of lookups",
+    summary="Runs a list of ips_by_domains, domains_by_ips and ips_by_mx_pattern lookups concurrently.",
+    tags=["Batch"],
+    responses={
+        200: {
+            "description": "All results or, with stream, one NDJSON record per result as it finishes",
+            "content": {
+                "application/json": {},
+                "application/x-ndjson": {}
+            },
+        }
+    }
+)
+async def select_batch(
+    lookups: List[BatchLookup],
+    stream: Optional[bool] = False,
+    concurrency: int = Query(config["BATCH_MAX_CONCURRENCY"], gt=0, le=config["BATCH_MAX_CONCURRENCY"])
+):
+    """ Each lookup has a `type`, the `inputs` (a single pattern for ips_by_mx_pattern) and optionally `date_from`,
+    `date_to` and `limit`. Identical lookups are run once and at most `concurrency` at the same time. The results
+    are returned in the order of the lookups, with `stream` as NDJSON records with the `indexes` of the lookups
+    in the order of completion. A lookup that fails or is started as background job has the `status` of the
+    corresponding response instead of the data. """
+    start = time.time()
+    if len(lookups) == 0:
+        raise HTTPException(status_code=422, detail="no lookups")
+    if len(lookups) > config["BATCH_MAX_LOOKUPS"]:
+        raise HTTPException(
+            status_code=422,
+            detail="too many lookups, at most %i per batch" % config["BATCH_MAX_LOOKUPS"]
+        )
+    unique = []  # (key, lookup, inputs)
+    indexes = {}  # key -> indexes of the identical lookups
+    for i, lookup in enumerate(lookups):
+        try:
+            inputs = get_batch_inputs(lookup)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail="lookup %i: %s" % (i, str(e)))
+        key = make_key(
+            lookup.type,
+            inputs,
+            catalog.default_day() if lookup.date_from is None else lookup.date_from,
+            catalog.default_day() if lookup.date_to is None else lookup.date_to,
+            lookup.limit
+        )
+        if key not in indexes:
+            indexes[key] = []
+            unique.append((key, lookup, inputs))
+        indexes[key].append(i)
+
+    async def lookup_unique(item):
+        key, lookup, inputs = item
+        return await run_batch_lookup(lookup, inputs)
+
+    if stream:
+        # the headers are sent before the results are known
+        mark_uncacheable()
+
+        async def stream_results():
+            async for j, results in run_chunked(lookup_unique, unique, concurrency):
+                yield json.dumps(jsonable_encoder({"indexes": indexes[unique[j][0]], "result": results})) + "\n"
+            logger.info("/api/v1/batch completed %i lookups in %f s" % (len(unique), time.time() - start))
+
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+    data = [None] * len(lookups)
+    async for j, results in run_chunked(lookup_unique, unique, concurrency):
+        for i in indexes[unique[j][0]]:
+            data[i] = results
+    dt = time.time() - start
+    logger.info("/api/v1/batch completed %i lookups in %f s" % (len(unique), dt))
+    return {
+        'lookups': len(lookups),
+        'unique_lookups': len(unique),
+        'query_time': dt,
+        'data': data
+    }
+
+
 @app.get(
     "/api/v1/measurements_by_domain/{domain}",
     name="Find all measurements per domain",
@@ -381,28 +1515,62 @@ async def select_measurements_by_domain(
     domain: str,
     ip: Optional[IPvAnyAddress] = None,
     type: Optional[str] = None,
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
     limit: int = 100,
-    full: Optional[bool] = False
+    full: Optional[bool] = False,
+    collapse: Optional[bool] = False,
+    explain: Optional[bool] = False
 ):
-    start = time.time()
-    results = await openintel_select_measurements_by_name_and_ip_or_type(
-        DBConnection,
-        logger,
-        domain,
-        date_from,
-        date_to,
-        limit,
-        ip=ip,
-        type=type,
-        full=full
+    """ With `collapse` consecutive days with the same observation are merged into one row with `first_seen`,
+    `last_seen` and the `count` of measurements, `limit` applies to these rows then. """
+    results, cleanup = await lookup_measurements(
+        domain, ip, type, date_from, date_to, limit, full, collapse, explain
     )
+    return StreamingResponse(
+        iter_json(results),
+        media_type="application/json",
+        background=BackgroundTask(cleanup)
+    )
+
+
+async def lookup_measurements(domain, ip, type, date_from, date_to, limit, full, collapse=False, explain=False):
+    """ returns the results and a function that releases their memory once the response has been sent
+
+    large results are spilled to disk (see spill.py), the data of the results are SpilledRows then
+    """
+    if full and collapse:
+        raise HTTPException(status_code=422, detail="collapse is not supported with full")
+    options = {"ip": ip, "type": type, "full": full}
+    if collapse:
+        options["collapse"] = True
+    start = time.time()
+    connection = SpillingConnection(DBConnection, result_memory)
+    try:
+        results = await execute_lookup(
+            "measurements_by_domain",
+            domain,
+            date_from,
+            date_to,
+            limit,
+            options,
+            explain=explain,
+            connection=connection
+        )
+    except BaseException:
+        connection.release()
+        raise
     results["data"] = results["rows"]
     del(results["rows"])
     dt = time.time() - start
     logger.info("/api/v1/measurements_by_domain_ip/{domain} completed in %f s" % dt)
-    return results
+
+    def cleanup():
+        connection.release()
+        if isinstance(results["data"], SpilledRows):
+            results["data"].close()
+
+    return results, cleanup
 
 
 @app.get(
@@ -424,42 +1592,29 @@ async def select_measurements_by_domain_csv(
     domain: str,
     ip: Optional[IPvAnyAddress] = None,
     type: Optional[str] = None,
-    date_from: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
-    date_to: Optional[datetime.date] = datetime.date.today() - datetime.timedelta(days=1),
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
     limit: int = 100,
-    full: Optional[bool] = False
+    full: Optional[bool] = False,
+    collapse: Optional[bool] = False
 ):
+    """ See `/api/v1/measurements_by_domain/{domain}` for `collapse`. """
     logger.debug(domain)
-    results = await select_measurements_by_domain(
+    results, cleanup = await lookup_measurements(
         domain,
         ip,
         type,
         date_from,
         date_to,
         limit,
-        full
-    )
-
-    stream = io.StringIO()
-
-    csv_writer = csv.writer(
-        stream,
-        delimiter=';',
-        quotechar='"'
+        full,
+        collapse
     )
 
-    for i, line in enumerate(results["data"]):
-        if i == 0:
-            fields = line.keys()
-            csv_writer.writerow(fields)
-        values = [line[key] for key in fields]
-        csv_writer.writerow(values)
-
-    stream.seek(0)
-
     response = StreamingResponse(
-        stream,
-        media_type="text/csv"
+        iter_csv(results["data"]),
+        media_type="text/csv",
+        background=BackgroundTask(cleanup)
     )
 
     csv_filename = "openintel_msm_history_%s" % domain
@@ -470,11 +1625,49 @@ async def select_measurements_by_domain_csv(
     if type is not None:
         csv_filename += "_type_%s" % (type)
 
-    csv_filename += "_%s_%s" % (date_from.strftime("%Y-%m-%d"), date_from.strftime("%Y-%m-%d"))
+    if collapse:
+        csv_filename += "_collapsed"
+
+    csv_filename += "_%s_%s" % (
+        results["queried_interval"][0].strftime("%Y-%m-%d"),
+        results["queried_interval"][1].strftime("%Y-%m-%d")
+    )
     csv_filename += ".csv"
 
     response.headers["Content-Disposition"] = "attachment; filename=%s" % csv_filename
 
-    print(csv_filename)
-
     return response
+
+
+@app.get(
+    "/api/v1/records_summary/{domain}",
+    name="Summary of the records of a domain",
+    summary="Lists the distinct records of domain {domain} over a timeframe with the first and last time they were "
+            "seen, optionally filtered by IP or record_type",
+    tags=["Measurement Histories"]
+)
+async def select_records_summary(
+    domain: str,
+    ip: Optional[IPvAnyAddress] = None,
+    type: Optional[str] = None,
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    limit: int = 100,
+    explain: Optional[bool] = False
+):
+    """ Days that are rolled up (`ROLLUP`) are read from the daily rollups, `rolled_up_interval` lists them. """
+    start = time.time()
+    results = await execute_lookup(
+        "records_summary",
+        domain,
+        date_from,
+        date_to,
+        limit,
+        {"ip": ip, "type": type},
+        explain=explain
+    )
+    results["data"] = results["rows"]
+    del(results["rows"])
+    dt = time.time() - start
+    logger.info("/api/v1/records_summary/{domain} completed in %f s" % dt)
+    return results
@@ -2,84 +2,35 @@ import time
 import ipaddress
 import datetime
 from config import config
-from collections import defaultdict
-
-next_level = defaultdict(lambda: None)
-next_level['year'] = 'month'
-next_level['month'] = 'day'
-
-
-def get_field():
-    return "CAST(%(prefix)s.%(field)s AS integer)"
-
-
-def get_value(prefix):
-    return "%%%%(%s_%%(field)s)s" % prefix
-
-
-def _get_date_where_sub_clauses(prefix, field, from_, to, range_='full', level=0):
-    if to < from_:
-        return "FALSE"
-    spec = {
-        "prefix": prefix,
-        "field": field
-    }
-    nl = next_level[field]
-    if range_ == 'full' and (getattr(to, field) - getattr(from_, field) <= 0):
-        # if the value of the field is the same we can bypass the more complicated logic below
-        where_clause = "(%s = %s)" % (get_field(), get_value("from"))
-        if nl is not None:
-            where_clause += " AND %s" % _get_date_where_sub_clauses(prefix, nl, from_, to, 'full', level=level+1)
-    else:
-        # put together the statement for this line
-        # three cases:
-        #   first period - need to include where clause of next level
-        #   periods in between - take all entries
-        #   last period - need to include where clause of next level
-        # if the range_ is open to one side, only include the side opposite to the open side and skip the other one
-
-        _cases = []
-
-        # Left/Right end period - here we have to consider the levels below, i.e. if this is month
-        # then a condition on the days must be included
-        if range_ == 'open-right' or range_ == 'full':
-            _clauses = ["(%s = %s)" % (get_field(), get_value("from")), ]
-            if nl is not None:
-                _clauses.append(_get_date_where_sub_clauses(prefix, nl, from_, to, 'open-right', level=level+1))
-            _cases.append(" AND ".join(_clauses))
-
-        if range_ == 'open-left' or range_ == 'full':
-            _clauses = ["(%s = %s)" % (get_field(), get_value("to")), ]
-            if nl is not None:
-                _clauses.append(_get_date_where_sub_clauses(prefix, nl, from_, to, 'open-left', level=level+1))
-            _cases.append(" AND ".join(_clauses))
-
-        # in-between periods - in these periods we take the whole periods so no additional conditions
-        # are required
-        if range_ == 'open-right':
-            _cases.append("(%s > %s)" % (get_field(), get_value("from")))
-        elif range_ == 'open-left':
-            _cases.append("(%s < %s)" % (get_field(), get_value("to")))
-        elif range_ == 'full':
-            _cases.append("((%s > %s) AND (%s < %s))" % (get_field(), get_value("from"), get_field(), get_value("to")))
-        else:
-            raise ValueError("unknown range_ '%s'" % range_)
+from sql_templates import templates, pad_values, get_placeholders, get_params
+
+
+def _get_date_bound_clause(prefix, name, op):
+    """ compares (year, month, day) of the partition lexicographically with the day of the parameters of name """
+    year, month, day = ("CAST(%s.%s AS integer)" % (prefix, field) for field in ("year", "month", "day"))
+    value = "%%%%(%s_%%s)s" % name
+    return "(%s %s %s) OR ((%s = %s) AND ((%s %s %s) OR ((%s = %s) AND (%s %s= %s))))" % (
+        year, op, value % "year",
+        year, value % "year",
+        month, op, value % "month",
+        month, value % "month",
+        day, op, value % "day"
+    )
 
-        # A date of interest can be in either of the above cases so we join them with OR
-        where_clause = ' OR '.join(map(lambda s: "(%s)" % s, _cases))
 
-    if level == 0:
-        return where_clause % spec
-    else:
-        return "(%s)" % ((where_clause % spec).replace('%', '%%'))
+def get_date_where_clause(prefix, from_, to, names=("from", "to")):
+    """ names are the parameters of the interval, see get_spec_for_clause
 
-
-def get_date_where_clause(prefix, from_, to):
+    The clause has the same form for all intervals, so the text of a query does not depend on them.
+    """
     if not isinstance(from_, datetime.date):
         raise ValueError("from_ must be a datetime.date")
     if not isinstance(to, datetime.date):
         raise ValueError("to must be a datetime.date")
-    return _get_date_where_sub_clauses(prefix, "year", from_, to)
+    return "(%s) AND (%s)" % (
+        _get_date_bound_clause(prefix, names[0], ">"),
+        _get_date_bound_clause(prefix, names[1], "<")
+    )
 
 
 def get_spec_for_clause(spec):
@@ -93,120 +44,337 @@ def get_spec_for_clause(spec):
     return _res
 
 
+class LazyJoin(object):
+    """ joins the values for a log message only if the message is emitted """
+    def __init__(self, values, separator=', '):
+        self.values = values
+        self.separator = separator
+
+    def __str__(self):
+        return self.separator.join(map(str, self.values))
+
+
+class LazyFormat(object):
+    """ formats a query with its parameters only if the log message is emitted """
+    def __init__(self, query, params):
+        self.query = query
+        self.params = params
+
+    def __str__(self):
+        return self.query % self.params
+
+
+def parse_ip_input(value):
+    """ parses an IP address, a CIDR prefix (1.2.3.0/24) or a range (1.2.3.4-1.2.3.10)
+
+    returns a list of networks covering the input, raises ValueError for invalid input
+    """
+    if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        return [ipaddress.ip_network(value)]
+    value = str(value).strip()
+    message = "'%s' is neither an IP address, a CIDR prefix nor an IP range" % value
+    if '-' in value:
+        try:
+            first, last = [ipaddress.ip_address(_ip.strip()) for _ip in value.split('-', 1)]
+        except ValueError:
+            raise ValueError(message)
+        if first.version != last.version:
+            raise ValueError("'%s' mixes IPv4 and IPv6 addresses" % value)
+        if last < first:
+            raise ValueError("'%s' is an empty range" % value)
+        return list(ipaddress.summarize_address_range(first, last))
+    try:
+        return [ipaddress.ip_network(value, strict=False)]
+    except ValueError:
+        raise ValueError(message)
+
+
+def get_ipv4_ranges(networks):
+    """ merges IPv4 networks into a minimal list of (first, last) integer ranges """
+    ranges = []
+    for network in ipaddress.collapse_addresses(networks):
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        if len(ranges) > 0 and ranges[-1][1] + 1 >= first:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+def get_ipv6_like_pattern(network):
+    """ returns (pattern, exact) for matching the compressed text form of the addresses of network
+
+    Only leading non-zero 16 bit groups are used, as zero groups may be elided by the
+    compression. exact is False if the pattern also matches addresses outside of network.
+    """
+    groups = network.network_address.exploded.split(':')
+    n_full_groups = network.prefixlen // 16
+    leading = []
+    for group in groups[:n_full_groups]:
+        if int(group, 16) == 0:
+            break
+        leading.append('%x' % int(group, 16))
+    if len(leading) == 0:
+        return None, False
+    exact = (len(leading) == n_full_groups) and (network.prefixlen % 16 == 0)
+    return ':'.join(leading) + ':%', exact
+
+
+IPV6_GROUP_REGEXP = "[0-9a-f]{1,4}"
+
+
+def _get_ipv6_group_regexp(value, n_bits):
+    """ matches the text form of the 16 bit groups that share the n_bits leading bits of value """
+    digits = "%04x" % value
+    n_fixed, n_partial = divmod(n_bits, 4)
+    if n_partial > 0:
+        first = int(digits[n_fixed], 16)
+        heads = [digits[:n_fixed] + "%x" % v for v in range(first, first + 2 ** (4 - n_partial))]
+        n_free = 3 - n_fixed
+    else:
+        heads = [digits[:n_fixed]]
+        n_free = 4 - n_fixed
+    alternatives = []
+    for head in heads:
+        # leading zeros are not written
+        head = head.lstrip("0")
+        if len(head) > 0:
+            alternatives.append(head + ("[0-9a-f]{%i}" % n_free if n_free > 0 else ""))
+        elif n_free > 0:
+            alternatives.append("[0-9a-f]{1,%i}" % n_free)
+        else:
+            alternatives.append("0")
+    return "(%s)" % "|".join(alternatives)
+
+
+def get_ipv6_regexp(network):
+    """ returns a regexp that matches exactly the text forms of the addresses of network, None for ::/0
+
+    The text form may elide any run of zero groups with '::', so there is one alternative for every
+    position of the elided run that is compatible with the prefix. After the run, the number of groups
+    is fixed, which tells the groups of the prefix from the others.
+    """
+    n_groups = (network.prefixlen + 15) // 16
+    if n_groups == 0:
+        return None
+    values = [int(group, 16) for group in network.network_address.exploded.split(':')]
+    groups = [_get_ipv6_group_regexp(values[k], min(16, network.prefixlen - 16 * k)) for k in range(n_groups)]
+    # the network address has zeros in the free bits, so a group can be zero if its value is
+    can_be_zero = [values[k] == 0 for k in range(n_groups)]
+    n_free_groups = 8 - n_groups
+
+    # no elided run within the groups of the prefix
+    alternatives = [":".join(groups) + "(:|$)"]
+    # a run starting at group n_before (all groups before it are written)
+    for n_before in range(n_groups):
+        head = ":".join(groups[:n_before]) + "::"
+        # the run covers the rest of the prefix, at most n_free_groups groups follow
+        if all(can_be_zero[n_before:]):
+            if n_free_groups > 0:
+                alternatives.append(head + "(%s(:%s){0,%i})?$" % (
+                    IPV6_GROUP_REGEXP, IPV6_GROUP_REGEXP, n_free_groups - 1))
+            else:
+                alternatives.append(head + "$")
+        # the run ends within the prefix, n_after groups follow it
+        for n_after in range(n_free_groups + 1, 8 - n_before):
+            first_after = 8 - n_after
+            if not all(can_be_zero[n_before:first_after]):
+                continue
+            alternatives.append(head + ":".join(groups[first_after:]) + "(:%s)" % IPV6_GROUP_REGEXP * n_free_groups + "$")
+    return "^(%s)" % "|".join(alternatives)
+
+
+def get_ipv4_numeric_field(prefix):
+    return " + ".join(
+        "CAST(split_part(%s.ip4_address, '.', %i) AS BIGINT) * %i" % (prefix, i + 1, 256 ** (3 - i))
+        for i in range(4)
+    )
+
+
+def group_rows_by_input(rows, inputs):
+    """ returns {input: [rows]} for the inputs (strings) of a domains by IPs lookup """
+    networks = [(_input, parse_ip_input(_input)) for _input in inputs]
+    groups = {_input: [] for _input in inputs}
+    for row in rows:
+        if row.get("ip_address") is None:
+            continue
+        ip_address = ipaddress.ip_address(row["ip_address"])
+        for _input, _networks in networks:
+            if any(ip_address in network for network in _networks):
+                groups[_input].append(row)
+    return groups
+
+
 async def openintel_select_domains_by_ips(
     DBConnection,
     logger,
     ip_list,
     date_from,
     date_to,
-    limit
+    limit,
+    existence_filter=None
 ):
-    ip4_list = []
-    ip6_list = []
+    ip4_networks = []
+    ip6_networks = []
     for _ip in ip_list:
-        try:
-            ip_address = ipaddress.ip_address(_ip)
-        except ValueError:
-            raise ValueError("'%s' is not an IP address" % _ip)
-        if ip_address.version == 4:
-            ip4_list.append(ip_address.compressed)
-        elif ip_address.version == 6:
-            ip6_list.append(ip_address.compressed)
-        else:
-            raise RuntimeError("unexpected error: ip_address version != 4 or 6 found")
+        for network in parse_ip_input(_ip):
+            if network.version == 4:
+                ip4_networks.append(network)
+            elif network.version == 6:
+                ip6_networks.append(network)
+            else:
+                raise RuntimeError("unexpected error: ip_address version != 4 or 6 found")
+
+    # single addresses are looked up with IN lists, prefixes and ranges with range predicates
+    ip4_networks = list(ipaddress.collapse_addresses(ip4_networks))
+    ip6_networks = list(ipaddress.collapse_addresses(ip6_networks))
+    ip4_list = [n.network_address.compressed for n in ip4_networks if n.num_addresses == 1]
+    ip6_list = [n.network_address.compressed for n in ip6_networks if n.num_addresses == 1]
+    ip4_ranges = get_ipv4_ranges([n for n in ip4_networks if n.num_addresses > 1])
+    ip6_prefixes = [n for n in ip6_networks if n.num_addresses > 1]
+
     if len(ip4_list) > 0:
-        logger.debug("fetching domains for IPv4 addresses: %s" % ', '.join(map(str, ip4_list)))
+        logger.debug("fetching domains for IPv4 addresses: %s", LazyJoin(ip4_list))
     if len(ip6_list) > 0:
-        logger.debug("fetching domains for IPv6 addresses: %s" % ', '.join(map(str, ip6_list)))
+        logger.debug("fetching domains for IPv6 addresses: %s", LazyJoin(ip6_list))
 
     result_dict = {
         'queried_ipv4': ip4_list,
         'queried_ipv6': ip6_list,
         'queried_interval': [date_from, date_to]
     }
+    if len(ip4_ranges) > 0 or len(ip6_prefixes) > 0:
+        result_dict['queried_prefixes'] = [
+            "%s-%s" % (ipaddress.IPv4Address(first), ipaddress.IPv4Address(last))
+            for first, last in ip4_ranges
+        ] + [n.compressed for n in ip6_prefixes]
 
-    if len(ip4_list) == 0 and len(ip6_list) == 0:
+    if len(ip4_list) == 0 and len(ip6_list) == 0 and len(ip4_ranges) == 0 and len(ip6_prefixes) == 0:
         logger.debug("empty IP list - skipping DB call")
         result_dict['names'] = []
         return result_dict
 
-    ip_where_clause = []
-    if len(ip4_list) > 0:
-        _clause = "(l2.ip4_address IN (%s))" % ','.join(
-            ["%%(__o%i)s" % i for i in range(len(ip4_list))]
-        )
-        ip_where_clause.append(_clause)
-
-    if len(ip6_list) > 0:
-        _clause = "(l2.ip6_address IN (%s))" % ','.join(
-            ["%%(__n%i)s" % i for i in range(len(ip6_list))]
-        )
-        ip_where_clause.append(_clause)
-
-    ip_where_clause = ' OR '.join(ip_where_clause)
-
-    params = {
-        'from': date_from,
-        'to': date_to
+    if existence_filter is not None:
+        ip4_list, absent_ip4 = existence_filter.split_absent('ip4_address', ip4_list, date_from, date_to)
+        ip6_list, absent_ip6 = existence_filter.split_absent('ip6_address', ip6_list, date_from, date_to)
+        result_dict['absent_ips'] = absent_ip4 + absent_ip6
+        if len(ip4_list) == 0 and len(ip6_list) == 0 and len(ip4_ranges) == 0 and len(ip6_prefixes) == 0:
+            logger.debug("no queried IP is present in the requested interval - skipping DB call")
+            existence_filter.n_skipped_queries += 1
+            result_dict.update({'rows': [], 'query_time': 0.0, 'fetch_time': 0.0})
+            return result_dict
+
+    # IPv6 prefixes are matched on the text form, with LIKE where the pattern is exact, else with a regexp
+    ip6_patterns = []
+    ip6_regexps = []
+    ip6_any = False
+    for network in ip6_prefixes:
+        pattern, exact = get_ipv6_like_pattern(network)
+        if exact:
+            ip6_patterns.append(pattern)
+            continue
+        regexp = get_ipv6_regexp(network)
+        if regexp is None:
+            ip6_any = True
+        else:
+            ip6_regexps.append(regexp)
+
+    # IN and OR lists are padded to powers of two, the text of the query only depends on their lengths
+    padded = {
+        '__o': pad_values(ip4_list) if len(ip4_list) > 0 else [],
+        '__n': pad_values(ip6_list) if len(ip6_list) > 0 else [],
+        '__r': pad_values(ip4_ranges) if len(ip4_ranges) > 0 else [],
+        '__p': pad_values(ip6_patterns) if len(ip6_patterns) > 0 else [],
+        '__x': pad_values(ip6_regexps) if len(ip6_regexps) > 0 else []
     }
 
-    date_where_clause = get_date_where_clause("l1", params["from"], params["to"])
-    params = get_spec_for_clause(params)
+    def build():
+        ip_where_clause = []
+        if len(padded['__o']) > 0:
+            ip_where_clause.append("(l2.ip4_address IN (%s))" % get_placeholders('__o', len(padded['__o'])))
 
-    query = """
-        SELECT
-            IF(nonnullvalue(l2.ip4_address), l2.ip4_address, l2.ip6_address) AS ip_address,
-            l2.asn,
-            SUBSTR(l1.query_name, 1, LENGTH(l1.query_name) - 1) AS pointing_query_name,
-            SUBSTR(l1.response_name, 1, LENGTH(l1.response_name) - 1) AS pointing_response_name,
-            SUBSTR(l2.query_name, 1, LENGTH(l2.query_name) - 1) AS query_name,
-            SUBSTR(l2.response_name, 1, LENGTH(l2.response_name) - 1) AS response_name,
-            l1.query_type AS pointing_record_type,
-            l1.field AS pointing_record_field,
-            to_timestamp(CAST(MIN(l2.time)/1000 AS BIGINT)) AS first_ts,
-            to_timestamp(CAST(MAX(l2.time)/1000 AS BIGINT)) AS last_ts
-        FROM %(db)s AS l2
-        JOIN (
-                      SELECT query_type, query_name, response_name, query_name AS ref_query_name, year, day, month, time, 'query_name' AS field FROM %(db)s WHERE (ip4_address IS NOT NULL) OR (ip6_address IS NOT NULL)
-            UNION ALL SELECT query_type, query_name, response_name, mx_address AS ref_query_name, year, day, month, time, 'mx_address' AS field FROM %(db)s WHERE mx_address IS NOT NULL
-            UNION ALL SELECT query_type, query_name, response_name, ns_address AS ref_query_name, year, day, month, time, 'ns_address' AS field FROM %(db)s WHERE ns_address IS NOT NULL
-            UNION ALL SELECT query_type, query_name, response_name, cname_name AS ref_query_name, year, day, month, time, 'cname_name' AS field FROM %(db)s WHERE cname_name IS NOT NULL
-            UNION ALL SELECT query_type, query_name, response_name, dname_name AS ref_query_name, year, day, month, time, 'dname_name' AS field FROM %(db)s WHERE dname_name IS NOT NULL
-            UNION ALL SELECT query_type, query_name, response_name, soa_mname  AS ref_query_name, year, day, month, time, 'soa_mname'  AS field FROM %(db)s WHERE soa_mname  IS NOT NULL
-        ) AS l1 ON (l2.query_name = l1.ref_query_name)
-        WHERE
-            (
-                %(ip_where_clause)s
-            )
-            AND
-            (
-                %(date_where_clause)s
-            )
-            AND
-            (
-                l2.year = l1.year
-                AND l2.month = l1.month
-                AND l2.day = l1.day
+        if len(padded['__n']) > 0:
+            ip_where_clause.append("(l2.ip6_address IN (%s))" % get_placeholders('__n', len(padded['__n'])))
+
+        if len(padded['__r']) > 0:
+            ip4_numeric = get_ipv4_numeric_field("l2")
+            _clause = "((l2.ip4_address IS NOT NULL) AND (%s))" % ' OR '.join(
+                ["((%s) BETWEEN %%(__r%i_first)s AND %%(__r%i_last)s)" % (ip4_numeric, i, i)
+                 for i in range(len(padded['__r']))]
             )
-        GROUP BY l2.ip4_address, l2.ip6_address, l2.query_name, l2.response_name, l2.asn, l1.query_type, l1.query_name, l1.response_name, l1.field
-        ORDER BY first_ts
-    """ % {
-        'db': config["DB"],
-        'ip_where_clause': ip_where_clause,
-        'date_where_clause': date_where_clause
-    }
+            ip_where_clause.append(_clause)
 
-    params.update({
-        '__o%i' % i: ip4
-        for i, ip4 in enumerate(ip4_list)
-    })
-    params.update({
-        '__n%i' % i: ip6
-        for i, ip6 in enumerate(ip6_list)
+        if ip6_any:
+            ip_where_clause.append("(l2.ip6_address IS NOT NULL)")
+        else:
+            ip_where_clause.extend(
+                ["(l2.ip6_address LIKE %%(__p%i)s)" % i for i in range(len(padded['__p']))]
+                + ["(l2.ip6_address REGEXP %%(__x%i)s)" % i for i in range(len(padded['__x']))]
+            )
+        ip_where_clause = ' OR '.join(ip_where_clause)
+
+        query = """
+            SELECT
+                IF(nonnullvalue(l2.ip4_address), l2.ip4_address, l2.ip6_address) AS ip_address,
+                l2.asn,
+                SUBSTR(l1.query_name, 1, LENGTH(l1.query_name) - 1) AS pointing_query_name,
+                SUBSTR(l1.response_name, 1, LENGTH(l1.response_name) - 1) AS pointing_response_name,
+                SUBSTR(l2.query_name, 1, LENGTH(l2.query_name) - 1) AS query_name,
+                SUBSTR(l2.response_name, 1, LENGTH(l2.response_name) - 1) AS response_name,
+                l1.query_type AS pointing_record_type,
+                l1.field AS pointing_record_field,
+                to_timestamp(CAST(MIN(l2.time)/1000 AS BIGINT)) AS first_ts,
+                to_timestamp(CAST(MAX(l2.time)/1000 AS BIGINT)) AS last_ts
+            FROM %(db)s AS l2
+            JOIN (
+                          SELECT query_type, query_name, response_name, query_name AS ref_query_name, year, day, month, time, 'query_name' AS field FROM %(db)s WHERE (ip4_address IS NOT NULL) OR (ip6_address IS NOT NULL)
+                UNION ALL SELECT query_type, query_name, response_name, mx_address AS ref_query_name, year, day, month, time, 'mx_address' AS field FROM %(db)s WHERE mx_address IS NOT NULL
+                UNION ALL SELECT query_type, query_name, response_name, ns_address AS ref_query_name, year, day, month, time, 'ns_address' AS field FROM %(db)s WHERE ns_address IS NOT NULL
+                UNION ALL SELECT query_type, query_name, response_name, cname_name AS ref_query_name, year, day, month, time, 'cname_name' AS field FROM %(db)s WHERE cname_name IS NOT NULL
+                UNION ALL SELECT query_type, query_name, response_name, dname_name AS ref_query_name, year, day, month, time, 'dname_name' AS field FROM %(db)s WHERE dname_name IS NOT NULL
+                UNION ALL SELECT query_type, query_name, response_name, soa_mname  AS ref_query_name, year, day, month, time, 'soa_mname'  AS field FROM %(db)s WHERE soa_mname  IS NOT NULL
+            ) AS l1 ON (l2.query_name = l1.ref_query_name)
+            WHERE
+                (
+                    %(ip_where_clause)s
+                )
+                AND
+                (
+                    %(date_where_clause)s
+                )
+                AND
+                (
+                    l2.year = l1.year
+                    AND l2.month = l1.month
+                    AND l2.day = l1.day
+                )
+            GROUP BY l2.ip4_address, l2.ip6_address, l2.query_name, l2.response_name, l2.asn, l1.query_type, l1.query_name, l1.response_name, l1.field
+            ORDER BY first_ts
+        """ % {
+            'db': config["DB"],
+            'ip_where_clause': ip_where_clause,
+            'date_where_clause': get_date_where_clause("l1", date_from, date_to)
+        }
+        if limit > 0:
+            query += "\nLIMIT %(limit)s"
+        return query
+
+    shape = tuple(len(values) for values in padded.values()) + (ip6_any, limit > 0)
+    query = templates.get("openintel_domains_by_ips", shape, build)
+
+    params = get_spec_for_clause({
+        'from': date_from,
+        'to': date_to
     })
-
+    params.update(get_params('__o', padded['__o']))
+    params.update(get_params('__n', padded['__n']))
+    for i, (first, last) in enumerate(padded['__r']):
+        params['__r%i_first' % i] = first
+        params['__r%i_last' % i] = last
+    params.update(get_params('__p', padded['__p']))
+    params.update(get_params('__x', padded['__x']))
     if limit > 0:
-        query += "\nLIMIT %(limit)s"
         params["limit"] = limit
 
     results = await DBConnection.execute_query_async(
@@ -218,6 +386,15 @@ async def openintel_select_domains_by_ips(
 
     result_dict.update(results)
 
+    if existence_filter is not None and (limit <= 0 or len(results["rows"]) < limit):
+        found = set(row["ip_address"] for row in results["rows"])
+        existence_filter.record_absent(
+            'ip4_address', [ip for ip in ip4_list if ip not in found], date_from, date_to
+        )
+        existence_filter.record_absent(
+            'ip6_address', [ip for ip in ip6_list if ip not in found], date_from, date_to
+        )
+
     if len(result_dict["rows"]) > 0:
         result_dict['columns'] = list(result_dict['rows'][0].keys())
 
@@ -230,7 +407,8 @@ async def openintel_select_ips_by_domains(
     domains,
     date_from,
     date_to,
-    limit
+    limit,
+    existence_filter=None
 ):
     domains = list(map(str, domains))
     result_dict = {
@@ -242,67 +420,77 @@ async def openintel_select_ips_by_domains(
         result_dict["ips"] = []
         return result_dict
 
-    params = {
+    if existence_filter is not None:
+        present, absent = existence_filter.split_absent(
+            'query_name', [_name + "." for _name in domains], date_from, date_to
+        )
+        domains = [_name[:-1] for _name in present]
+        result_dict['absent_domains'] = [_name[:-1] for _name in absent]
+        if len(domains) == 0:
+            logger.debug("no queried domain is present in the requested interval - skipping DB call")
+            existence_filter.n_skipped_queries += 1
+            result_dict.update({'rows': [], 'query_time': 0.0, 'fetch_time': 0.0})
+            return result_dict
+
+    # the IN list is padded to a power of two, the text of the query only depends on its length
+    padded = pad_values([_name + "." for _name in domains])
+
+    def build():
+        query = """
+            SELECT
+                SUBSTR(l1.query_name, 1, LENGTH(l1.query_name) - 1) AS domain_name,
+                l1.query_type AS record_type,
+                GROUP_CONCAT(DISTINCT SUBSTR(l2.query_name, 1, LENGTH(l2.query_name) - 1), ',') AS record_names,
+                IF(nonnullvalue(l2.ip4_address), l2.ip4_address, l2.ip6_address) AS ip_address,
+                l2.asn,
+                l2.country,
+                to_timestamp(CAST(MIN(l1.time)/1000 AS BIGINT)) AS first_ts,
+                to_timestamp(CAST(MAX(l1.time)/1000 AS BIGINT)) AS last_ts
+            FROM %(db)s AS l2
+            JOIN (
+                -- do one self join to find entries that are not referenced from another MX/NS/CNAME/DNAME/SOA record
+                          SELECT query_type, query_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE (ip4_address IS NOT NULL) OR (ip6_address IS NOT NULL)
+                UNION ALL SELECT query_type, mx_address AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE mx_address IS NOT NULL
+                UNION ALL SELECT query_type, ns_address AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE ns_address IS NOT NULL
+                UNION ALL SELECT query_type, cname_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE cname_name IS NOT NULL
+                UNION ALL SELECT query_type, dname_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE dname_name IS NOT NULL
+                UNION ALL SELECT query_type, soa_mname  AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE soa_mname  IS NOT NULL
+            ) AS l1 ON (l2.query_name = l1.ref_query_name)
+            WHERE
+                (l1.query_name IN (%(domain_names)s))
+                AND (
+                    (l2.ip4_address IS NOT NULL)
+                    OR (l2.ip6_address IS NOT NULL)
+                )
+                AND
+                (
+                    %(date_clause)s
+                )
+                AND
+                (
+                    l2.year = l1.year
+                    AND l2.month = l1.month
+                    AND l2.day = l1.day
+                )
+            GROUP BY l1.query_name, l1.query_type, l2.ip4_address, l2.ip6_address, l2.asn, l2.country
+            ORDER BY l1.query_name
+        """ % {
+            'db': config["DB"],
+            'date_clause': get_date_where_clause("l1", date_from, date_to),
+            'domain_names': get_placeholders('__domain_name', len(padded))
+        }
+        if limit > 0:
+            query += "\nLIMIT %(limit)s"
+        return query
+
+    query = templates.get("openintel_ips_by_domains", (len(padded), limit > 0), build)
+
+    params = get_spec_for_clause({
         'from': date_from,
         'to': date_to
-    }
-
-    date_clause = get_date_where_clause("l1", params["from"], params["to"])
-    params = get_spec_for_clause(params)
-
-    query = """
-        SELECT
-            SUBSTR(l1.query_name, 1, LENGTH(l1.query_name) - 1) AS domain_name,
-            l1.query_type AS record_type,
-            GROUP_CONCAT(DISTINCT SUBSTR(l2.query_name, 1, LENGTH(l2.query_name) - 1), ',') AS record_names,
-            IF(nonnullvalue(l2.ip4_address), l2.ip4_address, l2.ip6_address) AS ip_address,
-            l2.asn,
-            l2.country,
-            to_timestamp(CAST(MIN(l1.time)/1000 AS BIGINT)) AS first_ts,
-            to_timestamp(CAST(MAX(l1.time)/1000 AS BIGINT)) AS last_ts
-        FROM %(db)s AS l2
-        JOIN (
-            -- do one self join to find entries that are not referenced from another MX/NS/CNAME/DNAME/SOA record
-                      SELECT query_type, query_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE (ip4_address IS NOT NULL) OR (ip6_address IS NOT NULL)
-            UNION ALL SELECT query_type, mx_address AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE mx_address IS NOT NULL
-            UNION ALL SELECT query_type, ns_address AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE ns_address IS NOT NULL
-            UNION ALL SELECT query_type, cname_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE cname_name IS NOT NULL
-            UNION ALL SELECT query_type, dname_name AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE dname_name IS NOT NULL
-            UNION ALL SELECT query_type, soa_mname  AS ref_query_name, year, day, month, query_name, time FROM %(db)s WHERE soa_mname  IS NOT NULL
-        ) AS l1 ON (l2.query_name = l1.ref_query_name)
-        WHERE
-            (l1.query_name IN (%(domain_names)s))
-            AND (
-                (l2.ip4_address IS NOT NULL)
-                OR (l2.ip6_address IS NOT NULL)
-            )
-            AND
-            (
-                %(date_clause)s
-            )
-            AND
-            (
-                l2.year = l1.year
-                AND l2.month = l1.month
-                AND l2.day = l1.day
-            )
-        GROUP BY l1.query_name, l1.query_type, l2.ip4_address, l2.ip6_address, l2.asn, l2.country
-        ORDER BY l1.query_name
-    """ % {
-        'db': config["DB"],
-        'date_clause': date_clause,
-        'domain_names': ','.join(
-            ['%%(__domain_name%i)s' % i for i in range(len(domains))]
-        )
-    }
-
-    params.update({
-        '__domain_name%i' % i: _name + "."
-        for i, _name in enumerate(domains)
     })
-
+    params.update(get_params('__domain_name', padded))
     if limit > 0:
-        query += "\nLIMIT %(limit)s"
         params["limit"] = limit
 
     results = await DBConnection.execute_query_async(
@@ -314,6 +502,12 @@ async def openintel_select_ips_by_domains(
 
     result_dict.update(results)
 
+    if existence_filter is not None and (limit <= 0 or len(results["rows"]) < limit):
+        found = set(row["domain_name"] for row in results["rows"])
+        existence_filter.record_absent(
+            'query_name', [_name + "." for _name in domains if _name not in found], date_from, date_to
+        )
+
     if len(result_dict["rows"]) > 0:
         result_dict['columns'] = list(result_dict['rows'][0].keys())
 
@@ -401,6 +595,211 @@ async def openintel_select_ips_by_mx_records(
     return result_dict
 
 
+async def openintel_select_references(
+    DBConnection,
+    logger,
+    names,
+    date_from,
+    date_to,
+    limit
+):
+    """ returns the CNAME, DNAME, MX and NS targets and the A/AAAA addresses of the names (one table scan) """
+    names = list(map(str, names))
+    result_dict = {
+        'queried_names': names,
+        'queried_interval': [date_from, date_to]
+    }
+    if len(names) == 0:
+        result_dict.update({'rows': [], 'query_time': 0.0, 'fetch_time': 0.0})
+        return result_dict
+
+    # the IN list is padded to a power of two, the text of the query only depends on its length
+    padded = pad_values([_name + "." for _name in names])
+
+    def build():
+        query = """
+            SELECT
+                SUBSTR(l1.response_name, 1, LENGTH(l1.response_name) - 1) AS name,
+                l1.response_type AS record_type,
+                IF(
+                    l1.response_type IN ('A', 'AAAA'),
+                    IF(nonnullvalue(l1.ip4_address), l1.ip4_address, l1.ip6_address),
+                    SUBSTR(
+                        COALESCE(l1.cname_name, l1.dname_name, l1.mx_address, l1.ns_address), 1,
+                        LENGTH(COALESCE(l1.cname_name, l1.dname_name, l1.mx_address, l1.ns_address)) - 1
+                    )
+                ) AS target,
+                to_timestamp(CAST(MIN(l1.time)/1000 AS BIGINT)) AS first_ts,
+                to_timestamp(CAST(MAX(l1.time)/1000 AS BIGINT)) AS last_ts
+            FROM %(db)s AS l1
+            WHERE
+                (l1.response_name IN (%(names)s))
+                AND (l1.response_type IN ('CNAME', 'DNAME', 'MX', 'NS', 'A', 'AAAA'))
+                AND
+                (
+                    %(date_clause)s
+                )
+            GROUP BY 1, 2, 3
+            ORDER BY 1
+        """ % {
+            'db': config["DB"],
+            'date_clause': get_date_where_clause("l1", date_from, date_to),
+            'names': get_placeholders('__name', len(padded))
+        }
+        if limit > 0:
+            query += "\nLIMIT %(limit)s"
+        return query
+
+    query = templates.get("openintel_references", (len(padded), limit > 0), build)
+
+    params = get_spec_for_clause({
+        'from': date_from,
+        'to': date_to
+    })
+    params.update(get_params('__name', padded))
+    if limit > 0:
+        params["limit"] = limit
+
+    results = await DBConnection.execute_query_async(
+        query,
+        params,
+        {'paramstyle': 'format'},
+        query_name="openintel_references"
+    )
+
+    result_dict.update(results)
+
+    if len(result_dict["rows"]) > 0:
+        result_dict['columns'] = list(result_dict['rows'][0].keys())
+
+    return result_dict
+
+
+def get_day_clause(prefix, name):
+    """ matches the partition of a single day, the parameters are those of get_spec_for_clause for name """
+    return " AND ".join(
+        "(CAST(%s.%s AS integer) = %%(%s_%s)s)" % (prefix, field, name, field)
+        for field in ("year", "month", "day")
+    )
+
+
+async def openintel_select_changes(
+    DBConnection,
+    logger,
+    domains,
+    date_before,
+    date_after,
+    limit,
+    zone=None
+):
+    """ returns the A/AAAA addresses and CNAME, DNAME, MX and NS targets of the domains that differ between two days
+
+    Per domain and day the set of (record type, target) pairs is reduced to a fingerprint (count and sum of
+    hashes), only the pairs of domains whose fingerprints differ are compared. With zone all domains of the
+    zone are compared instead of the listed ones.
+    """
+    domains = list(map(str, domains))
+    result_dict = {
+        'queried_domains': domains,
+        'queried_zone': zone,
+        'queried_interval': [date_before, date_after]
+    }
+    if len(domains) == 0 and zone is None:
+        result_dict.update({'rows': [], 'query_time': 0.0, 'fetch_time': 0.0})
+        return result_dict
+
+    params = get_spec_for_clause({
+        'before': date_before,
+        'after': date_after
+    })
+
+    if zone is None:
+        # the IN list is padded to a power of two, the text of the query only depends on its length
+        padded = pad_values([_name + "." for _name in domains])
+        name_clause = "l1.query_name IN (%s)" % get_placeholders('__domain_name', len(padded))
+        params.update(get_params('__domain_name', padded))
+        shape = (len(padded), limit > 0)
+    else:
+        name_clause = "l1.query_name LIKE %(zone_pattern)s"
+        params['zone_pattern'] = "%%.%s." % zone.strip(".")
+        shape = ("zone", limit > 0)
+
+    def build():
+        query = """
+            WITH edges AS (
+                SELECT DISTINCT
+                    SUBSTR(l1.query_name, 1, LENGTH(l1.query_name) - 1) AS domain_name,
+                    l1.response_type AS record_type,
+                    IF(
+                        l1.response_type IN ('A', 'AAAA'),
+                        IF(nonnullvalue(l1.ip4_address), l1.ip4_address, l1.ip6_address),
+                        SUBSTR(
+                            COALESCE(l1.cname_name, l1.dname_name, l1.mx_address, l1.ns_address), 1,
+                            LENGTH(COALESCE(l1.cname_name, l1.dname_name, l1.mx_address, l1.ns_address)) - 1
+                        )
+                    ) AS target,
+                    IF(%(after_clause)s, 'after', 'before') AS side
+                FROM %(db)s AS l1
+                WHERE
+                    (%(name_clause)s)
+                    AND (l1.response_type IN ('CNAME', 'DNAME', 'MX', 'NS', 'A', 'AAAA'))
+                    AND
+                    (
+                        (%(before_clause)s) OR (%(after_clause)s)
+                    )
+            ),
+            fingerprints AS (
+                SELECT
+                    domain_name,
+                    SUM(IF(side = 'before', 1, 0)) AS n_before,
+                    SUM(IF(side = 'after', 1, 0)) AS n_after,
+                    SUM(IF(side = 'before', pmod(fnv_hash(CONCAT(record_type, '|', target)), 2147483647), 0)) AS fp_before,
+                    SUM(IF(side = 'after', pmod(fnv_hash(CONCAT(record_type, '|', target)), 2147483647), 0)) AS fp_after
+                FROM edges
+                GROUP BY domain_name
+            )
+            SELECT
+                e.domain_name,
+                e.record_type,
+                e.target,
+                IF(MIN(e.side) = 'after', 'added', 'removed') AS change
+            FROM edges AS e
+            JOIN fingerprints AS f ON (e.domain_name = f.domain_name)
+            WHERE
+                (f.n_before != f.n_after) OR (f.fp_before != f.fp_after)
+            GROUP BY e.domain_name, e.record_type, e.target
+            HAVING COUNT(*) = 1
+            ORDER BY e.domain_name
+        """ % {
+            'db': config["DB"],
+            'name_clause': name_clause,
+            'before_clause': get_day_clause("l1", "before"),
+            'after_clause': get_day_clause("l1", "after")
+        }
+        if limit > 0:
+            query += "\nLIMIT %(limit)s"
+        return query
+
+    query = templates.get("openintel_changes", shape, build)
+    if limit > 0:
+        params["limit"] = limit
+
+    results = await DBConnection.execute_query_async(
+        query,
+        params,
+        {'paramstyle': 'format'},
+        query_name="openintel_changes"
+    )
+
+    result_dict.update(results)
+    result_dict['changed_domains'] = len(set(row["domain_name"] for row in result_dict["rows"]))
+
+    if len(result_dict["rows"]) > 0:
+        result_dict['columns'] = list(result_dict['rows'][0].keys())
+
+    return result_dict
+
+
 async def openintel_select_measurements_by_name_and_ip_or_type(
     DBConnection,
     logger,
@@ -410,14 +809,21 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
     limit,
     ip=None,
     type=None,
-    full=False
+    full=False,
+    collapse=False
 ):
+    """ with collapse, consecutive days with the same observation are merged into one row with the
+    first_seen and last_seen timestamps and the count of measurements (not with full) """
+    if full and collapse:
+        raise ValueError("collapse is not supported with full")
+
     result_dict = {
         'queried_domain_name': name,
         'queried_ip': ip,
         'queried_interval': [date_from, date_to],
         'queried_record_type':  type,
         'full': full,
+        'collapse': collapse,
         'limit': limit
     }
 
@@ -429,6 +835,14 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
 
     if full:
         sql_fields = """to_timestamp(CAST(time/1000 AS BIGINT)) AS ts, *"""
+    elif collapse:
+        sql_fields = """SUBSTR(query_name, 1, LENGTH(query_name) - 1) AS query_name,
+                        SUBSTR(response_name, 1, LENGTH(response_name) - 1) AS response_name,
+                        query_type,
+                        response_type,
+                        ip4_address,
+                        ip6_address,
+                        to_timestamp(CAST(time/1000 AS BIGINT)) AS ts"""
     else:
         sql_fields = """SUBSTR(query_name, 1, LENGTH(query_name) - 1),
                         SUBSTR(response_name, 1, LENGTH(response_name) - 1),
@@ -468,8 +882,8 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
         FROM %(db)s AS l1
         WHERE
             (
-                (query_name = %%(query_name)s)
-                OR (response_name = %%(query_name)s)
+                (l1.query_name = %%(query_name)s)
+                OR (l1.response_name = %%(query_name)s)
             )
             AND
             (
@@ -483,7 +897,6 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
             (
                 %(date_clause)s
             )
-        ORDER BY ts
     """ % {
         'db': config["DB"],
         'sql_fields': sql_fields,
@@ -492,16 +905,47 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
         'date_clause': date_clause
     }
 
+    if collapse:
+        # the days of a run of an observation are consecutive, so their distance to the
+        # dense rank of the day is the same for the whole run
+        query = """
+        SELECT
+            query_name,
+            response_name,
+            query_type,
+            response_type,
+            ip4_address,
+            ip6_address,
+            MIN(ts) AS first_seen,
+            MAX(ts) AS last_seen,
+            COUNT(*) AS `count`
+        FROM (
+            SELECT
+                m.*,
+                DATEDIFF(ts, '1970-01-01') - DENSE_RANK() OVER (
+                    PARTITION BY query_name, response_name, query_type, response_type, ip4_address, ip6_address
+                    ORDER BY TO_DATE(ts)
+                ) AS run
+            FROM (%(measurements)s) AS m
+        ) AS runs
+        GROUP BY query_name, response_name, query_type, response_type, ip4_address, ip6_address, run
+        ORDER BY first_seen
+        """ % {
+            'measurements': query
+        }
+    else:
+        query += "ORDER BY ts"
+
     if limit > 0:
         query += "\nLIMIT %(limit)s"
         params['limit'] = limit
 
-    logger.debug(query % params)
+    logger.debug("%s", LazyFormat(query, params))
 
     results = await DBConnection.execute_query_async(
         query,
         params,
-        query_name='openintel_measurements_by_name_and_ip_pair'
+        query_name='openintel_measurements_collapsed' if collapse else 'openintel_measurements_by_name_and_ip_pair'
     )
 
     result_dict.update(results)
@@ -512,16 +956,105 @@ async def openintel_select_measurements_by_name_and_ip_or_type(
     return result_dict
 
 
+RECORD_COLUMNS = ("query_name", "response_name", "query_type", "response_type", "ip4_address", "ip6_address")
+
+
+def get_records_aggregation(table, date_clause, where_clause="True"):
+    """ the distinct records of the measurements in table with the first and last time they were seen """
+    return """
+        SELECT
+            %(columns)s,
+            MIN(to_timestamp(CAST(time/1000 AS BIGINT))) AS first_ts,
+            MAX(to_timestamp(CAST(time/1000 AS BIGINT))) AS last_ts,
+            COUNT(*) AS measurements
+        FROM %(table)s AS l1
+        WHERE
+            (
+                %(where_clause)s
+            )
+            AND
+            (
+                %(date_clause)s
+            )
+        GROUP BY %(columns)s
+    """ % {
+        'columns': ", ".join(RECORD_COLUMNS),
+        'table': table,
+        'where_clause': where_clause,
+        'date_clause': date_clause
+    }
+
+
+async def openintel_create_records_rollup(DBConnection, logger, table):
+    """ creates the table of the daily rollups of the records, partitioned like the measurements """
+    query = """
+        CREATE TABLE IF NOT EXISTS %(table)s (
+            query_name STRING,
+            response_name STRING,
+            query_type STRING,
+            response_type STRING,
+            ip4_address STRING,
+            ip6_address STRING,
+            first_ts TIMESTAMP,
+            last_ts TIMESTAMP,
+            measurements BIGINT
+        )
+        PARTITIONED BY (year STRING, month STRING, day STRING)
+        STORED AS PARQUET
+    """ % {
+        'table': table
+    }
+    logger.debug("%s", query)
+    return await DBConnection.execute_query_async(query, query_name='openintel_create_records_rollup')
+
+
+async def openintel_build_records_rollup(DBConnection, logger, table, day):
+    """ (re)writes the rollup of the records of a day """
+    params = get_spec_for_clause({'day': day})
+    query = """
+        INSERT OVERWRITE TABLE %(table)s PARTITION (year, month, day)
+        SELECT
+            %(columns)s,
+            MIN(to_timestamp(CAST(time/1000 AS BIGINT))) AS first_ts,
+            MAX(to_timestamp(CAST(time/1000 AS BIGINT))) AS last_ts,
+            COUNT(*) AS measurements,
+            l1.year,
+            l1.month,
+            l1.day
+        FROM %(db)s AS l1
+        WHERE
+            %(day_clause)s
+        GROUP BY %(columns)s, l1.year, l1.month, l1.day
+    """ % {
+        'table': table,
+        'db': config["DB"],
+        'columns': ", ".join(RECORD_COLUMNS),
+        'day_clause': get_day_clause("l1", "day")
+    }
+    logger.debug("%s", LazyFormat(query, params))
+    return await DBConnection.execute_query_async(
+        query,
+        params,
+        query_name='openintel_build_records_rollup'
+    )
+
+
 async def openintel_select_records_summary(
     DBConnection,
     logger,
+    name,
     date_from,
     date_to,
     limit,
-    name=None,
     ip=None,
-    type=None
+    type=None,
+    rollup=None
 ):
+    """ returns the distinct records of a name, IP and/or type with the first and last time they were seen
+
+    with rollup (see rollup.py), the days that are rolled up are read from the rollup table and only the
+    remaining days from the measurements
+    """
     result_dict = {
         'queried_domain_name': name,
         'queried_ip': ip,
@@ -538,7 +1071,7 @@ async def openintel_select_records_summary(
     if name is None:
         name_clause = "True"
     else:
-        name_clause = "(query_name = %(query_name)s) OR (response_name = %(query_name)s)"
+        name_clause = "(l1.query_name = %(query_name)s) OR (l1.response_name = %(query_name)s)"
         params['query_name'] = str(name) + "."
 
     if ip is None:
@@ -562,57 +1095,70 @@ async def openintel_select_records_summary(
         type_clause = "((query_type = %(query_type)s) OR (response_type = %(query_type)s))"
         params['query_type'] = str(type)
 
-    date_clause = get_date_where_clause("l1", params["from"], params["to"])
+    where_clause = "(%s) AND (%s) AND (%s)" % (name_clause, ip_clause, type_clause)
+
+    rolled_up_to = None if rollup is None else rollup.get_rolled_up(date_from, date_to)
+    parts = []
+    if rolled_up_to is not None:
+        params['rollup_from'] = date_from
+        params['rollup_to'] = rolled_up_to
+        parts.append("""
+            SELECT %(columns)s, first_ts, last_ts, measurements
+            FROM %(table)s AS l1
+            WHERE
+                (
+                    %(where_clause)s
+                )
+                AND
+                (
+                    %(date_clause)s
+                )
+        """ % {
+            'columns': ", ".join(RECORD_COLUMNS),
+            'table': rollup.table,
+            'where_clause': where_clause,
+            'date_clause': get_date_where_clause("l1", date_from, rolled_up_to, names=("rollup_from", "rollup_to"))
+        })
+        result_dict['rolled_up_interval'] = [date_from, rolled_up_to]
+        date_from = rolled_up_to + datetime.timedelta(days=1)
+        params['from'] = date_from
+    if rolled_up_to is None or date_from <= date_to:
+        parts.append(get_records_aggregation(
+            config["DB"],
+            get_date_where_clause("l1", date_from, date_to),
+            where_clause
+        ))
     params = get_spec_for_clause(params)
 
-    sql_fields = """"""
-
+    # the days of a record from both parts are merged again
     query = """
         SELECT
-            SUBSTR(query_name, 1, LENGTH(query_name) - 1),
-                    SUBSTR(response_name, 1, LENGTH(response_name) - 1),
-                    query_type,
-                    response_type,
-                    ip4_address,
-                    ip6_address,
-                    to_timestamp(CAST(time/1000 AS BIGINT)) AS ts
-        FROM %(db)s AS l1
-        WHERE
-            (
-                %(name_clause)s
-            )
-            AND
-            (
-                %(ip_clause)s
-            )
-            AND
-            (
-                %(type_clause)s
-            )
-            AND
-            (
-                %(date_clause)s
-            )
-        ORDER BY ts
-        GROUP BY query_name, response_name, query_type, response_type, ip4_address, ip6_address
+            SUBSTR(query_name, 1, LENGTH(query_name) - 1) AS query_name,
+            SUBSTR(response_name, 1, LENGTH(response_name) - 1) AS response_name,
+            query_type,
+            response_type,
+            ip4_address,
+            ip6_address,
+            MIN(first_ts) AS first_seen,
+            MAX(last_ts) AS last_seen,
+            SUM(measurements) AS measurements
+        FROM (%(parts)s) AS records
+        GROUP BY records.query_name, records.response_name, query_type, response_type, ip4_address, ip6_address
+        ORDER BY first_seen, query_name
     """ % {
-        'db': config["DB"],
-        'name_clause': name_clause,
-        'ip_clause': ip_clause,
-        'type_clause': type_clause,
-        'date_clause': date_clause
+        'parts': "UNION ALL".join(parts)
     }
 
     if limit > 0:
         query += "\nLIMIT %(limit)s"
         params['limit'] = limit
 
-    logger.debug(query % params)
+    logger.debug("%s", LazyFormat(query, params))
 
     results = await DBConnection.execute_query_async(
         query,
         params,
-        query_name='openintel_select_records_summary'
+        query_name='openintel_records_summary'
     )
 
     result_dict.update(results)
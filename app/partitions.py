@@ -0,0 +1,128 @@
+import bisect
+import hashlib
+import asyncio
+import datetime
+
+
+"""
+Catalog of the loaded year/month/day partitions
+
+The catalog is refreshed with SHOW PARTITIONS every PARTITION_REFRESH_INTERVAL
+seconds. It provides the latest loaded day (the default interval of the
+lookups) and clamps requested intervals to the loaded partitions, so queries
+for days that have not been loaded (yet) are answered without touching the
+cluster.
+"""
+
+
+class PartitionCatalog(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.refresh_interval = float(self.config["PARTITION_REFRESH_INTERVAL"])  # seconds
+        self.days = []  # sorted list of loaded days
+        self.row_counts = dict()  # day -> number of rows (-1 if there are no stats)
+        self.refreshed = None
+        self.version = None  # changes whenever partitions are loaded or reloaded
+        self.listeners = []
+
+    @property
+    def loaded(self):
+        return len(self.days) > 0
+
+    @property
+    def latest_day(self):
+        return self.days[-1] if self.loaded else None
+
+    @property
+    def first_day(self):
+        return self.days[0] if self.loaded else None
+
+    def default_day(self):
+        """ the latest loaded day, or yesterday as long as the catalog is unknown """
+        if self.loaded:
+            return self.latest_day
+        return datetime.date.today() - datetime.timedelta(days=1)
+
+    def clamp(self, date_from, date_to):
+        """ returns the interval clamped to the loaded partitions or None if no partition intersects it
+
+        the interval is returned unchanged as long as the catalog is unknown
+        """
+        if not self.loaded:
+            return date_from, date_to
+        i_from = bisect.bisect_left(self.days, date_from)
+        i_to = bisect.bisect_right(self.days, date_to) - 1
+        if i_from > i_to:
+            return None
+        return self.days[i_from], self.days[i_to]
+
+    def get_days(self, date_from, date_to):
+        """ returns the loaded days within the interval """
+        return self.days[bisect.bisect_left(self.days, date_from):bisect.bisect_right(self.days, date_to)]
+
+    @staticmethod
+    def _parse_partition(row):
+        row = {str(k).lower(): v for k, v in row.items()}
+        try:
+            day = datetime.date(int(row["year"]), int(row["month"]), int(row["day"]))
+        except (KeyError, TypeError, ValueError):
+            # e.g. the 'Total' row
+            return None, None
+        try:
+            n_rows = int(row.get("#rows", -1))
+        except (TypeError, ValueError):
+            n_rows = -1
+        return day, n_rows
+
+    @staticmethod
+    def get_version(row_counts):
+        """ the same for all workers that see the same partitions """
+        digest = hashlib.sha1()
+        for day in sorted(row_counts):
+            digest.update(("%s:%i," % (day, row_counts[day])).encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    async def refresh(self, DBConnection):
+        """ reloads the catalog and returns the days that have been added """
+        results = await DBConnection.execute_query_async(
+            "SHOW PARTITIONS %s" % self.config["DB"],
+            query_name='show_partitions'
+        )
+        row_counts = dict()
+        for row in results["rows"]:
+            day, n_rows = self._parse_partition(row)
+            if day is not None:
+                row_counts[day] = n_rows
+        previous_latest_day = self.latest_day
+        self.row_counts = row_counts
+        self.days = sorted(row_counts.keys())
+        self.version = self.get_version(row_counts)
+        self.refreshed = datetime.datetime.now()
+        if previous_latest_day is None:
+            return []
+        return [day for day in self.days if day > previous_latest_day]
+
+    async def run_scheduler(self, DBConnection):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                new_days = await self.refresh(DBConnection)
+                if len(new_days) > 0:
+                    self.logger.info("new day(s) loaded: %s" % ', '.join(map(str, new_days)))
+                for listener in self.listeners:
+                    await listener(new_days)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error("error while refreshing the partition catalog - %s" % str(e))
+
+    def stats(self):
+        return {
+            "partitions": len(self.days),
+            "first_day": self.first_day,
+            "latest_day": self.latest_day,
+            "version": self.version,
+            "refreshed": self.refreshed
+        }
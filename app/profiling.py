@@ -0,0 +1,116 @@
+import io
+import os
+import time
+import uuid
+import random
+import pstats
+import cProfile
+
+
+"""
+On-demand profiling of single requests
+
+Clients listed in PROFILE_CLIENTS (names of CLIENT_API_KEYS) can add
+profile=true to any request: the request is run under cProfile including the
+serialization of the response body, and the report (sorted by cumulative
+time) is returned as text file instead of the response. In addition a share
+of PROFILE_SAMPLE_RATE of all API requests is profiled and the reports are
+kept in PROFILE_DIR (the latest PROFILE_MAX_REPORTS), where they can be
+listed and downloaded by the same clients. Work that runs in executor threads
+(e.g. fetching rows) is not seen by the profiler, it shows up as waiting time
+of the request. Only one request per process is profiled at a time, other
+requests that run on the event loop meanwhile show up in its report as well.
+Streamed responses (SSE, exports, measurements) are read to the end under the
+profiler for profile=true. The sampling skips them, they are passed through as
+soon as their headers arrive.
+"""
+
+
+class RequestProfiler(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.clients = set(
+            name.strip() for name in self.config["PROFILE_CLIENTS"].split(",") if len(name.strip()) > 0
+        )
+        self.sample_rate = float(self.config["PROFILE_SAMPLE_RATE"])
+        self.profile_dir = self.config["PROFILE_DIR"]
+        self.max_reports = int(self.config["PROFILE_MAX_REPORTS"])
+        self.top_n = int(self.config["PROFILE_TOP_N"])
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        self.active = False  # a request is being profiled
+        self.n_profiled = 0
+        self.n_sampled = 0
+        self.n_streamed = 0
+
+    def is_admin(self, client_id):
+        return client_id in self.clients
+
+    def should_sample(self, request):
+        return (
+            self.sample_rate > 0 and not self.active and request.url.path.startswith("/api/")
+            and random.random() < self.sample_rate
+        )
+
+    async def profile(self, request, call_next, drain_streamed=False):
+        """ runs the request and the response body under the profiler, returns (response, body, report)
+
+        streamed responses (without Content-Length) are only read with drain_streamed, else they are
+        returned untouched with body and report None
+        """
+        self.active = True
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            response = await call_next(request)
+            if "content-length" not in response.headers and not drain_streamed:
+                self.n_streamed += 1
+                return response, None, None
+            chunks = []
+            async for chunk in response.body_iterator:
+                chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+            body = b"".join(chunks)
+        finally:
+            profiler.disable()
+            self.active = False
+        dt = time.time() - start
+        self.n_profiled += 1
+
+        stream = io.StringIO()
+        stream.write("%s %s\n" % (request.method, request.url))
+        stream.write("status %i, %i bytes, %f s\n\n" % (response.status_code, len(body), dt))
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(self.top_n)
+        return response, body, stream.getvalue()
+
+    def store(self, report):
+        self.n_sampled += 1
+        name = "%i-%s.txt" % (time.time() * 1000, uuid.uuid4().hex[:8])
+        with open(os.path.join(self.profile_dir, name), "w") as f:
+            f.write(report)
+        for old_name in self.list_reports()[self.max_reports:]:
+            try:
+                os.remove(os.path.join(self.profile_dir, old_name))
+            except OSError:
+                pass
+        return name
+
+    def list_reports(self):
+        """ the names of the stored reports, latest first """
+        return sorted((name for name in os.listdir(self.profile_dir) if name.endswith(".txt")), reverse=True)
+
+    def get_report_filename(self, name):
+        if name not in self.list_reports():
+            raise KeyError(name)
+        return os.path.join(self.profile_dir, name)
+
+    def stats(self):
+        return {
+            "profiled": self.n_profiled,
+            "sampled": self.n_sampled,
+            "streamed": self.n_streamed,
+            "reports": len(self.list_reports())
+        }
@@ -0,0 +1,93 @@
+import json
+import random
+
+from scheduler import parse_mapping
+
+
+"""
+Query option profiles
+
+A profile is a named set of impala query options, e.g.
+{"join": {"RUNTIME_FILTER_MODE": "GLOBAL", "DEFAULT_JOIN_DISTRIBUTION_MODE": "BROADCAST"},
+ "scan": {"MT_DOP": 4, "EXEC_TIME_LIMIT_S": 60}} (QUERY_OPTION_PROFILES, JSON).
+QUERY_PROFILES selects the profile per query name ("query_name:profile,..."),
+its options are sent with the configuration of the query, queries without a
+profile run with the default options of the session. For A/B tests
+QUERY_PROFILES_B selects an alternative profile per query name ("default" for
+the default options) that is used for a share of QUERY_PROFILES_B_SHARE of the
+queries, the query times of both variants are listed under /meta/stats.
+"""
+
+DEFAULT_PROFILE = "default"
+
+
+class QueryTimes(object):
+    def __init__(self, profile):
+        self.profile = profile
+        self.n_queries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, query_time):
+        self.n_queries += 1
+        self.total_time += query_time
+        self.max_time = max(self.max_time, query_time)
+
+    def stats(self):
+        return {
+            "profile": self.profile,
+            "queries": self.n_queries,
+            "mean_query_time": self.total_time / self.n_queries if self.n_queries > 0 else 0.0,
+            "max_query_time": self.max_time
+        }
+
+
+class QueryOptionProfiles(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.profiles = json.loads(self.config["QUERY_OPTION_PROFILES"] or "{}")
+        self.profiles[DEFAULT_PROFILE] = {}
+        self.selected = {
+            "A": parse_mapping(self.config["QUERY_PROFILES"]),
+            "B": parse_mapping(self.config["QUERY_PROFILES_B"])
+        }
+        self.b_share = float(self.config["QUERY_PROFILES_B_SHARE"])
+        for variant, selected in self.selected.items():
+            for query_name, profile in selected.items():
+                if profile not in self.profiles:
+                    raise ValueError("unknown query option profile '%s' for '%s'" % (profile, query_name))
+
+        self.times = dict()  # (query_name, variant) -> QueryTimes
+
+    def get_profile(self, query_name):
+        """ returns the variant and the name of the profile for the next query """
+        if query_name in self.selected["B"] and random.random() < self.b_share:
+            return "B", self.selected["B"][query_name]
+        return "A", self.selected["A"].get(query_name, DEFAULT_PROFILE)
+
+    def get_configuration(self, query_name, configuration=None):
+        """ returns the configuration with the options of the profile of the query and the variant """
+        variant, profile = self.get_profile(query_name)
+        options = self.profiles[profile]
+        if len(options) > 0:
+            configuration = dict(configuration or {})
+            configuration.update({key: str(value) for key, value in options.items()})
+            self.logger.debug("query options of '%s' (%s): %s", query_name, profile, configuration)
+        return configuration, variant
+
+    def record(self, query_name, variant, query_time):
+        if query_name is None:
+            return
+        times = self.times.get((query_name, variant))
+        if times is None:
+            profile = self.selected[variant].get(query_name, DEFAULT_PROFILE)
+            times = self.times[(query_name, variant)] = QueryTimes(profile)
+        times.add(query_time)
+
+    def stats(self):
+        stats = dict()
+        for (query_name, variant), times in sorted(self.times.items()):
+            stats.setdefault(query_name, {})[variant] = times.stats()
+        return stats
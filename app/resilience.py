@@ -0,0 +1,128 @@
+import time
+import random
+
+
+"""
+Retry policy and circuit breaker for the DB layer
+
+Only errors that indicate an unreachable or overloaded cluster are retried,
+with exponential backoff and full jitter. They are also counted by the circuit
+breaker: after DB_BREAKER_FAILURE_THRESHOLD of them in a row the breaker opens
+and queries fail immediately with DBUnavailable (503 with Retry-After) for
+DB_BREAKER_RESET_TIMEOUT seconds. Then a single query is let through as probe
+(half open), its outcome closes or reopens the breaker.
+"""
+
+# messages of server side errors that are worth another try
+RETRYABLE_MESSAGES = (
+    "invalid session",
+    "session closed",
+    "invalid query handle",
+    "connection reset",
+    "timed out",
+    "queue is full",
+    "admission",
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DBUnavailable(Exception):
+    """ the cluster cannot be reached, retry_after is a hint in seconds """
+    def __init__(self, message, retry_after):
+        super(DBUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(DBUnavailable):
+    pass
+
+
+def is_retryable(exc):
+    # connection errors of impyla, thrift and the socket layer
+    if type(exc).__name__ in ("InterfaceError", "TTransportException", "TTransportError"):
+        return True
+    if isinstance(exc, (ConnectionError, TimeoutError, OSError)):
+        return True
+    if type(exc).__name__ in ("HiveServer2Error", "OperationalError"):
+        message = str(exc).lower()
+        return any(retryable in message for retryable in RETRYABLE_MESSAGES)
+    return False
+
+
+class Backoff(object):
+    def __init__(self, base_delay, max_delay):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt):
+        """ full jitter: uniform between 0 and the exponential delay of the attempt """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.failure_threshold = int(self.config["DB_BREAKER_FAILURE_THRESHOLD"])
+        self.reset_timeout = float(self.config["DB_BREAKER_RESET_TIMEOUT"])  # seconds
+
+        self.state = CLOSED
+        self.changed = time.time()
+        self.n_failures = 0  # consecutive
+        self.probing = False
+
+        self.n_opened = 0
+        self.n_rejected = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.logger.warning("circuit breaker %s -> %s" % (self.state, state))
+            self.state = state
+            self.changed = time.time()
+            if state == OPEN:
+                self.n_opened += 1
+
+    def get_retry_after(self):
+        if self.state != OPEN:
+            return 1.0
+        return max(1.0, self.changed + self.reset_timeout - time.time())
+
+    def before_call(self):
+        """ raises CircuitOpenError unless the call may go to the cluster """
+        if self.state == OPEN and time.time() >= self.changed + self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return
+        self.n_rejected += 1
+        raise CircuitOpenError("the database is unavailable", self.get_retry_after())
+
+    def record_success(self):
+        self.probing = False
+        self.n_failures = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.probing = False
+        self.n_failures += 1
+        if self.state == HALF_OPEN or self.n_failures >= self.failure_threshold:
+            self._set_state(OPEN)
+
+    def release(self):
+        """ the call ended without telling anything about the cluster (e.g. it was cancelled) """
+        self.probing = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "since": self.changed,
+            "consecutive_failures": self.n_failures,
+            "opened": self.n_opened,
+            "rejected": self.n_rejected
+        }
@@ -0,0 +1,153 @@
+import time
+import asyncio
+import datetime
+
+from partitions import PartitionCatalog
+from openintel_sql_calls import openintel_create_records_rollup, openintel_build_records_rollup
+
+
+"""
+Daily rollups of the records
+
+With ROLLUP the distinct records (names, types and addresses) of every day are
+kept in ROLLUP_TABLE, with the first and last time they were seen and the
+number of measurements, partitioned like the measurements. After every refresh
+of the partition catalog up to ROLLUP_DAYS_PER_RUN missing days of the latest
+ROLLUP_MAX_DAYS are rolled up, latest first; days younger than
+ROLLUP_MIN_AGE_DAYS may still change and are left out. The rollups run as a
+background task, so they do not hold up the other listeners of the catalog.
+With the shared cache tier every day is rolled up by one worker only: the
+worker claims the day for ROLLUP_CLAIM_TTL seconds, the claim is kept after
+the build until it expires, so workers that have not seen the new partition
+yet do not build the day again. Records summaries read the rolled up days
+from the rollup table and only the remaining days from the measurements.
+"""
+
+
+class RecordsRollup(object):
+    def __init__(self, logger, config, DBConnection, catalog, result_cache):
+        self.logger = logger
+        self.config = config
+        self.DBConnection = DBConnection
+        self.catalog = catalog
+        self.result_cache = result_cache
+
+        self.table = self.config["ROLLUP_TABLE"]
+        if not self.table and self.config["DB"]:
+            self.table = "%s_records_daily" % self.config["DB"]
+        self.enabled = self.config["ROLLUP"] and bool(self.table)
+        if self.config["ROLLUP"] and not self.enabled:
+            self.logger.error("rollups need ROLLUP_TABLE or DB - disabled")
+        self.min_age_days = int(self.config["ROLLUP_MIN_AGE_DAYS"])
+        self.max_days = int(self.config["ROLLUP_MAX_DAYS"])
+        self.days_per_run = int(self.config["ROLLUP_DAYS_PER_RUN"])
+        self.claim_ttl = float(self.config["ROLLUP_CLAIM_TTL"])  # seconds
+
+        self.days = set()  # rolled up days
+        self.refreshed = None
+        self.task = None  # the running rollups
+
+        self.n_built = 0
+        self.n_failed = 0
+        self.build_time = 0.0
+
+    async def start(self):
+        """ creates the rollup table if it does not exist and loads the rolled up days """
+        if not self.enabled:
+            return
+        await openintel_create_records_rollup(self.DBConnection, self.logger, self.table)
+        await self.refresh()
+
+    async def refresh(self):
+        results = await self.DBConnection.execute_query_async(
+            "SHOW PARTITIONS %s" % self.table,
+            query_name='show_rollup_partitions'
+        )
+        days = set()
+        for row in results["rows"]:
+            day, n_rows = PartitionCatalog._parse_partition(row)
+            if day is not None:
+                days.add(day)
+        self.days = days
+        self.refreshed = datetime.datetime.now()
+
+    def get_rolled_up(self, date_from, date_to):
+        """ returns the last day up to which all loaded days from date_from on are rolled up, None if there is none """
+        if not self.enabled:
+            return None
+        last_day = None
+        for day in self.catalog.get_days(date_from, date_to):
+            if day not in self.days:
+                break
+            last_day = day
+        return last_day
+
+    def get_missing_days(self):
+        """ the days to roll up, latest first """
+        latest_day = datetime.date.today() - datetime.timedelta(days=self.min_age_days)
+        days = [day for day in self.catalog.days if day <= latest_day][-self.max_days:]
+        return [day for day in reversed(days) if day not in self.days]
+
+    async def build(self, day):
+        """ rolls up a day, returns False if another worker does it """
+        shared = self.result_cache.shared
+        name = "rollup:%s" % day.isoformat()
+        if shared is not None and not await shared.claim_async(name, self.claim_ttl):
+            return False
+        start = time.time()
+        try:
+            await openintel_build_records_rollup(self.DBConnection, self.logger, self.table, day)
+        except BaseException:
+            if shared is not None:
+                await shared.release_async(name)
+            raise
+        dt = time.time() - start
+        self.days.add(day)
+        self.n_built += 1
+        self.build_time += dt
+        self.logger.info("rolled up the records of %s in %f s" % (day, dt))
+        return True
+
+    async def on_catalog_refresh(self, new_days):
+        """ called by the partition catalog after every refresh, starts the rollups unless they are still running """
+        if not self.enabled:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        if self.result_cache.shared is not None:
+            await self.result_cache.shared.prune_claims_async("rollup:", self.claim_ttl)
+        # days rolled up by other workers
+        await self.refresh()
+        n_built = 0
+        for day in self.get_missing_days():
+            if n_built >= self.days_per_run:
+                break
+            try:
+                if await self.build(day):
+                    n_built += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.n_failed += 1
+                self.logger.error("rolling up the records of %s failed - %s" % (day, str(e)))
+                break
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "table": self.table,
+            "days": len(self.days),
+            "first_day": min(self.days) if len(self.days) > 0 else None,
+            "latest_day": max(self.days) if len(self.days) > 0 else None,
+            "refreshed": self.refreshed,
+            "running": self.task is not None and not self.task.done(),
+            "built": self.n_built,
+            "failed": self.n_failed,
+            "mean_build_time": self.build_time / self.n_built if self.n_built > 0 else 0.0
+        }
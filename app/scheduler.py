@@ -0,0 +1,265 @@
+import time
+import asyncio
+import contextvars
+from collections import deque
+
+
+"""
+Per-client fair-share scheduling of DB queries
+
+Every request is attributed to a client, identified by a known API key
+(X-API-Key, see CLIENT_API_KEYS) or else by its source address, and the id is
+kept in a context variable, so background tasks started by a request are
+attributed to the same client. With CLIENT_RATE > 0 API requests of a client
+take a token from its token bucket (CLIENT_RATE per second, at most
+CLIENT_BURST) of the worker, without one they fail with RateLimited (429).
+At most SCHEDULER_MAX_CONCURRENCY queries per
+worker run at the same time and at most CLIENT_MAX_CONCURRENCY of them for the
+same client. Waiting queries are dispatched by weighted fair queuing (start
+time fair queuing with the weights of CLIENT_WEIGHTS), so a client looping
+over an endpoint gets its share of the slots without starving the others.
+Internal queries (catalog, warm-up, health checks) are not attributed to a
+client and bypass the scheduler.
+"""
+
+current_client = contextvars.ContextVar("current_client", default=None)
+
+
+class RateLimited(Exception):
+    """ the client ran out of tokens, retry_after is a hint in seconds """
+    def __init__(self, message, retry_after):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_mapping(value, convert=str):
+    """ parses "a:1,b:2" into {"a": convert("1"), "b": convert("2")} """
+    mapping = {}
+    for item in value.split(","):
+        if ":" not in item:
+            continue
+        key, item_value = item.rsplit(":", 1)
+        mapping[key.strip()] = convert(item_value.strip())
+    return mapping
+
+
+def get_client_id(request, api_keys, trust_forwarded=False):
+    """ returns the name of a known API key or the source address of the request """
+    api_key = request.headers.get("x-api-key")
+    if api_key is not None and api_key in api_keys:
+        return api_keys[api_key]
+    if trust_forwarded and "x-forwarded-for" in request.headers:
+        # the proxy appends the address it sees, the entries before it are sent by the client
+        return request.headers["x-forwarded-for"].split(",")[-1].strip()
+    if request.client is not None:
+        return request.client.host
+    return "unknown"
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second, 0: unlimited
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """ returns 0 if a token was taken, else the seconds until the next one is available """
+        if self.rate <= 0:
+            return 0.0
+        self.refill()
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class Client(object):
+    def __init__(self, client_id, weight, max_concurrency, bucket):
+        self.client_id = client_id
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.bucket = bucket
+        self.queue = deque()  # (tag, future)
+        self.running = 0
+        self.last_tag = 0.0
+
+        self.n_queries = 0
+        self.n_rate_limited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.last_used = time.time()
+
+    @property
+    def idle(self):
+        return self.running == 0 and len(self.queue) == 0
+
+    def stats(self):
+        return {
+            "weight": self.weight,
+            "running": self.running,
+            "queued": len(self.queue),
+            "queries": self.n_queries,
+            "rate_limited": self.n_rate_limited,
+            "mean_wait_time": self.wait_time / self.n_queries if self.n_queries > 0 else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "tokens": self.bucket.tokens
+        }
+
+
+class FairScheduler(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.max_concurrency = int(self.config["SCHEDULER_MAX_CONCURRENCY"])
+        self.client_max_concurrency = int(self.config["CLIENT_MAX_CONCURRENCY"])
+        self.client_rate = float(self.config["CLIENT_RATE"])  # requests per second, 0: unlimited
+        self.client_burst = int(self.config["CLIENT_BURST"])
+        self.max_clients = int(self.config["SCHEDULER_MAX_CLIENTS"])
+        self.weights = parse_mapping(self.config["CLIENT_WEIGHTS"], float)
+        self.api_keys = {key: name for name, key in parse_mapping(self.config["CLIENT_API_KEYS"]).items()}
+
+        self.clients = {}
+        self.running = 0
+        self.virtual_time = 0.0
+
+    def get_client(self, client_id):
+        client = self.clients.get(client_id)
+        if client is None:
+            if len(self.clients) >= self.max_clients:
+                self._forget_idle_clients()
+            client = Client(
+                client_id,
+                self.weights.get(client_id, 1.0),
+                self.client_max_concurrency,
+                TokenBucket(self.client_rate, self.client_burst)
+            )
+            self.clients[client_id] = client
+        client.last_used = time.time()
+        return client
+
+    def _forget_idle_clients(self):
+        # the least recently used half of the idle clients, their buckets are refilled by then
+        idle = sorted((c for c in self.clients.values() if c.idle), key=lambda c: c.last_used)
+        for client in idle[:max(1, len(idle) // 2)]:
+            del self.clients[client.client_id]
+
+    def _get_tag(self, client):
+        tag = max(self.virtual_time, client.last_tag) + 1.0 / client.weight
+        client.last_tag = tag
+        return tag
+
+    def _dispatch(self):
+        """ starts waiting queries while slots are free, lowest finish tag first """
+        while self.running < self.max_concurrency:
+            candidates = [
+                c for c in self.clients.values()
+                if len(c.queue) > 0 and c.running < c.max_concurrency
+            ]
+            if len(candidates) == 0:
+                return
+            client = min(candidates, key=lambda c: c.queue[0][0])
+            tag, future = client.queue.popleft()
+            if future.done():
+                # cancelled while waiting
+                continue
+            self.virtual_time = max(self.virtual_time, tag - 1.0 / client.weight)
+            self.running += 1
+            client.running += 1
+            future.set_result(None)
+
+    def check_rate(self, client_id):
+        """ takes a token of the client, raises RateLimited if there is none """
+        client = self.get_client(client_id)
+        retry_after = client.bucket.take()
+        if retry_after > 0:
+            client.n_rate_limited += 1
+            raise RateLimited("too many requests, please slow down", retry_after)
+
+    async def acquire(self, client_id):
+        client = self.get_client(client_id)
+        start = time.time()
+        tag = self._get_tag(client)
+        future = asyncio.get_event_loop().create_future()
+        client.queue.append((tag, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted just before the cancellation
+                self.release(client_id)
+            else:
+                try:
+                    client.queue.remove((tag, future))
+                except ValueError:
+                    pass
+            raise
+        wait_time = time.time() - start
+        client.n_queries += 1
+        client.wait_time += wait_time
+        client.max_wait_time = max(client.max_wait_time, wait_time)
+        if wait_time > 1.0:
+            self.logger.debug("query of client %s waited %f s for a slot", client_id, wait_time)
+
+    def release(self, client_id):
+        client = self.clients[client_id]
+        client.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": sum(len(c.queue) for c in self.clients.values()),
+            "max_concurrency": self.max_concurrency,
+            "clients": {c.client_id: c.stats() for c in self.clients.values()}
+        }
+
+
+class ScheduledConnection(object):
+    """ runs the queries of the DB connection through the scheduler, everything else is passed through """
+    def __init__(self, DBConnection, scheduler):
+        self.DBConnection = DBConnection
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.DBConnection, name)
+
+    async def execute_query_async(self, *args, **kwargs):
+        client_id = current_client.get()
+        if client_id is None:
+            return await self.DBConnection.execute_query_async(*args, **kwargs)
+        await self.scheduler.acquire(client_id)
+        try:
+            return await self.DBConnection.execute_query_async(*args, **kwargs)
+        finally:
+            self.scheduler.release(client_id)
+
+    async def stream_query_async(self, *args, **kwargs):
+        client_id = current_client.get()
+        if client_id is not None:
+            await self.scheduler.acquire(client_id)
+        try:
+            async for event in self.DBConnection.stream_query_async(*args, **kwargs):
+                yield event
+        finally:
+            if client_id is not None:
+                self.scheduler.release(client_id)
+
+    async def execute_query_batches_async(self, *args, **kwargs):
+        client_id = current_client.get()
+        if client_id is not None:
+            await self.scheduler.acquire(client_id)
+        try:
+            async for batch in self.DBConnection.execute_query_batches_async(*args, **kwargs):
+                yield batch
+        finally:
+            if client_id is not None:
+                self.scheduler.release(client_id)
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+
+from bulk import run_chunked
+
+
+"""
+Time-sliced lookups
+
+A lookup over a long interval is split into windows (days, weeks or months)
+that are queried concurrently, each as a join over its own partitions only.
+The grouped rows of the slices are merged as the slices complete: rows of the
+same group are combined to one with the earliest first_ts, the latest last_ts
+and the union of the record names. A slice that fails is skipped and listed in
+failed_slices of the (then partial) result. The limit applies to every slice,
+so a slice that returns limit rows may have left out rows of groups that other
+slices return; the merged first_ts/last_ts of such groups can be off, which is
+flagged with truncated.
+"""
+
+WINDOWS = ("day", "week", "month")
+
+# how the rows of the lookups that can be sliced are merged
+MERGE_SPECS = {
+    "ips_by_domains": {
+        "group_columns": ("domain_name", "record_type", "ip_address", "asn", "country"),
+        "min_columns": ("first_ts", ),
+        "max_columns": ("last_ts", ),
+        "union_columns": ("record_names", ),
+        "order_by": "domain_name"
+    }
+}
+
+
+def get_slices(date_from, date_to, window):
+    """ splits the interval into days, weeks (Monday to Sunday) or calendar months """
+    if window not in WINDOWS:
+        raise ValueError("unknown window '%s'" % window)
+    slices = []
+    start = date_from
+    while start <= date_to:
+        if window == "day":
+            end = start
+        elif window == "week":
+            end = start + datetime.timedelta(days=6 - start.weekday())
+        else:
+            next_month = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+            end = next_month - datetime.timedelta(days=1)
+        end = min(end, date_to)
+        slices.append((start, end))
+        start = end + datetime.timedelta(days=1)
+    return slices
+
+
+class RowMerger(object):
+    def __init__(self, group_columns, min_columns=(), max_columns=(), union_columns=(), order_by=None, limit=0):
+        self.group_columns = group_columns
+        self.min_columns = min_columns
+        self.max_columns = max_columns
+        self.union_columns = union_columns
+        self.order_by = order_by
+        self.limit = limit
+
+        self.groups = {}  # group -> merged row
+        self.unions = {}  # group -> {column: set of values}
+
+    def add(self, rows):
+        for row in rows:
+            group = tuple(row.get(column) for column in self.group_columns)
+            merged = self.groups.get(group)
+            if merged is None:
+                self.groups[group] = dict(row)
+                self.unions[group] = {
+                    column: set(row[column].split(',')) if row.get(column) else set()
+                    for column in self.union_columns
+                }
+                continue
+            for column in self.min_columns:
+                if merged.get(column) is None or (row.get(column) is not None and row[column] < merged[column]):
+                    merged[column] = row.get(column)
+            for column in self.max_columns:
+                if merged.get(column) is None or (row.get(column) is not None and row[column] > merged[column]):
+                    merged[column] = row.get(column)
+            for column in self.union_columns:
+                if row.get(column):
+                    values = self.unions[group][column]
+                    n_values = len(values)
+                    values.update(row[column].split(','))
+                    if len(values) > n_values:
+                        merged[column] = ','.join(sorted(values))
+
+    def get_rows(self):
+        """ the merged rows in order, at most limit (0: all) """
+        rows = list(self.groups.values())
+        if self.order_by is not None:
+            rows.sort(key=lambda row: (row.get(self.order_by) is not None, row.get(self.order_by) or ""))
+        if self.limit > 0:
+            rows = rows[:self.limit]
+        return rows
+
+
+async def run_sliced(lookup, slices, max_concurrency, merger, on_event=None, progressive=False):
+    """ runs lookup(date_from, date_to) for all slices, at most max_concurrency at a time, and merges the results
+
+    on_event(event, value) is awaited with "progress" after every completed slice and,
+    if progressive, with "merged" and the running merged rows. Raises the error of the
+    first slice if all slices failed.
+    """
+    results_dict = {
+        'slices': slices,
+        'query_time': 0.0,
+        'fetch_time': 0.0
+    }
+    absent = {}  # e.g. absent_domains -> inputs that are absent in all slices
+    truncated = False
+    failed = []
+    errors = []
+    n_done = 0
+
+    async def _lookup(slice_):
+        try:
+            return await lookup(*slice_)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return e
+
+    async for i, results in run_chunked(_lookup, slices, max_concurrency):
+        n_done += 1
+        if isinstance(results, Exception):
+            failed.append(slices[i])
+            errors.append(results)
+        else:
+            rows = results.get("rows", [])
+            if merger.limit > 0 and len(rows) >= merger.limit:
+                truncated = True
+            merger.add(rows)
+            results_dict['query_time'] += results.get('query_time', 0.0)
+            results_dict['fetch_time'] += results.get('fetch_time', 0.0)
+            for key, values in results.items():
+                if key.startswith("absent_"):
+                    absent[key] = set(values) if key not in absent else absent[key] & set(values)
+        if on_event is not None:
+            await on_event("progress", {
+                "state": "running",
+                "slices_total": len(slices),
+                "slices_done": n_done,
+                "slices_failed": len(failed),
+                "rows": len(merger.groups)
+            })
+            if progressive:
+                await on_event("merged", merger.get_rows())
+
+    if len(slices) > 0 and len(failed) == len(slices):
+        raise errors[0]
+    results_dict['rows'] = merger.get_rows()
+    results_dict['truncated'] = truncated or len(merger.groups) > len(results_dict['rows'])
+    for key, values in absent.items():
+        results_dict[key] = sorted(values)
+    if len(failed) > 0:
+        results_dict['failed_slices'] = sorted(failed)
+    if len(results_dict['rows']) > 0:
+        results_dict['columns'] = list(results_dict['rows'][0].keys())
+    return results_dict
@@ -0,0 +1,174 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+
+from cache import encode_results, decode_results
+
+
+"""
+Result snapshots for server-side processing in the web UI
+
+A snapshot keeps the rows of a lookup in SNAPSHOT_DIR under a result id, so
+the web UI can page, sort and filter it with the DataTables server-side
+protocol (see datatables_page) from any worker, transferring only the visible
+page. Every worker keeps the last used snapshots and their filtered and sorted
+views in memory, so paging through a large result does not sort it again.
+Coroutines use the *_async methods, which read, write, filter and sort in the
+default executor.
+"""
+
+
+def _sort_key(value):
+    # None first, values of different types are compared as strings
+    return (value is not None, value if value is not None else 0)
+
+
+def _parse_datatables_params(params):
+    """ parses the flat DataTables request parameters (columns[0][data], order[0][dir], ...) """
+    columns = []
+    i = 0
+    while "columns[%i][data]" % i in params:
+        columns.append({
+            "data": params["columns[%i][data]" % i],
+            "searchable": params.get("columns[%i][searchable]" % i, "true") == "true",
+            "orderable": params.get("columns[%i][orderable]" % i, "true") == "true",
+            "search": params.get("columns[%i][search][value]" % i, "").strip().lower()
+        })
+        i += 1
+    order = []
+    i = 0
+    while "order[%i][column]" % i in params:
+        column = int(params["order[%i][column]" % i])
+        if 0 <= column < len(columns) and columns[column]["orderable"]:
+            order.append((columns[column]["data"], params.get("order[%i][dir]" % i, "asc") == "desc"))
+        i += 1
+    return {
+        "draw": int(params.get("draw", 0)),
+        "start": max(0, int(params.get("start", 0))),
+        "length": int(params.get("length", 10)),
+        "search": params.get("search[value]", "").strip().lower(),
+        "columns": columns,
+        "order": order
+    }
+
+
+def filter_and_sort(rows, search, columns, order):
+    """ returns the rows matching the global and the per-column searches (case insensitive substrings) in order """
+    searchable = [column["data"] for column in columns if column["searchable"]]
+    column_searches = [(column["data"], column["search"]) for column in columns if column["search"]]
+    if search or column_searches:
+        def matches(row):
+            if search and not any(search in str(row.get(column, "")).lower() for column in searchable):
+                return False
+            return all(value in str(row.get(column, "")).lower() for column, value in column_searches)
+        rows = [row for row in rows if matches(row)]
+    else:
+        rows = list(rows)
+    # stable sorts from the least to the most significant column
+    for column, descending in reversed(order):
+        try:
+            rows.sort(key=lambda row: _sort_key(row.get(column)), reverse=descending)
+        except TypeError:
+            rows.sort(key=lambda row: _sort_key(None if row.get(column) is None else str(row.get(column))),
+                      reverse=descending)
+    return rows
+
+
+class SnapshotStore(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.snapshot_dir = self.config["SNAPSHOT_DIR"]
+        self.ttl = float(self.config["SNAPSHOT_TTL"])  # seconds
+        self.cache_size = int(self.config["SNAPSHOT_CACHE_SIZE"])
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+        self._snapshots = OrderedDict()  # result id -> rows
+        self._views = OrderedDict()  # (result id, search, columns searches, order) -> filtered and sorted rows
+        # used by the executor threads, one at a time
+        self.lock = threading.Lock()
+
+    def _get_filename(self, result_id):
+        # result ids are generated by create(), anything else is rejected
+        if not all(c in "0123456789abcdef" for c in result_id):
+            raise KeyError(result_id)
+        return os.path.join(self.snapshot_dir, "%s.snapshot" % result_id)
+
+    def _remember(self, entries, key, value, max_entries):
+        with self.lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def create(self, results):
+        self.cleanup()
+        result_id = uuid.uuid4().hex
+        filename = self._get_filename(result_id)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(encode_results({"rows": results.get("rows", [])}))
+        os.rename(filename + ".tmp", filename)
+        self._remember(self._snapshots, result_id, results.get("rows", []), self.cache_size)
+        return result_id
+
+    def get_rows(self, result_id):
+        with self.lock:
+            rows = self._snapshots.get(result_id)
+        if rows is None:
+            try:
+                with open(self._get_filename(result_id), "rb") as f:
+                    rows = decode_results(f.read())["rows"]
+            except (IOError, OSError, ValueError):
+                raise KeyError(result_id)
+        self._remember(self._snapshots, result_id, rows, self.cache_size)
+        return rows
+
+    def datatables_page(self, result_id, params):
+        """ answers a DataTables server-side processing request, raises KeyError for unknown results """
+        rows = self.get_rows(result_id)
+        request = _parse_datatables_params(params)
+        view_key = (
+            result_id,
+            request["search"],
+            tuple((column["data"], column["search"]) for column in request["columns"] if column["search"]),
+            tuple(request["order"])
+        )
+        with self.lock:
+            view = self._views.get(view_key)
+        if view is None:
+            view = filter_and_sort(rows, request["search"], request["columns"], request["order"])
+        self._remember(self._views, view_key, view, self.cache_size)
+        if request["length"] < 0:
+            # -1: all rows
+            page = view[request["start"]:]
+        else:
+            page = view[request["start"]:request["start"] + request["length"]]
+        return {
+            "draw": request["draw"],
+            "recordsTotal": len(rows),
+            "recordsFiltered": len(view),
+            "data": page
+        }
+
+    async def create_async(self, results):
+        return await asyncio.get_event_loop().run_in_executor(None, self.create, results)
+
+    async def get_rows_async(self, result_id):
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_rows, result_id)
+
+    async def datatables_page_async(self, result_id, params):
+        return await asyncio.get_event_loop().run_in_executor(None, self.datatables_page, result_id, params)
+
+    def cleanup(self):
+        limit = time.time() - self.ttl
+        for filename in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, filename)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
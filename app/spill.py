@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import asyncio
+import tempfile
+
+from cache import _encode_object, _decode_object
+
+
+"""
+Memory-bounded results
+
+SpillingConnection stands in for the DB connection of a lookup and fetches
+the rows in batches. As long as the estimated size of the rows stays within
+the budget of the request (RESULT_MEMORY_REQUEST_LIMIT) and of the worker
+(RESULT_MEMORY_WORKER_LIMIT, shared by all requests of the worker) they are
+kept in memory, beyond that all rows of the result are moved to a temporary
+file in SPILL_DIR (one JSON list of values per row) and the result contains a
+SpilledRows object instead of the list of rows. It is read back through mmap
+in batches, so the response can be streamed from it (StreamingResponse
+iterates in its threadpool), single rows are read at their offsets.
+"""
+
+
+def estimate_size(rows):
+    """ estimated resident size of a batch of dict rows in bytes, from the first row """
+    if len(rows) == 0:
+        return 0
+    row = rows[0]
+    row_size = sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+    return row_size * len(rows) + sys.getsizeof(rows)
+
+
+class SpilledRows(object):
+    """ rows in a temporary file, the file is removed when it is closed
+
+    extend() blocks on the file, SpillingConnection calls it in the default executor
+    """
+    def __init__(self, directory):
+        self.file = tempfile.TemporaryFile(dir=directory, prefix="result-")
+        self.columns = None
+        self.offsets = array.array('Q')  # of the rows in the file
+        self.n_rows = 0
+        self.n_bytes = 0
+
+    def extend(self, rows):
+        if len(rows) == 0:
+            return
+        if self.columns is None:
+            self.columns = list(rows[0].keys())
+        lines = [
+            (json.dumps([row[column] for column in self.columns], separators=(',', ':'), default=_encode_object)
+             + "\n").encode("utf-8")
+            for row in rows
+        ]
+        offset = self.n_bytes
+        for line in lines:
+            self.offsets.append(offset)
+            offset += len(line)
+        self.file.write(b"".join(lines))
+        self.n_rows += len(rows)
+        self.n_bytes = offset
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n_rows
+        if not 0 <= index < self.n_rows:
+            raise IndexError(index)
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < self.n_rows else self.n_bytes
+        self.file.flush()
+        line = os.pread(self.file.fileno(), end - start, start)
+        return dict(zip(self.columns, json.loads(line, object_hook=_decode_object)))
+
+    def __iter__(self):
+        for batch in self.iter_batches(1000):
+            for row in batch:
+                yield row
+
+    def iter_batches(self, batch_size):
+        if self.n_bytes == 0:
+            return
+        self.file.flush()
+        view = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            batch = []
+            for line in iter(view.readline, b""):
+                batch.append(dict(zip(self.columns, json.loads(line, object_hook=_decode_object))))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+        finally:
+            view.close()
+
+    def close(self):
+        self.file.close()
+
+
+def iter_batches(rows, batch_size):
+    """ yields batches of a list of rows or of SpilledRows """
+    if isinstance(rows, SpilledRows):
+        for batch in rows.iter_batches(batch_size):
+            yield batch
+        return
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+class ResultMemory(object):
+    """ accounts the estimated memory of the results of a worker """
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.request_limit = int(self.config["RESULT_MEMORY_REQUEST_LIMIT"])  # bytes, 0: unlimited
+        self.worker_limit = int(self.config["RESULT_MEMORY_WORKER_LIMIT"])  # bytes, 0: unlimited
+        self.spill_dir = self.config["SPILL_DIR"]
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self.resident = 0
+        self.peak_resident = 0
+        self.n_spills = 0
+        self.spilled_rows = 0
+        self.spilled_bytes = 0
+
+    def reserve(self, n_bytes, request_bytes):
+        """ returns False if n_bytes more would exceed the budget of the request or the worker """
+        if 0 < self.request_limit < request_bytes + n_bytes:
+            return False
+        if 0 < self.worker_limit < self.resident + n_bytes:
+            return False
+        self.resident += n_bytes
+        self.peak_resident = max(self.peak_resident, self.resident)
+        return True
+
+    def release(self, n_bytes):
+        self.resident -= n_bytes
+
+    def spill(self, rows):
+        spilled = SpilledRows(self.spill_dir)
+        spilled.extend(rows)
+        self.n_spills += 1
+        return spilled
+
+    def stats(self):
+        return {
+            "resident": self.resident,
+            "peak_resident": self.peak_resident,
+            "request_limit": self.request_limit,
+            "worker_limit": self.worker_limit,
+            "spills": self.n_spills,
+            "spilled_rows": self.spilled_rows,
+            "spilled_bytes": self.spilled_bytes
+        }
+
+
+class SpillingConnection(object):
+    def __init__(self, DBConnection, memory):
+        self.DBConnection = DBConnection
+        self.memory = memory
+        self.reserved = 0  # bytes of the rows of this request kept in memory
+
+    async def execute_query_async(self, query, parameters=None, configuration=None, query_name=None):
+        loop = asyncio.get_event_loop()
+        rows = []
+        spilled = None
+        query_time_start = time.time()
+        dt_query = None
+        try:
+            async for event, value in self.DBConnection.stream_query_async(
+                    query, parameters, configuration, query_name=query_name):
+                if event != "rows":
+                    continue
+                if dt_query is None:
+                    dt_query = time.time() - query_time_start
+                if spilled is None:
+                    n_bytes = estimate_size(value)
+                    if self.memory.reserve(n_bytes, self.reserved):
+                        self.reserved += n_bytes
+                        rows.extend(value)
+                        continue
+                    self.memory.logger.info("spilling result of '%s' to disk after %i rows" % (query_name, len(rows)))
+                    spilled = await loop.run_in_executor(None, self.memory.spill, rows)
+                    rows = None
+                    self.release()
+                await loop.run_in_executor(None, spilled.extend, value)
+        except BaseException:
+            if spilled is not None:
+                spilled.close()
+            raise
+        if dt_query is None:
+            dt_query = time.time() - query_time_start
+        results = {
+            'rows': rows,
+            'query_time': dt_query,
+            'fetch_time': time.time() - query_time_start - dt_query
+        }
+        if spilled is not None:
+            self.memory.spilled_rows += spilled.n_rows
+            self.memory.spilled_bytes += spilled.n_bytes
+            results['rows'] = spilled
+            results['spilled'] = True
+        return results
+
+    def release(self):
+        """ returns the memory of the rows to the budget of the worker """
+        self.memory.release(self.reserved)
+        self.reserved = 0
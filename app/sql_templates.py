@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+from config import config
+
+
+"""
+SQL templates
+
+The text of a lookup query only depends on its shape: the lengths of its IN
+lists and OR lists, which are padded to the next power of two by repeating
+the last value, and a few flags (e.g. whether there is a LIMIT). The date
+clause has the same form for all intervals (see get_date_where_clause). So
+a lookup builds the text of a shape only once per worker and the number of
+distinct statements (e.g. in the query profiles of the cluster) stays small.
+Up to SQL_TEMPLATE_CACHE_SIZE texts are kept.
+"""
+
+
+def get_bucket_size(n):
+    """ the next power of two that is at least n """
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def pad_values(values):
+    """ pads a non-empty list to the bucket size of its length by repeating its last value """
+    values = list(values)
+    return values + [values[-1]] * (get_bucket_size(len(values)) - len(values))
+
+
+def get_placeholders(name, n):
+    """ the placeholders name0, name1, ... of n parameters """
+    return ','.join('%%(%s%i)s' % (name, i) for i in range(n))
+
+
+def get_params(name, values):
+    return {'%s%i' % (name, i): value for i, value in enumerate(values)}
+
+
+class TemplateCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.texts = OrderedDict()  # (query_name, shape) -> text
+        self.shapes = dict()  # query_name -> set of shapes
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, query_name, shape, build):
+        """ returns the text of the query of that shape, build() creates it if it is not cached """
+        key = (query_name, shape)
+        text = self.texts.get(key)
+        if text is not None:
+            self.texts.move_to_end(key)
+            self.n_hits += 1
+            return text
+        self.n_misses += 1
+        text = build()
+        self.shapes.setdefault(query_name, set()).add(shape)
+        if self.max_size > 0:
+            self.texts[key] = text
+            while len(self.texts) > self.max_size:
+                self.texts.popitem(last=False)
+        return text
+
+    def stats(self):
+        return {
+            "templates": len(self.texts),
+            "hits": self.n_hits,
+            "misses": self.n_misses,
+            # distinct statements per query name since the start
+            "shapes": {query_name: len(shapes) for query_name, shapes in sorted(self.shapes.items())}
+        }
+
+
+templates = TemplateCache(int(config["SQL_TEMPLATE_CACHE_SIZE"]))
@@ -0,0 +1,59 @@
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+
+"""
+Server-Sent Events for long lookups
+
+StreamingConnection stands in for the DB connection of a lookup function and
+forwards the progress of the query and the row batches as they are fetched to
+a bounded queue (QUEUE_SIZE events, fetching waits for a slow client), from
+which the SSE endpoint sends them to the client. The lookup functions do not
+filter the rows after the query, so the streamed rows are those of the
+result. Results that are kept as snapshot (for paging) are not sent, only the
+number of rows fetched so far ('fetched' events). Time-sliced lookups send the
+progress of the slices instead (and, if progressive, the merged rows as
+'merged' events), their rows follow once all slices are merged.
+"""
+
+QUEUE_SIZE = 16
+
+
+def format_sse(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(jsonable_encoder(data)))
+
+
+class StreamingConnection(object):
+    def __init__(self, DBConnection, queue, progressive=False, send_rows=True):
+        self.DBConnection = DBConnection
+        self.queue = queue
+        self.progressive = progressive  # time-sliced lookups send the running merged rows
+        self.send_rows = send_rows  # else only the number of fetched rows
+        self.n_rows = 0  # rows forwarded to the queue
+
+    async def publish(self, event, value):
+        await self.queue.put((event, value))
+
+    async def execute_query_async(self, query, parameters=None, configuration=None, query_name=None):
+        rows = []
+        query_time_start = time.time()
+        dt_query = None
+        async for event, value in self.DBConnection.stream_query_async(
+                query, parameters, configuration, query_name=query_name):
+            if event == "rows":
+                if dt_query is None:
+                    dt_query = time.time() - query_time_start
+                rows.extend(value)
+                self.n_rows += len(value)
+                if not self.send_rows:
+                    event, value = "fetched", {"rows": self.n_rows}
+            await self.queue.put((event, value))
+        if dt_query is None:
+            dt_query = time.time() - query_time_start
+        return {
+            'rows': rows,
+            'query_time': dt_query,
+            'fetch_time': time.time() - query_time_start - dt_query
+        }
@@ -0,0 +1,168 @@
+import time
+import random
+import asyncio
+import datetime
+import ipaddress
+
+
+"""
+Stand-in for HadoopDBConnection that answers every query with synthetic
+rows after a configurable delay. It is used for load tests and local
+development without access to an impala cluster (DBBACKEND=stub).
+"""
+
+_COLUMNS = {
+    "openintel_domains_by_ips": [
+        "ip_address", "asn", "pointing_query_name", "pointing_response_name", "query_name",
+        "response_name", "pointing_record_type", "pointing_record_field", "first_ts", "last_ts"
+    ],
+    "openintel_ips_by_domains": [
+        "domain_name", "record_type", "record_names", "ip_address", "asn", "country", "first_ts", "last_ts"
+    ],
+    "openintel_ips_by_mx_pattern": [
+        "query_name", "response_name", "mx_address", "query_type", "ip_address", "first_ts", "last_ts"
+    ],
+    "openintel_measurements_by_name_and_ip_pair": [
+        "query_name", "response_name", "query_type", "response_type", "ip4_address", "ip6_address", "ts"
+    ],
+    "openintel_measurements_collapsed": [
+        "query_name", "response_name", "query_type", "response_type", "ip4_address", "ip6_address",
+        "first_seen", "last_seen", "count"
+    ],
+    "openintel_records_summary": [
+        "query_name", "response_name", "query_type", "response_type", "ip4_address", "ip6_address",
+        "first_seen", "last_seen", "measurements"
+    ],
+    "openintel_references": ["name", "record_type", "target", "first_ts", "last_ts"],
+    "openintel_changes": ["domain_name", "record_type", "target", "change"],
+    "existence_filter_query_name": ["value"],
+    "existence_filter_ip4_address": ["value"],
+    "existence_filter_ip6_address": ["value"],
+}
+
+_DEFAULT_COLUMNS = ["query_name", "query_type", "ip4_address", "ts"]
+
+
+class StubDBConnection(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.query_delay = float(self.config["STUB_QUERY_DELAY"])  # seconds
+        self.query_delay_jitter = float(self.config["STUB_QUERY_DELAY_JITTER"])  # seconds
+        self.n_rows = int(self.config["STUB_N_ROWS"])
+        self.first_day = datetime.date.fromisoformat(self.config["STUB_FIRST_DAY"])
+
+    async def open_pool(self, n_connections=None):
+        pass
+
+    def close_pool(self):
+        pass
+
+    async def run_health_checks(self):
+        pass
+
+    def stats(self):
+        return {"backend": "stub"}
+
+    def _get_n_rows(self, params):
+        n_rows = self.n_rows
+        if isinstance(params, dict) and "limit" in params:
+            n_rows = min(n_rows, int(params["limit"]))
+        return n_rows
+
+    def _get_delay(self):
+        return max(0.0, self.query_delay + random.uniform(-1.0, 1.0) * self.query_delay_jitter)
+
+    def _make_value(self, column, i):
+        if column.endswith("_ts") or column in ("ts", "first_seen", "last_seen"):
+            return datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=i)
+        if column in ("ip_address", "ip4_address", "value"):
+            return str(ipaddress.IPv4Address(0x0a000000 + i))
+        if column == "ip6_address":
+            return None
+        if column == "asn":
+            return 64496 + (i % 16)
+        if column in ("count", "measurements"):
+            return 1 + i % 30
+        if column == "country":
+            return "AT"
+        if column.endswith("type"):
+            return "A"
+        if column.endswith("field"):
+            return "query_name"
+        return "name%i.example.at" % i
+
+    def make_partitions(self):
+        rows = []
+        day = self.first_day
+        while day < datetime.date.today():
+            rows.append({
+                "year": str(day.year), "month": str(day.month), "day": str(day.day),
+                "#Rows": self.n_rows, "#Files": 1, "Size": "1.00MB"
+            })
+            day += datetime.timedelta(days=1)
+        rows.append({"year": "Total", "month": "", "day": "", "#Rows": self.n_rows * len(rows), "#Files": len(rows), "Size": ""})
+        return rows
+
+    def make_rows(self, query_name, n_rows):
+        if query_name == "show_partitions":
+            return self.make_partitions()
+        columns = _COLUMNS.get(query_name, _DEFAULT_COLUMNS)
+        return [
+            {column: self._make_value(column, i) for column in columns}
+            for i in range(n_rows)
+        ]
+
+    def execute_query(self, *args, **kwargs):
+        query_name = kwargs.pop('query_name', None)
+        params = kwargs.get('parameters', args[1] if len(args) >= 2 else None)
+        query_time_start = time.time()
+        time.sleep(self._get_delay())
+        dt_query = time.time() - query_time_start
+        fetch_time_start = time.time()
+        rows = self.make_rows(query_name, self._get_n_rows(params))
+        return {
+            'rows': rows,
+            'query_time': dt_query,
+            'fetch_time': time.time() - fetch_time_start
+        }
+
+    async def execute_query_async(self, *args, **kwargs):
+        query_name = kwargs.pop('query_name', None)
+        params = kwargs.get('parameters', args[1] if len(args) >= 2 else None)
+        self.logger.debug("executing query (stub) '%s'", query_name)
+        query_time_start = time.time()
+        await asyncio.sleep(self._get_delay())
+        dt_query = time.time() - query_time_start
+        fetch_time_start = time.time()
+        rows = self.make_rows(query_name, self._get_n_rows(params))
+        return {
+            'rows': rows,
+            'query_time': dt_query,
+            'fetch_time': time.time() - fetch_time_start
+        }
+
+    async def stream_query_async(self, query, parameters=None, configuration=None, batch_size=None, query_name=None):
+        if batch_size is None:
+            batch_size = int(self.config["FETCH_BATCH_SIZE"])
+        delay = self._get_delay()
+        start = time.time()
+        n_steps = 4
+        for i in range(n_steps):
+            yield "progress", {
+                "state": "running",
+                "elapsed": time.time() - start,
+                "completed_scan_ranges": i,
+                "total_scan_ranges": n_steps
+            }
+            await asyncio.sleep(delay / n_steps)
+        rows = self.make_rows(query_name, self._get_n_rows(parameters))
+        for i in range(0, len(rows), batch_size):
+            yield "rows", rows[i:i + batch_size]
+
+    async def execute_query_batches_async(self, query, parameters=None, batch_size=None, query_name=None):
+        async for event, value in self.stream_query_async(
+                query, parameters, batch_size=batch_size, query_name=query_name):
+            if event == "rows":
+                yield value
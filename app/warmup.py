@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+
+from cache import normalize_inputs
+
+
+"""
+Warm-up and cache pre-population
+
+Warmer opens the connection pool and runs EXPLAIN for every query template at
+startup, so the first requests after a deploy neither pay the connection setup
+nor the cold metadata loading on the coordinator. When the partition catalog
+reports a new day, cached results including that day are dropped and the most
+popular lookups of the previous day (tracked by HotKeyTracker) are executed for
+the new day, so the morning rush is served from the result cache. With the shared cache tier the
+lookup counts of all workers are merged and only one worker prefetches.
+"""
+
+# inputs for the EXPLAIN probes, the values do not matter
+PROBE_INPUTS = {
+    "domains_by_ips": ["192.0.2.1", "2001:db8::1"],
+    "ips_by_domains": ["example.com"],
+    "ips_by_mx_pattern": "%.example.com",
+    "measurements_by_domain": "example.com",
+    "references": ["example.com"],
+    "changes": ["example.com"],
+    "records_summary": "example.com",
+}
+
+
+class SpaceSaving(object):
+    """ top-k heavy hitters with bounded memory (Metwally et al., Space-Saving) """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = dict()
+
+    def add(self, item):
+        if item in self.counts:
+            self.counts[item] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = 1
+        else:
+            min_item = min(self.counts, key=self.counts.get)
+            self.counts[item] = self.counts.pop(min_item) + 1
+
+    def top(self, k):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class HotKeyTracker(object):
+    """ counts lookups of the latest loaded day with their interval relative to that day """
+    def __init__(self, capacity):
+        self.sketch = SpaceSaving(capacity)
+
+    def record(self, lookup_type, inputs, date_from, date_to, limit, options, latest_day):
+        if latest_day is None or date_to != latest_day:
+            return
+        self.sketch.add((
+            lookup_type,
+            normalize_inputs(inputs),
+            (date_from - latest_day).days,
+            int(limit),
+            tuple(sorted(options.items()))
+        ))
+
+    def top(self, k):
+        return [key for key, _ in self.sketch.top(k)]
+
+    def drain(self):
+        """ returns all (key, count) pairs and resets the tracker """
+        counts = self.sketch.top(len(self.sketch))
+        self.reset()
+        return counts
+
+    def reset(self):
+        self.sketch = SpaceSaving(self.sketch.capacity)
+
+
+class ExplainConnection(object):
+    """ runs EXPLAIN instead of the query, used to warm up the coordinator's metadata """
+    def __init__(self, DBConnection):
+        self.DBConnection = DBConnection
+
+    async def execute_query_async(self, query, *args, **kwargs):
+        return await self.DBConnection.execute_query_async("EXPLAIN " + query, *args, **kwargs)
+
+
+class Warmer(object):
+    def __init__(self, logger, config, DBConnection, lookups, execute_lookup, result_cache, hot_keys, catalog):
+        self.logger = logger
+        self.config = config
+        self.DBConnection = DBConnection
+        self.lookups = lookups  # lookup type -> openintel_select_* function
+        self.execute_lookup = execute_lookup
+        self.result_cache = result_cache
+        self.hot_keys = hot_keys
+        self.catalog = catalog
+
+        self.prefetch_top_k = int(self.config["PREFETCH_TOP_K"])
+        self.prefetch_concurrency = int(self.config["PREFETCH_CONCURRENCY"])
+
+        self.n_prefetched = 0
+
+    @property
+    def latest_day(self):
+        return self.catalog.latest_day
+
+    async def warm_up(self):
+        start = asyncio.get_event_loop().time()
+        await self.DBConnection.open_pool()
+        day = self.catalog.default_day()
+        explain = ExplainConnection(self.DBConnection)
+        for lookup_type, func in self.lookups.items():
+            try:
+                await func(
+                    explain,
+                    self.logger,
+                    PROBE_INPUTS[lookup_type],
+                    day,
+                    day,
+                    1
+                )
+            except Exception as e:
+                self.logger.warning("warm-up probe for %s failed - %s" % (lookup_type, str(e)))
+        self.logger.info("warm-up completed in %f s" % (asyncio.get_event_loop().time() - start))
+
+    async def prefetch(self, day):
+        semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+
+        async def _prefetch(key):
+            lookup_type, inputs, from_offset, limit, options = key
+            async with semaphore:
+                try:
+                    await self.execute_lookup(
+                        lookup_type,
+                        list(inputs) if isinstance(inputs, (tuple, list)) else inputs,
+                        day + datetime.timedelta(days=from_offset),
+                        day,
+                        limit,
+                        dict(options),
+                        track=False,
+                        guard=False
+                    )
+                    self.n_prefetched += 1
+                except Exception as e:
+                    self.logger.warning("prefetching %s failed - %s" % (lookup_type, str(e)))
+
+        if self.result_cache.shared is not None:
+            # the cache is shared, so one worker prefetches the popular lookups of all workers
+            await self.result_cache.shared.add_hot_keys_async(self.hot_keys.drain())
+            if not await self.result_cache.shared.claim_async("prefetch:%s" % day.isoformat()):
+                return
+            keys = await self.result_cache.shared.pop_hot_keys_async(self.prefetch_top_k)
+        else:
+            keys = self.hot_keys.top(self.prefetch_top_k)
+            self.hot_keys.reset()
+        self.logger.info("prefetching %i popular lookups for %s" % (len(keys), day))
+        await asyncio.gather(*[_prefetch(key) for key in keys])
+
+    async def on_catalog_refresh(self, new_days):
+        """ called by the partition catalog after every refresh """
+        if len(new_days) > 0:
+            loaded_at = await self.result_cache.mark_day_loaded_async(new_days[0])
+            await self.result_cache.invalidate_from_async(new_days[0], loaded_at)
+            if self.config["WARMUP"]:
+                await self.prefetch(new_days[-1])
+        elif self.result_cache.shared is not None:
+            await self.result_cache.shared.add_hot_keys_async(self.hot_keys.drain())
+
+    def stats(self):
+        return {
+            "latest_day": self.latest_day,
+            "hot_keys": len(self.hot_keys.sketch),
+            "prefetched": self.n_prefetched
+        }
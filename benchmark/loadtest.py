@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+"""
+Load test harness for openintel-lookup
+
+Generates input sets, then hits every API endpoint at stepped concurrency
+levels and reports p50/p95/p99 latency, throughput, error rate and the
+resident memory of the server's worker processes per endpoint. The results
+are checked against the SLO thresholds in the configuration file
+(loadtest.json) and the script exits with status 1 if any SLO is violated.
+
+To run it without an impala cluster start the service with DBBACKEND=stub,
+e.g.
+
+    cd app && DBBACKEND=stub uvicorn main:app --port 8989 --workers 4
+    python3 benchmark/loadtest.py generate
+    python3 benchmark/loadtest.py run --config benchmark/loadtest.json
+
+The service must not rate limit the load test (CLIENT_RATE=0, the default),
+429 responses are counted as errors and reported.
+
+Only the python standard library is required.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import ipaddress
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+###############################################################################
+# Input generation
+
+def generate_domains(n, seed):
+    rnd = random.Random(seed)
+    tlds = ["at", "nl", "com", "net", "org"]
+    return [
+        "%s%i.%s" % ("".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(10)), i, rnd.choice(tlds))
+        for i in range(n)
+    ]
+
+
+def generate_ips(n, seed):
+    rnd = random.Random(seed)
+    ips = []
+    for i in range(n):
+        if i % 4 == 3:
+            ips.append(ipaddress.IPv6Address((0x2001067c << 96) | rnd.getrandbits(96)).compressed)
+        else:
+            ips.append(str(ipaddress.IPv4Address(rnd.getrandbits(32))))
+    return ips
+
+
+def write_lines(path, lines):
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def cmd_generate(args):
+    domains = generate_domains(args.n_domains, args.seed)
+    ips = generate_ips(args.n_ips, args.seed)
+    write_lines(os.path.join(args.output_dir, "domains.txt"), domains)
+    write_lines(os.path.join(args.output_dir, "ips.txt"), ips)
+    # artillery payload for test.yaml
+    write_lines(os.path.join(args.output_dir, "domains.csv"), ["domain_name", ] + domains)
+    print("wrote %i domains and %i IPs to %s" % (len(domains), len(ips), args.output_dir))
+    return 0
+
+
+###############################################################################
+# Requests
+
+class Endpoint(object):
+    def __init__(self, name, method, path, batch_size=1, inputs="domains"):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.batch_size = batch_size
+        self.inputs = inputs
+
+    def make_request(self, base_url, query, inputs, rnd):
+        values = rnd.sample(inputs, min(self.batch_size, len(inputs)))
+        url = base_url + self.path.replace("{value}", urllib.parse.quote(values[0], safe=""))
+        url += "?" + urllib.parse.urlencode(query)
+        data = None
+        headers = {"Accept": "application/json, text/csv, */*"}
+        if self.method == "POST":
+            if self.inputs == "mx_pattern":
+                values = ["%." + values[0]]
+            data = json.dumps(values).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        return urllib.request.Request(url, data=data, headers=headers, method=self.method)
+
+
+ENDPOINTS = {
+    "domains_by_ip": dict(method="GET", path="/api/v1/domains_by_ip/{value}", inputs="ips"),
+    "domains_by_ips": dict(method="POST", path="/api/v1/domains_by_ips/", inputs="ips"),
+    "ips_by_domain": dict(method="GET", path="/api/v1/ips_by_domain/{value}", inputs="domains"),
+    "ips_by_domains": dict(method="POST", path="/api/v1/ips_by_domains/", inputs="domains"),
+    "ips_by_mx_pattern": dict(method="POST", path="/api/v1/ips_by_mx_pattern/", inputs="mx_pattern"),
+    "measurements_by_domain": dict(method="GET", path="/api/v1/measurements_by_domain/{value}", inputs="domains"),
+    "measurements_by_domain_csv": dict(method="GET", path="/api/v1/measurements_by_domain/{value}/csv", inputs="domains"),
+}
+
+
+###############################################################################
+# Worker memory
+
+def find_worker_pids(pattern):
+    pids = []
+    own_pid = os.getpid()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == own_pid:
+            continue
+        try:
+            with open("/proc/%s/cmdline" % entry, "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode("utf-8", "replace")
+        except (IOError, OSError):
+            continue
+        if pattern in cmdline:
+            pids.append(int(entry))
+    return pids
+
+
+def get_rss(pid):
+    """ returns the resident set size of pid in bytes or None """
+    try:
+        with open("/proc/%i/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pattern, interval=0.5):
+        super(RSSSampler, self).__init__(daemon=True)
+        self.pattern = pattern
+        self.interval = interval
+        self.max_worker_rss = 0
+        self.max_total_rss = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = [get_rss(pid) for pid in find_worker_pids(self.pattern)]
+            rss = [r for r in rss if r is not None]
+            if len(rss) > 0:
+                self.max_worker_rss = max(self.max_worker_rss, max(rss))
+                self.max_total_rss = max(self.max_total_rss, sum(rss))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+###############################################################################
+# Load steps
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def run_step(endpoint, base_url, query, inputs, concurrency, duration, timeout, seed):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker(worker_id):
+        rnd = random.Random(seed + worker_id)
+        while time.time() < deadline:
+            request = endpoint.make_request(base_url, query, inputs, rnd)
+            start = time.time()
+            error = None
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                error = "HTTP %i" % e.code
+            except Exception as e:
+                error = type(e).__name__
+            dt = time.time() - start
+            with lock:
+                if error is None:
+                    latencies.append(dt)
+                else:
+                    errors.append(error)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    n_requests = len(latencies) + len(errors)
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": len(errors),
+        "error_types": sorted(set(errors)),
+        "error_rate": (len(errors) / float(n_requests)) if n_requests > 0 else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+    }
+
+
+def _ms(value):
+    return None if value is None else value * 1000.0
+
+
+def check_slo(step, slo):
+    violations = []
+    for key in ("p50_ms", "p95_ms", "p99_ms", "error_rate"):
+        if key in slo and step[key] is not None and step[key] > slo[key]:
+            violations.append("%s %.3f > %.3f" % (key, step[key], slo[key]))
+    if "min_throughput" in slo and step["throughput"] < slo["min_throughput"]:
+        violations.append("throughput %.2f < %.2f" % (step["throughput"], slo["min_throughput"]))
+    if "max_worker_rss_mb" in slo and step.get("max_worker_rss_mb") is not None:
+        if step["max_worker_rss_mb"] > slo["max_worker_rss_mb"]:
+            violations.append("worker rss %.1f MB > %.1f MB" % (step["max_worker_rss_mb"], slo["max_worker_rss_mb"]))
+    return violations
+
+
+def print_report(report):
+    header = "%-28s %5s %7s %7s %9s %9s %9s %9s %9s  %s" % (
+        "endpoint", "conc", "reqs", "err%", "req/s", "p50 ms", "p95 ms", "p99 ms", "rss MB", "SLO"
+    )
+    print(header)
+    print("-" * len(header))
+    for name, steps in report["endpoints"].items():
+        for step in steps:
+            print("%-28s %5i %7i %7.2f %9.2f %9s %9s %9s %9s  %s" % (
+                name,
+                step["concurrency"],
+                step["requests"],
+                step["error_rate"] * 100.0,
+                step["throughput"],
+                _fmt(step["p50_ms"]),
+                _fmt(step["p95_ms"]),
+                _fmt(step["p99_ms"]),
+                _fmt(step.get("max_worker_rss_mb")),
+                "OK" if len(step["slo_violations"]) == 0 else "; ".join(step["slo_violations"])
+            ))
+
+
+def _fmt(value):
+    return "-" if value is None else "%.1f" % value
+
+
+def cmd_run(args):
+    with open(args.config) as f:
+        cfg = json.load(f)
+
+    base_url = args.target or cfg.get("target", "http://localhost:8989")
+    input_dir = os.path.dirname(os.path.abspath(args.config))
+    inputs = {
+        "domains": read_lines(os.path.join(input_dir, cfg.get("domains_file", "domains.txt"))),
+        "ips": read_lines(os.path.join(input_dir, cfg.get("ips_file", "ips.txt"))),
+    }
+    inputs["mx_pattern"] = inputs["domains"]
+
+    steps = cfg.get("concurrency_steps", [1, 2, 4, 8])
+    duration = float(cfg.get("step_duration", 10))
+    timeout = float(cfg.get("timeout", 600))
+    default_slo = cfg.get("slo", {})
+    worker_pattern = args.worker_pattern or cfg.get("worker_process_pattern")
+
+    selected = args.endpoints.split(",") if args.endpoints else list(cfg["endpoints"].keys())
+
+    report = {"target": base_url, "endpoints": {}}
+    violated = False
+    for name in selected:
+        ep_cfg = cfg["endpoints"][name]
+        spec = dict(ENDPOINTS[ep_cfg.get("type", name)])
+        spec["batch_size"] = int(ep_cfg.get("batch_size", 1))
+        endpoint = Endpoint(name, **spec)
+        query = ep_cfg.get("query", {})
+        slo = dict(default_slo)
+        slo.update(ep_cfg.get("slo", {}))
+
+        report["endpoints"][name] = []
+        for concurrency in steps:
+            sampler = None
+            if worker_pattern:
+                sampler = RSSSampler(worker_pattern)
+                sampler.start()
+            step = run_step(
+                endpoint, base_url, query, inputs[endpoint.inputs], concurrency, duration, timeout, args.seed
+            )
+            if sampler is not None:
+                sampler.stop()
+                step["max_worker_rss_mb"] = sampler.max_worker_rss / 1024.0 / 1024.0
+                step["max_total_rss_mb"] = sampler.max_total_rss / 1024.0 / 1024.0
+            step["slo_violations"] = check_slo(step, slo)
+            violated = violated or len(step["slo_violations"]) > 0
+            report["endpoints"][name].append(step)
+            if not args.quiet:
+                print("%s @ %i: %.2f req/s, p95 %s ms, %i errors" % (
+                    name, concurrency, step["throughput"], _fmt(step["p95_ms"]), step["errors"]
+                ), file=sys.stderr)
+            if "HTTP 429" in step["error_types"]:
+                print("%s @ %i: rate limited by the service, run it with CLIENT_RATE=0" % (name, concurrency),
+                      file=sys.stderr)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if violated else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="openintel-lookup load test harness")
+    subparsers = parser.add_subparsers(dest="command")
+
+    gen = subparsers.add_parser("generate", help="generate input sets")
+    gen.add_argument("--n-domains", type=int, default=10000)
+    gen.add_argument("--n-ips", type=int, default=10000)
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--output-dir", default=BENCHMARK_DIR)
+
+    run = subparsers.add_parser("run", help="run the load test")
+    run.add_argument("--config", default=os.path.join(BENCHMARK_DIR, "loadtest.json"))
+    run.add_argument("--target", help="base URL, overrides the configuration")
+    run.add_argument("--endpoints", help="comma separated list of endpoints to test (default: all)")
+    run.add_argument("--worker-pattern", help="substring of the worker command line used to sample RSS")
+    run.add_argument("--output", help="write the report as JSON to this file")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--quiet", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        return cmd_generate(args)
+    elif args.command == "run":
+        return cmd_run(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
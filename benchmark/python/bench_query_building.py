@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import DATE_RANGES, INPUT_SIZES, make_domains, make_ips, run
+
+from openintel_sql_calls import (
+    get_date_where_clause,
+    get_spec_for_clause,
+    openintel_select_domains_by_ips,
+    openintel_select_ips_by_domains,
+    openintel_select_measurements_by_name_and_ip_or_type
+)
+
+
+@pytest.mark.parametrize("date_range", sorted(DATE_RANGES.keys()))
+def bench_get_date_where_clause(benchmark, date_range):
+    date_from, date_to = DATE_RANGES[date_range]
+    benchmark(get_date_where_clause, "l1", date_from, date_to)
+
+
+@pytest.mark.parametrize("date_range", sorted(DATE_RANGES.keys()))
+def bench_get_spec_for_clause(benchmark, date_range):
+    date_from, date_to = DATE_RANGES[date_range]
+    benchmark(get_spec_for_clause, {"from": date_from, "to": date_to, "limit": 100})
+
+
+@pytest.mark.parametrize("n_domains", INPUT_SIZES)
+def bench_build_ips_by_domains(benchmark, fake_db, logger, n_domains):
+    domains = make_domains(n_domains)
+    date_from, date_to = DATE_RANGES["1y"]
+    benchmark(
+        lambda: run(openintel_select_ips_by_domains(fake_db, logger, domains, date_from, date_to, 100))
+    )
+
+
+@pytest.mark.parametrize("n_ips", INPUT_SIZES)
+def bench_build_domains_by_ips(benchmark, fake_db, logger, n_ips):
+    ips = make_ips(n_ips)
+    date_from, date_to = DATE_RANGES["1y"]
+    benchmark(
+        lambda: run(openintel_select_domains_by_ips(fake_db, logger, ips, date_from, date_to, 100))
+    )
+
+
+@pytest.mark.parametrize("date_range", sorted(DATE_RANGES.keys()))
+def bench_build_measurements_by_domain(benchmark, fake_db, logger, date_range):
+    date_from, date_to = DATE_RANGES[date_range]
+    benchmark(
+        lambda: run(openintel_select_measurements_by_name_and_ip_or_type(
+            fake_db, logger, "nic.at", date_from, date_to, 100, ip="1.2.3.4", type="A"
+        ))
+    )
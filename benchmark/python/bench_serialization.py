@@ -0,0 +1,21 @@
+import io
+import json
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from export import write_csv
+
+ROW_COUNTS = [1000, 10000, 100000]
+
+
+@pytest.mark.parametrize("n_rows", ROW_COUNTS)
+def bench_json_serialization(benchmark, measurement_rows, n_rows):
+    rows = measurement_rows[:n_rows]
+    benchmark(lambda: json.dumps(jsonable_encoder({"data": rows})))
+
+
+@pytest.mark.parametrize("n_rows", ROW_COUNTS)
+def bench_csv_export(benchmark, measurement_rows, n_rows):
+    rows = measurement_rows[:n_rows]
+    benchmark(lambda: write_csv(io.StringIO(), rows).getvalue())
@@ -0,0 +1,115 @@
+import os
+import sys
+import random
+import asyncio
+import datetime
+import ipaddress
+
+import pytest
+
+
+"""
+Fixtures for the python micro-benchmarks
+
+The benchmarks import the modules from app/ directly and replace the
+Impala connection by FakeDBConnection, so only the CPU cost of the
+python side (query building, serialization) is measured.
+"""
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
+os.environ.setdefault("DB", "openintel.measurements")
+
+END_DATE = datetime.date(2020, 11, 8)
+
+DATE_RANGES = {
+    "1d": (END_DATE, END_DATE),
+    "1w": (END_DATE - datetime.timedelta(days=7), END_DATE),
+    "1m": (END_DATE - datetime.timedelta(days=31), END_DATE),
+    "1y": (END_DATE - datetime.timedelta(days=365), END_DATE),
+    "5y": (END_DATE - datetime.timedelta(days=5 * 365), END_DATE),
+}
+
+INPUT_SIZES = [1, 100, 1000, 10000]
+
+
+class FakeDBConnection(object):
+    """ stands in for HadoopDBConnection and returns a fixed set of rows """
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else []
+
+    async def execute_query_async(self, *args, **kwargs):
+        return {
+            'rows': self.rows,
+            'query_time': 0.0,
+            'fetch_time': 0.0
+        }
+
+
+class NullLogger(object):
+    def debug(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+
+def make_domains(n, seed=0):
+    rnd = random.Random(seed)
+    tlds = ["at", "nl", "com", "net", "org"]
+    return [
+        "%s%i.example.%s" % ("".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8)), i, rnd.choice(tlds))
+        for i in range(n)
+    ]
+
+
+def make_ips(n, seed=0):
+    rnd = random.Random(seed)
+    ips = []
+    for i in range(n):
+        if i % 4 == 3:
+            ips.append(ipaddress.IPv6Address(rnd.getrandbits(128)))
+        else:
+            ips.append(ipaddress.IPv4Address(rnd.getrandbits(32)))
+    return ips
+
+
+def make_measurement_rows(n, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    rows = []
+    for i in range(n):
+        is_v4 = (i % 3) != 2
+        rows.append({
+            "query_name": "nic.at",
+            "response_name": "nic.at",
+            "query_type": "A" if is_v4 else "AAAA",
+            "response_type": "A" if is_v4 else "AAAA",
+            "ip4_address": str(ipaddress.IPv4Address(rnd.getrandbits(32))) if is_v4 else None,
+            "ip6_address": None if is_v4 else str(ipaddress.IPv6Address(rnd.getrandbits(128))),
+            "ts": start + datetime.timedelta(seconds=i * 60),
+        })
+    return rows
+
+
+@pytest.fixture
+def logger():
+    return NullLogger()
+
+
+@pytest.fixture
+def fake_db():
+    return FakeDBConnection()
+
+
+@pytest.fixture(scope="session")
+def measurement_rows():
+    return make_measurement_rows(100000)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
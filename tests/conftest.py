@@ -0,0 +1,206 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+
+"""
+Fixtures for the tests
+
+The tests import the modules from app/ directly. Nothing needs a cluster:
+the DB layer is exercised with stand-in connections and the API with the
+stub backend (DBBACKEND=stub).
+"""
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
+os.environ.setdefault("DB", "openintel.measurements")
+
+
+class NullLogger(object):
+    def isEnabledFor(self, level):
+        return False
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def warning(self, *args, **kwargs):
+        pass
+
+    def error(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def logger():
+    return NullLogger()
+
+
+@pytest.fixture
+def make_config():
+    """ the configuration of the app with some values replaced """
+    from config import config
+
+    def make_config(**kwargs):
+        return dict(config, **kwargs)
+    return make_config
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class StandInServer(object):
+    """ stands in for an impala coordinator: returns rows, can be down, slow to connect or fail queries """
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else [{"value": 1}]
+        self.down = False
+        self.connect_delay = 0.0  # seconds, connect() blocks for that long
+        self.errors = []  # raised by the next executions
+        self.fetch_errors = []  # raised by the next fetches after the first batch
+        self.n_connects = 0
+        self.queries = []
+
+
+class StandInCursor(object):
+    def __init__(self, server):
+        self.server = server
+        self.description = None
+        self.has_result_set = False
+        self.fields = None
+        self.position = 0
+
+    def execute(self, operation, parameters=None, configuration=None):
+        self.execute_async(operation, parameters, configuration)
+
+    def execute_async(self, operation, parameters=None, configuration=None):
+        self.server.queries.append((operation, parameters, configuration))
+        if len(self.server.errors) > 0:
+            raise self.server.errors.pop(0)
+        self.description = [(name, None) for name in self.server.rows[0].keys()] if self.server.rows else []
+        self.has_result_set = True
+
+    def is_executing(self):
+        return False
+
+    def get_summary(self):
+        return None
+
+    def fetchall(self):
+        return self.fetchmany(len(self.server.rows))
+
+    def fetchmany(self, size):
+        if self.position > 0 and len(self.server.fetch_errors) > 0:
+            raise self.server.fetch_errors.pop(0)
+        rows = self.server.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return [dict(row) for row in rows]
+
+    def cancel_operation(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StandInConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def cursor(self, dictify=False):
+        return StandInCursor(self.server)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def stand_in_db(logger, make_config):
+    """ returns a factory of HadoopDBConnection with stand-in coordinators ("host:port" -> StandInServer) """
+    import time
+    from db import HadoopDBConnection
+
+    class StandInDBConnection(HadoopDBConnection):
+        def __init__(self, servers, **kwargs):
+            kwargs.setdefault("RECONNECT_DELAY", 0.0)
+            kwargs.setdefault("DB_POLL_MIN_INTERVAL", 0.0)
+            super(StandInDBConnection, self).__init__(
+                logger, make_config(DBHOSTS=",".join(servers.keys()), DBPORT="21050", **kwargs)
+            )
+            self.servers = servers
+
+        def connect_to_db(self, coordinator):
+            server = self.servers[coordinator.name]
+            if server.connect_delay > 0:
+                time.sleep(server.connect_delay)
+            if server.down:
+                raise ConnectionRefusedError("connection refused")
+            server.n_connects += 1
+            coordinator.n_connections += 1
+            return StandInConnection(server)
+
+        def check_coordinator(self, coordinator):
+            if self.servers[coordinator.name].down:
+                raise ConnectionRefusedError("connection refused")
+
+    return StandInDBConnection
+
+
+@pytest.fixture
+def main(monkeypatch):
+    """ the app module, imported from app/ like uvicorn does """
+    from starlette.staticfiles import StaticFiles
+
+    init = StaticFiles.__init__
+
+    def init_unchecked(self, *args, **kwargs):
+        # the packages installed by yarn may be missing
+        kwargs["check_dir"] = False
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(StaticFiles, "__init__", init_unchecked)
+    monkeypatch.chdir(APP_DIR)
+    import main
+    return main
+
+
+@pytest.fixture
+def make_client(main, tmp_path, monkeypatch):
+    """ returns a factory of started TestClients of the app on the stub backend, kwargs replace config values """
+    from starlette.testclient import TestClient
+
+    clients = []
+
+    def make_client(**kwargs):
+        defaults = {
+            "DBBACKEND": "stub",
+            "STUB_QUERY_DELAY": 0.0,
+            "STUB_QUERY_DELAY_JITTER": 0.0,
+            "WARMUP": False,
+            "CLIENT_RATE": 0.0,
+            "SHARED_CACHE_DIR": str(tmp_path / "cache"),
+            "JOB_DIR": str(tmp_path / "jobs"),
+            "SNAPSHOT_DIR": str(tmp_path / "results"),
+            "PROFILE_DIR": str(tmp_path / "profiles"),
+            "SPILL_DIR": str(tmp_path / "spill"),
+            "EXISTENCE_FILTER_DIR": str(tmp_path / "filters"),
+        }
+        for name, value in dict(defaults, **kwargs).items():
+            monkeypatch.setitem(main.config, name, value)
+        client = TestClient(main.app)
+        client.__enter__()
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.__exit__(None, None, None)
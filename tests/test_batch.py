@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from resilience import DBUnavailable
+
+
+URL = "/api/v1/batch"
+
+
+def lookup(lookup_type, inputs, **kwargs):
+    return dict({"type": lookup_type, "inputs": inputs, "date_from": "2021-01-01", "date_to": "2021-01-02"}, **kwargs)
+
+
+@pytest.fixture
+def lookups(main, monkeypatch):
+    """ records the lookups that reach the DB, fail.example fails and down.example finds the DB unavailable """
+    lookups = []
+    run_lookup = main.run_lookup
+
+    async def record_lookup(lookup_type, inputs, *args, **kwargs):
+        lookups.append((lookup_type, inputs))
+        if "fail.example" in inputs:
+            raise RuntimeError("failed")
+        if "down.example" in inputs:
+            raise DBUnavailable("the database is unavailable", 5.0)
+        return await run_lookup(lookup_type, inputs, *args, **kwargs)
+
+    monkeypatch.setattr(main, "run_lookup", record_lookup)
+    return lookups
+
+
+def test_identical_lookups_run_once(make_client, lookups):
+    client = make_client()
+    batch = [
+        lookup("ips_by_domains", ["example.at"]),
+        lookup("domains_by_ips", ["192.0.2.1"]),
+        lookup("ips_by_domains", ["example.at"]),
+        lookup("ips_by_domains", ["example.at"], limit=10),
+    ]
+    response = client.post(URL, json=batch)
+    results = response.json()
+    assert (results["lookups"], results["unique_lookups"]) == (4, 3)
+    assert len(lookups) == 3
+    assert [result["status"] for result in results["data"]] == [200] * 4
+    assert results["data"][0] == results["data"][2]
+    assert len(results["data"][3]["data"]) == 10
+    assert "etag" in response.headers
+
+    records = [json.loads(line) for line in client.post(URL + "?stream=true", json=batch).text.splitlines()]
+    assert sorted(record["indexes"] for record in records) == [[0, 2], [1], [3]]
+    # served from the result cache
+    assert len(lookups) == 3
+
+
+def test_failing_lookups_are_answered_with_their_status(make_client, lookups):
+    client = make_client()
+    batch = [
+        lookup("ips_by_domains", ["example.at"]),
+        lookup("ips_by_domains", ["fail.example"]),
+        lookup("ips_by_domains", ["down.example"]),
+        lookup("ips_by_domains", ["fail.example"]),
+    ]
+    response = client.post(URL, json=batch)
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert [result["status"] for result in data] == [200, 500, 503, 500]
+    assert data[1] == {"status": 500, "detail": "the lookup failed"}
+    assert data[2] == {"status": 503, "detail": "the database is unavailable"}
+    assert len(data[0]["data"]) > 0
+    # the response depends on more than the request
+    assert "etag" not in response.headers
+    # failures are not cached, the other lookup is
+    client.post(URL, json=batch)
+    assert [inputs for _, inputs in lookups].count(["fail.example"]) == 2
+    assert [inputs for _, inputs in lookups].count(["example.at"]) == 1
+
+
+def test_invalid_lookups_reject_the_batch(make_client, lookups):
+    client = make_client()
+    response = client.post(URL, json=[lookup("ips_by_domains", ["example.at"]), lookup("zone_walk", ["example.at"])])
+    assert response.status_code == 422
+    assert response.json()["detail"] == "lookup 1: unknown lookup type 'zone_walk'"
+    assert client.post(URL, json=[]).status_code == 422
+    assert lookups == []
@@ -0,0 +1,144 @@
+import json
+import asyncio
+
+import pytest
+
+from conftest import run
+
+from bulk import get_chunks, normalize_domain, normalize_ip, read_inputs, run_chunked
+
+
+DOMAINS = "".join("name%i.example\n" % i for i in range(10))
+URL = "/api/v1/bulk/ips_by_domains/?date_from=2021-01-01&date_to=2021-01-02&chunk_size=4"
+
+
+async def iter_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def read(chunks, normalize=normalize_domain, **kwargs):
+    return run(read_inputs(iter_chunks(chunks), normalize, **kwargs))
+
+
+def read_ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_normalize():
+    assert normalize_domain(' "Example.AT." ') == "example.at"
+    assert normalize_ip(' "192.0.2.1" ') == "192.0.2.1"
+
+
+def test_read_inputs():
+    upload = [
+        "domain_name;count\r\n# comment\r\n\r\nExample.at.;3\r\n",
+        "example.NL,4\r\n  example.at \r\n\"exam",
+        "ple.com\",1\r\nexample.be",
+    ]
+    inputs = read([chunk.encode("utf-8") for chunk in upload], header="domain_name")
+    assert inputs == ["example.at", "example.nl", "example.com", "example.be"]
+    # lines split inside a multi-byte character
+    data = "bücher.example\nexample.at\n".encode("utf-8")
+    assert read([data[:2], data[2:]]) == ["bücher.example", "example.at"]
+    assert read([b"192.0.2.1\n192.0.2.1\n ,\n"], normalize_ip) == ["192.0.2.1"]
+    assert read([]) == []
+
+
+def test_max_inputs():
+    lines = [("name%i.example\n" % i).encode("utf-8") for i in range(5)]
+    assert len(read(lines, max_inputs=5)) == 5
+    # duplicates do not count
+    assert len(read(lines + lines, max_inputs=5)) == 5
+    with pytest.raises(ValueError):
+        read(lines, max_inputs=4)
+
+
+def test_chunks():
+    values = list(range(10))
+    assert get_chunks(values, 4) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert get_chunks(values, 10) == [values]
+    assert get_chunks([], 4) == []
+
+
+def test_run_chunked_bounds_the_concurrency():
+    running = []
+    max_running = []
+
+    async def lookup(chunk):
+        running.append(chunk)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01 * (3 - chunk[0] % 3))
+        running.remove(chunk)
+        return sum(chunk)
+
+    async def collect():
+        return [item async for item in run_chunked(lookup, get_chunks(list(range(12)), 2), 3)]
+
+    results = run(collect())
+    assert sorted(results) == [(i, 4 * i + 1) for i in range(6)]
+    # in the order of completion
+    assert [i for i, _ in results] != list(range(6))
+    assert max(max_running) == 3
+
+
+def test_run_chunked_cancels_pending_chunks():
+    started = []
+
+    async def lookup(chunk):
+        started.append(chunk)
+        await asyncio.sleep(0.01 * chunk)
+        return chunk
+
+    async def first():
+        results = run_chunked(lookup, [1, 2, 3, 4], 2)
+        result = await results.__anext__()
+        await results.aclose()
+        await asyncio.sleep(0.05)
+        return result
+
+    assert run(first()) == (0, 1)
+    # the third chunk took the place of the first one, the last one is not started anymore
+    assert started == [1, 2, 3]
+
+
+def test_chunks_are_served_from_the_result_cache(make_client, main, monkeypatch):
+    client = make_client()
+    chunks = []
+    run_lookup = main.run_lookup
+
+    async def record_lookup(lookup_type, inputs, *args, **kwargs):
+        chunks.append(inputs)
+        return await run_lookup(lookup_type, inputs, *args, **kwargs)
+
+    monkeypatch.setattr(main, "run_lookup", record_lookup)
+    first = read_ndjson(client.post(URL, data=DOMAINS))
+    assert sorted(len(chunk) for chunk in chunks) == [2, 4, 4]
+    second = read_ndjson(client.post(URL, data=DOMAINS))
+    assert len(chunks) == 3
+    assert first[-1]["progress"] == second[-1]["progress"]
+    assert second[-1]["progress"]["chunks_done"] == 3
+
+
+def test_expensive_uploads_are_rejected(make_client):
+    client = make_client(COST_REJECT_THRESHOLD=1.0)
+    response = client.post(URL, data=DOMAINS)
+    assert response.status_code == 422
+    assert response.json()["detail"]["estimate"]["inputs"] == 10
+
+
+def test_expensive_uploads_run_as_background_job(make_client):
+    client = make_client(COST_REJECT_THRESHOLD=0.0, COST_BACKGROUND_THRESHOLD=1.0)
+    response = client.post(URL, data=DOMAINS)
+    assert response.status_code == 202
+    assert response.json()["estimate"]["action"] == "background"
+    assert client.get(response.json()["status_url"]).status_code == 200
+
+
+def test_forced_limit_applies_to_the_chunks(make_client):
+    client = make_client(
+        COST_REJECT_THRESHOLD=0.0, COST_BACKGROUND_THRESHOLD=0.0, COST_LIMIT_THRESHOLD=1.0, COST_FORCED_LIMIT=3
+    )
+    events = read_ndjson(client.post(URL, data=DOMAINS))
+    assert events[-1]["progress"]["forced_limit"] == 3
+    assert events[-1]["progress"]["rows"] == 9
@@ -0,0 +1,124 @@
+import time
+import datetime
+import threading
+
+import pytest
+
+from conftest import run
+
+import cache
+from cache import ResultCache, SharedCache, make_key
+
+
+def make_results(n):
+    return {"rows": [{"domain_name": "name%i.example" % i, "ip_address": "10.0.0.%i" % (i % 256)} for i in range(n)]}
+
+
+def key_for(i, day=datetime.date(2021, 1, 1)):
+    return make_key("ips_by_domains", ["name%i.example" % i], day, day, 100)
+
+
+def sum_size(shared):
+    return shared.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+
+@pytest.fixture
+def make_shared(logger, make_config, tmp_path):
+    def make_shared(**kwargs):
+        return SharedCache(logger, make_config(SHARED_CACHE_DIR=str(tmp_path), **kwargs))
+    return make_shared
+
+
+def test_total_size_is_kept(make_shared):
+    shared = make_shared(SHARED_CACHE_MAX_BYTES=10 ** 9)
+    for i in range(20):
+        shared.put(key_for(i), make_results(10 + i), time.time())
+    assert shared.get_total_size() == sum_size(shared) > 0
+    # replaced
+    shared.put(key_for(3), make_results(200), time.time())
+    assert shared.get_total_size() == sum_size(shared)
+    shared.invalidate_from(datetime.date(2021, 1, 1), time.time())
+    assert shared.get_total_size() == sum_size(shared) == 0
+    # a second process opening the database sees the same total
+    shared.put(key_for(1), make_results(10), time.time())
+    assert make_shared().get_total_size() == sum_size(shared)
+
+
+def test_size_limit(make_shared):
+    shared = make_shared(SHARED_CACHE_MAX_BYTES=5000)
+    for i in range(50):
+        shared.put(key_for(i), make_results(50), time.time())
+    assert shared.n_evictions > 0
+    assert shared.get_total_size() == sum_size(shared) <= 5000
+    assert shared.get(key_for(49)) is not None
+
+
+def test_expired_entries_and_old_claims_are_swept(make_shared, monkeypatch):
+    shared = make_shared(RESULT_CACHE_TTL=0.0)
+    shared.claim("prefetch:2021-01-01")
+    shared.put(key_for(1), make_results(10), time.time())
+    assert shared.get(key_for(1)) is None
+    monkeypatch.setattr(cache, "CLAIM_MAX_AGE", 0.0)
+    shared.next_sweep = 0.0
+    time.sleep(0.01)
+    shared.evict()
+    assert sum_size(shared) == shared.get_total_size() == 0
+    assert shared.db.execute("SELECT COUNT(*) FROM claims").fetchone()[0] == 0
+
+
+def test_shared_tier_runs_in_the_executor(logger, make_config, tmp_path):
+    result_cache = ResultCache(logger, make_config(
+        RESULT_CACHE=True, SHARED_CACHE=True, SHARED_CACHE_DIR=str(tmp_path)
+    ))
+    threads = []
+    get = result_cache.shared.get
+
+    def record_thread(key):
+        threads.append(threading.current_thread())
+        return get(key)
+
+    result_cache.shared.get = record_thread
+
+    async def lookup():
+        await result_cache.put_async(key_for(1), make_results(10))
+        result_cache._entries.clear()
+        return await result_cache.get_async(key_for(1))
+
+    assert run(lookup())["rows"] == make_results(10)["rows"]
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_entries_are_counted(make_shared):
+    shared = make_shared(SHARED_CACHE_MAX_BYTES=10 ** 9)
+    for i in range(20):
+        shared.put(key_for(i), make_results(10), time.time())
+    shared.put(key_for(3), make_results(20), time.time())
+    assert shared.stats()["entries"] == 20
+    shared.invalidate_from(datetime.date(2021, 1, 1), time.time())
+    assert shared.stats()["entries"] == shared.db.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+
+
+def test_coroutines_do_not_call_the_shared_tier_on_the_loop(logger, make_config, tmp_path):
+    result_cache = ResultCache(logger, make_config(
+        RESULT_CACHE=True, SHARED_CACHE=True, SHARED_CACHE_DIR=str(tmp_path)
+    ))
+    shared = result_cache.shared
+    threads = []
+    for name in ("mark_day_loaded", "invalidate_from", "claim", "pop_hot_keys", "add_hot_keys", "stats"):
+        def record_thread(*args, method=getattr(shared, name)):
+            threads.append(threading.current_thread())
+            return method(*args)
+        setattr(shared, name, record_thread)
+
+    async def refresh():
+        day = datetime.date(2021, 1, 1)
+        loaded_at = await result_cache.mark_day_loaded_async(day)
+        await result_cache.invalidate_from_async(day, loaded_at)
+        await shared.add_hot_keys_async([(key_for(1), 3)])
+        assert await shared.claim_async("prefetch:2021-01-01")
+        assert len(await shared.pop_hot_keys_async(10)) == 1
+        return await result_cache.stats_async()
+
+    assert run(refresh())["shared"]["entries"] == 0
+    assert len(threads) == 6
+    assert threading.main_thread() not in threads
@@ -0,0 +1,135 @@
+import re
+import zlib
+import sqlite3
+import datetime
+
+import pytest
+
+from conftest import run
+
+from config import config
+from openintel_sql_calls import openintel_select_changes
+
+
+BEFORE = datetime.date(2020, 12, 31)
+AFTER = datetime.date(2021, 1, 1)
+
+# day -> query name -> [(response type, ip4 address or target)]
+RECORDS = {
+    BEFORE: {
+        "same.example.": [("A", "192.0.2.1"), ("MX", "mail.example.")],
+        "moved.example.": [("A", "192.0.2.1"), ("A", "192.0.2.2"), ("NS", "ns1.example.")],
+        "gone.example.": [("CNAME", "cdn.example.")],
+        "other.test.": [("A", "192.0.2.9")],
+    },
+    AFTER: {
+        # measured twice on that day
+        "same.example.": [("MX", "mail.example."), ("A", "192.0.2.1"), ("A", "192.0.2.1")],
+        "moved.example.": [("A", "192.0.2.1"), ("A", "192.0.2.3"), ("NS", "ns2.example."), ("TXT", "v=spf1")],
+        "new.example.": [("AAAA", "2001:db8::1")],
+        "other.test.": [("A", "192.0.2.10")],
+    },
+}
+
+TARGET_COLUMNS = {"CNAME": "cname_name", "DNAME": "dname_name", "MX": "mx_address", "NS": "ns_address"}
+
+
+class ChangesDBConnection(object):
+    """ runs the queries on sqlite, with the impala functions they use """
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function("IF", 3, lambda condition, a, b: a if condition else b)
+        self.db.create_function("nonnullvalue", 1, lambda value: value is not None)
+        self.db.create_function("CONCAT", 3, lambda *values: "".join(values))
+        self.db.create_function("fnv_hash", 1, lambda value: zlib.crc32(value.encode("utf-8")))
+        self.db.create_function("pmod", 2, lambda a, b: a % b)
+        schema, table = config["DB"].split(".")
+        self.db.execute("ATTACH ':memory:' AS %s" % schema)
+        self.db.execute(
+            "CREATE TABLE %s (query_name TEXT, response_type TEXT, ip4_address TEXT, ip6_address TEXT, "
+            "cname_name TEXT, dname_name TEXT, mx_address TEXT, ns_address TEXT, year TEXT, month TEXT, day TEXT)"
+            % config["DB"]
+        )
+        for day, names in RECORDS.items():
+            for name, records in names.items():
+                for response_type, value in records:
+                    row = dict(query_name=name, response_type=response_type, year=str(day.year),
+                               month=str(day.month), day=str(day.day))
+                    if response_type == "A":
+                        row["ip4_address"] = value
+                    elif response_type == "AAAA":
+                        row["ip6_address"] = value
+                    elif response_type in TARGET_COLUMNS:
+                        row[TARGET_COLUMNS[response_type]] = value
+                    self.db.execute("INSERT INTO %s (%s) VALUES (%s)" % (
+                        config["DB"], ", ".join(row.keys()), ", ".join("?" * len(row))
+                    ), list(row.values()))
+        self.queries = []
+
+    async def execute_query_async(self, query, params=None, configuration=None, query_name=None):
+        self.queries.append((query, params, query_name))
+        rows = self.db.execute(re.sub(r"%\((\w+)\)s", r":\1", query), params).fetchall()
+        return {'rows': [dict(row) for row in rows], 'query_time': 0.0, 'fetch_time': 0.0}
+
+
+@pytest.fixture
+def db():
+    return ChangesDBConnection()
+
+
+def changes(results):
+    return sorted((row["domain_name"], row["record_type"], row["target"], row["change"]) for row in results["rows"])
+
+
+def test_changes_of_domains(db, logger):
+    domains = ["same.example", "moved.example", "gone.example", "new.example", "unknown.example"]
+    results = run(openintel_select_changes(db, logger, domains, BEFORE, AFTER, 0))
+    assert changes(results) == [
+        ("gone.example", "CNAME", "cdn.example", "removed"),
+        ("moved.example", "A", "192.0.2.2", "removed"),
+        ("moved.example", "A", "192.0.2.3", "added"),
+        ("moved.example", "NS", "ns1.example", "removed"),
+        ("moved.example", "NS", "ns2.example", "added"),
+        ("new.example", "AAAA", "2001:db8::1", "added"),
+    ]
+    assert results["changed_domains"] == 3
+    query, params, query_name = db.queries[0]
+    assert query_name == "openintel_changes" and "LIMIT" not in query
+    # the IN list is padded to 8 names
+    assert query.count("%(__domain_name") == 8
+
+
+def test_changes_of_a_zone(db, logger):
+    results = run(openintel_select_changes(db, logger, [], BEFORE, AFTER, 0, zone=".test"))
+    assert changes(results) == [
+        ("other.test", "A", "192.0.2.10", "added"),
+        ("other.test", "A", "192.0.2.9", "removed"),
+    ]
+    assert db.queries[0][1]["zone_pattern"] == "%.test."
+
+
+def test_changes_limit(db, logger):
+    results = run(openintel_select_changes(db, logger, ["moved.example"], BEFORE, AFTER, 2))
+    assert len(results["rows"]) == 2
+    assert db.queries[0][0].rstrip().endswith("LIMIT %(limit)s")
+
+
+def test_no_domains(db, logger):
+    results = run(openintel_select_changes(db, logger, [], BEFORE, AFTER, 0))
+    assert results["rows"] == [] and db.queries == []
+
+
+def test_changes_endpoint(make_client):
+    client = make_client()
+    url = "/api/v1/changes/?date_before=%s&date_after=%s"
+    response = client.post(url % ("2021-01-01", "2021-01-02"), json=["Example.AT.", "example.at", " "])
+    assert response.status_code == 200
+    # normalized and deduplicated
+    assert response.json()["queried_domains"] == 1
+    response = client.post(url % ("2021-01-02", "2021-01-02"), json=["example.at"])
+    assert response.status_code == 422
+    assert response.json()["detail"] == "date_before must be before date_after"
+    response = client.post(url % ("2019-01-01", "2021-01-02"), json=["example.at"])
+    assert response.json()["detail"] == "no data for 2019-01-01"
+    assert client.post(url % ("2021-01-01", "2021-01-02"), json=[]).status_code == 422
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from conftest import StandInServer, run
+
+from coordinators import Coordinator, CoordinatorRouter, parse_hosts
+
+
+@pytest.fixture
+def router(logger, make_config):
+    def make_router(n=3, **kwargs):
+        coordinators = [Coordinator("host%i" % i, 21050) for i in range(n)]
+        return CoordinatorRouter(logger, make_config(**kwargs), coordinators)
+    return make_router
+
+
+def test_parse_hosts():
+    assert parse_hosts("a, b:1,[::1]:2,[::2]", 21050) == [("a", 21050), ("b", 1), ("::1", 2), ("::2", 21050)]
+
+
+def test_least_outstanding(router):
+    r = router()
+    r.coordinators[0].outstanding = 2
+    r.coordinators[1].outstanding = 0
+    r.coordinators[2].outstanding = 1
+    assert r.choose() is r.coordinators[1]
+
+
+def test_sticky_within_slack(router):
+    r = router(DB_STICKY_SLACK=2)
+    sticky = r.choose("query")
+    assert all(r.choose("query") is sticky for _ in range(10))
+    # busier than the least loaded one, but within the slack
+    sticky.outstanding = 2
+    assert r.choose("query") is sticky
+    # beyond the slack the least loaded one takes the query
+    sticky.outstanding = 3
+    assert r.choose("query") is not sticky
+    assert r.choose("query").outstanding == 0
+
+
+def test_sticky_keys_spread(router):
+    r = router()
+    assert len(set(r.choose("query %i" % i).name for i in range(100))) == 3
+
+
+def test_eject_and_readmit(router):
+    r = router(DB_EJECT_AFTER=3)
+    coordinator = r.coordinators[0]
+    assert not r.record_failure(coordinator)
+    assert not r.record_failure(coordinator)
+    assert r.record_failure(coordinator)
+    assert not coordinator.healthy
+    assert coordinator not in r.get_candidates()
+    assert all(r.choose("query %i" % i) is not coordinator for i in range(50))
+    r.readmit(coordinator)
+    assert coordinator.healthy and coordinator.n_failures == 0
+    assert coordinator in r.get_candidates()
+
+
+def test_success_resets_failures(router):
+    r = router(DB_EJECT_AFTER=2)
+    coordinator = r.coordinators[0]
+    r.record_failure(coordinator)
+    r.record_success(coordinator)
+    assert not r.record_failure(coordinator)
+    assert coordinator.healthy
+
+
+def test_all_ejected_still_tried(router):
+    r = router()
+    for coordinator in r.coordinators:
+        r.eject(coordinator)
+    assert r.get_candidates() == r.coordinators
+
+
+def test_queries_avoid_failing_coordinator(stand_in_db):
+    servers = {"a:1": StandInServer(), "b:2": StandInServer()}
+    servers["a:1"].down = True
+    db = stand_in_db(servers, DB_EJECT_AFTER=1, N_RECONNECT_TRIES=3)
+
+    async def query():
+        return [await db.execute_query_async("SELECT %i" % i, query_name="test") for i in range(10)]
+
+    results = run(query())
+    assert all(result["rows"] == [{"value": 1}] for result in results)
+    a, b = db.coordinators
+    assert not a.healthy and b.healthy
+    assert a.outstanding == 0 and b.outstanding == 0
+    assert len(servers["b:2"].queries) == 10
+
+
+def test_health_check_readmits(stand_in_db):
+    servers = {"a:1": StandInServer(), "b:2": StandInServer()}
+    db = stand_in_db(servers, DB_HEALTH_CHECK_INTERVAL=0.01)
+    db.router.eject(db.coordinators[0])
+
+    async def check():
+        try:
+            await asyncio.wait_for(db.run_health_checks(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
+    run(check())
+    assert db.coordinators[0].healthy
+
+
+def test_connect_does_not_block_the_loop(stand_in_db):
+    servers = {"a:1": StandInServer()}
+    servers["a:1"].connect_delay = 0.3
+    db = stand_in_db(servers)
+    ticks = []
+
+    async def tick():
+        for _ in range(5):
+            ticks.append(asyncio.get_event_loop().time())
+            await asyncio.sleep(0.02)
+
+    async def query():
+        ticker = asyncio.ensure_future(tick())
+        result = await db.execute_query_async("SELECT 1", query_name="test")
+        await ticker
+        return result
+
+    assert run(query())["rows"] == [{"value": 1}]
+    # the ticker ran while connect() was blocking its thread
+    assert ticks[-1] - ticks[0] < 0.25
+
+
+def test_slow_connect_can_be_timed_out(stand_in_db):
+    servers = {"a:1": StandInServer()}
+    servers["a:1"].connect_delay = 0.3
+    db = stand_in_db(servers)
+
+    async def query():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(db.execute_query_async("SELECT 1", query_name="test"), 0.05)
+        # the connection that was still being opened is closed again
+        await asyncio.sleep(0.4)
+
+    run(query())
+    coordinator = db.coordinators[0]
+    assert coordinator.outstanding == 0
+    assert coordinator.n_connections == 0
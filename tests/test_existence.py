@@ -0,0 +1,98 @@
+import time
+import datetime
+
+from conftest import run
+
+from existence import BloomFilter, ExistenceFilter
+
+
+class BatchDBConnection(object):
+    def __init__(self, values, batch_size=100):
+        self.values = values
+        self.batch_size = batch_size
+
+    async def execute_query_batches_async(self, query, parameters=None, batch_size=None, query_name=None):
+        for i in range(0, len(self.values), self.batch_size):
+            yield [{"value": value} for value in self.values[i:i + self.batch_size]]
+
+
+def test_stored_filter_is_mapped(tmp_path):
+    bloom = BloomFilter(1000, 0.01)
+    bloom.update("name%i.example" % i for i in range(1000))
+    filename = str(tmp_path / "filter.bloom")
+    bloom.save(filename)
+
+    loaded = BloomFilter.load(filename)
+    assert loaded.mapped
+    assert (loaded.n_bits, loaded.n_hashes) == (bloom.n_bits, bloom.n_hashes)
+    assert all("name%i.example" % i in loaded for i in range(1000))
+    assert all(("other%i.example" % i in loaded) == ("other%i.example" % i in bloom) for i in range(1000))
+    assert sum("other%i.example" % i in loaded for i in range(1000)) < 50
+    loaded.close()
+
+
+def test_build_and_load_filters(logger, make_config, tmp_path):
+    existence = ExistenceFilter(logger, make_config(
+        EXISTENCE_FILTER_DIR=str(tmp_path), EXISTENCE_FILTER_DAYS=1, EXISTENCE_FILTER_CAPACITY=1000
+    ))
+    day = existence._days_to_filter()[0]
+    values = ["name%i.example" % i for i in range(500)]
+    run(existence.build_missing_filters(BatchDBConnection(values)))
+    existence.load_filters()
+    assert set(existence.filters.keys()) == set((kind, day) for kind in ("query_name", "ip4_address", "ip6_address"))
+    assert not existence.is_absent("query_name", "name1.example", day, day)
+    assert sum(existence.is_absent("query_name", "other%i.example" % i, day, day) for i in range(100)) > 90
+
+    # filters of days that are no longer of interest are unmapped
+    existence.filter_days = 0
+    existence.load_filters()
+    assert existence.filters == {}
+
+
+def test_empty_partition_has_no_filter(logger, make_config, tmp_path):
+    existence = ExistenceFilter(logger, make_config(EXISTENCE_FILTER_DIR=str(tmp_path), EXISTENCE_FILTER_CAPACITY=1000))
+    day = datetime.date(2021, 1, 1)
+    assert run(existence.build_filter(BatchDBConnection([]), "query_name", day)) is None
+
+
+def test_negative_cache_covers_ranges(logger, make_config):
+    existence = ExistenceFilter(logger, make_config())
+    existence.record_absent("query_name", ["a.example"], datetime.date(2021, 1, 1), datetime.date(2021, 1, 10))
+    existence.record_absent("query_name", ["a.example"], datetime.date(2021, 1, 11), datetime.date(2021, 1, 20))
+    assert existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 5), datetime.date(2021, 1, 15))
+    assert existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 1), datetime.date(2021, 1, 20))
+    assert not existence.is_absent("query_name", "a.example", datetime.date(2020, 12, 31), datetime.date(2021, 1, 5))
+    assert not existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 15), datetime.date(2021, 1, 21))
+    assert not existence.is_absent("query_name", "b.example", datetime.date(2021, 1, 5), datetime.date(2021, 1, 5))
+    # recent days may still be loaded
+    today = datetime.date.today()
+    existence.record_absent("query_name", ["c.example"], today, today)
+    assert not existence.is_absent("query_name", "c.example", today, today)
+
+
+def test_negative_cache_gaps_are_checked_in_the_filters(logger, make_config):
+    existence = ExistenceFilter(logger, make_config())
+    day = datetime.date(2021, 1, 11)
+    existence.record_absent("query_name", ["a.example"], datetime.date(2021, 1, 1), datetime.date(2021, 1, 10))
+    existence.record_absent("query_name", ["a.example"], datetime.date(2021, 1, 12), datetime.date(2021, 1, 20))
+    assert not existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 1), datetime.date(2021, 1, 20))
+    bloom = BloomFilter(100, 0.01)
+    existence.filters[("query_name", day)] = bloom
+    assert existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 1), datetime.date(2021, 1, 20))
+    bloom.add("a.example")
+    assert not existence.is_absent("query_name", "a.example", datetime.date(2021, 1, 1), datetime.date(2021, 1, 20))
+
+
+def test_long_ranges_take_one_entry_per_value(logger, make_config):
+    existence = ExistenceFilter(logger, make_config(NEGATIVE_CACHE_SIZE=10000))
+    date_from, date_to = datetime.date(2020, 1, 1), datetime.date(2024, 12, 31)
+    existence.record_absent("query_name", ["other%i.example" % i for i in range(100)], date_from, date_to)
+    values = ["name%i.example" % i for i in range(5000)]
+    start = time.time()
+    existence.record_absent("query_name", values, date_from, date_to)
+    present, absent = existence.split_absent("query_name", values, date_from, date_to)
+    assert time.time() - start < 1.0
+    assert len(existence.negative_cache) == 5100
+    assert present == [] and absent == values
+    # the entries of other lookups are kept
+    assert existence.is_absent("query_name", "other1.example", date_from, date_to)
@@ -0,0 +1,90 @@
+from conftest import run
+
+from graph import resolve_graph
+
+
+# name -> [(record_type, target)]
+ZONE = {
+    "www.example.at": [("CNAME", "cdn.example.net")],
+    "cdn.example.net": [("CNAME", "edge.example.org"), ("A", "192.0.2.1")],
+    "edge.example.org": [("A", "192.0.2.2"), ("AAAA", "2001:db8::2")],
+    "example.at": [("MX", "mail.example.at"), ("NS", "ns.example.net")],
+    "mail.example.at": [("A", "192.0.2.1")],
+    "ns.example.net": [("A", "192.0.2.53")],
+    # a -> b -> c -> a
+    "a.example": [("CNAME", "b.example")],
+    "b.example": [("CNAME", "c.example")],
+    "c.example": [("CNAME", "a.example"), ("A", "192.0.2.3")],
+}
+
+
+class StandInReferences(object):
+    """ answers references lookups from ZONE, limited to limit rows """
+    def __init__(self, limit=1000):
+        self.limit = limit
+        self.levels = []
+
+    async def lookup(self, names):
+        self.levels.append(list(names))
+        rows = [
+            {"name": name, "record_type": record_type, "target": target}
+            for name in names for record_type, target in ZONE.get(name, [])
+        ]
+        return {"rows": rows[:self.limit], "query_time": 0.1}
+
+
+def resolve(roots, max_depth=10, max_nodes=100, limit=1000):
+    references = StandInReferences(limit)
+    return run(resolve_graph(references.lookup, roots, max_depth, max_nodes)), references
+
+
+def test_levels_are_looked_up_breadth_first():
+    graph, references = resolve(["www.example.at", "example.at", "www.example.at"])
+    assert references.levels == [
+        ["www.example.at", "example.at"],
+        ["cdn.example.net", "mail.example.at", "ns.example.net"],
+        ["edge.example.org"],
+    ]
+    depths = {node["id"]: (node["type"], node["depth"]) for node in graph["nodes"]}
+    assert depths["192.0.2.1"] == ("address", 2)
+    assert depths["2001:db8::2"] == ("address", 3)
+    assert depths["edge.example.org"] == ("name", 2)
+    # both names pointing to 192.0.2.1 have their edge, the address is a single node
+    assert sorted(edge["source"] for edge in graph["edges"] if edge["target"] == "192.0.2.1") == [
+        "cdn.example.net", "mail.example.at"
+    ]
+    assert len(graph["nodes"]) == 10 and len(graph["edges"]) == 9
+    assert graph["cycles"] == [] and not graph["truncated"]
+    assert [(level["names"], level["rows"]) for level in graph["levels"]] == [(2, 3), (3, 4), (1, 2)]
+
+
+def test_cycles_are_expanded_once():
+    graph, references = resolve(["a.example"])
+    assert references.levels == [["a.example"], ["b.example"], ["c.example"]]
+    assert [(edge["source"], edge["target"]) for edge in graph["cycles"]] == [("c.example", "a.example")]
+    assert len(graph["edges"]) == 4 and not graph["truncated"]
+    # a root that is reached from another root
+    graph, references = resolve(["a.example", "b.example"])
+    assert references.levels == [["a.example", "b.example"], ["c.example"]]
+    assert sorted((edge["source"], edge["target"]) for edge in graph["cycles"]) == [
+        ("a.example", "b.example"), ("c.example", "a.example")
+    ]
+
+
+def test_depth_limit():
+    graph, references = resolve(["www.example.at"], max_depth=1)
+    assert references.levels == [["www.example.at"]]
+    assert [node["id"] for node in graph["nodes"]] == ["www.example.at", "cdn.example.net"]
+    assert graph["truncated"]
+    graph, references = resolve(["www.example.at"], max_depth=3)
+    assert not graph["truncated"]
+
+
+def test_node_limit():
+    graph, references = resolve(["www.example.at", "example.at"], max_nodes=4)
+    assert len(graph["nodes"]) == 4 and graph["truncated"]
+    # edges between nodes of the graph are kept
+    assert all(edge["target"] in {node["id"] for node in graph["nodes"]} for edge in graph["edges"])
+    # a level whose lookup returned max_nodes rows may be incomplete
+    graph, references = resolve(["www.example.at", "example.at"], limit=2, max_nodes=2)
+    assert graph["truncated"] and graph["levels"][0]["rows"] == 2
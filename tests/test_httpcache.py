@@ -0,0 +1,91 @@
+import datetime
+
+from starlette.requests import Request
+
+from httpcache import HTTPCachePolicy, normalize_body, parse_if_none_match
+
+
+HISTORICAL = "/api/v1/ips_by_domain/example.at?date_from=2021-01-01&date_to=2021-01-02"
+HISTORICAL_POST = "/api/v1/ips_by_domains/?date_from=2021-01-01&date_to=2021-01-01"
+
+
+def make_request(path, query="", method="GET"):
+    return Request({
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode("utf-8"),
+        "headers": []
+    })
+
+
+def test_etags():
+    get_etag = HTTPCachePolicy.get_etag
+    request = make_request("/api/v1/ips_by_domain/example.at", "date_to=2021-01-02&date_from=2021-01-01")
+    etag = get_etag(request, b"", "v1")
+    assert etag.startswith('W/"') and etag.endswith('"')
+    # the order of the parameters and the formatting of the body do not matter
+    same = make_request("/api/v1/ips_by_domain/example.at", "date_from=2021-01-01&date_to=2021-01-02")
+    assert get_etag(same, b"", "v1") == etag
+    assert get_etag(request, b'["a",  "b"]', "v1") == get_etag(request, b'["a","b"]', "v1") != etag
+    assert normalize_body(b"not json") == b"not json"
+    # everything else does
+    assert get_etag(request, b"", "v2") != etag
+    assert get_etag(make_request("/api/v1/ips_by_domain/example.nl", "date_from=2021-01-01&date_to=2021-01-02"),
+                    b"", "v1") != etag
+    assert get_etag(make_request("/api/v1/ips_by_domain/example.at", "date_from=2021-01-01"), b"", "v1") != etag
+
+
+def test_if_none_match():
+    assert parse_if_none_match('W/"a", "b" ,*') == {'"a"', '"b"', "*"}
+
+
+def test_cache_control(logger, make_config):
+    policy = HTTPCachePolicy(logger, make_config(HTTP_CACHE_MAX_AGE=600, HTTP_CACHE_RECENT_MAX_AGE=0))
+    latest_day = datetime.date(2021, 1, 10)
+    for query, historical in (
+            ("date_to=2021-01-09", True),
+            ("date_to=2021-01-10", False),
+            ("date_before=2021-01-01&date_after=2021-01-09", True),
+            ("date_to=yesterday", False),
+            # the latest loaded day
+            ("", False)):
+        assert policy.is_historical(make_request("/api/v1/changes/", query), latest_day) == historical
+    assert policy.get_cache_control(True) == "public, max-age=600, immutable"
+    assert policy.get_cache_control(False) == "no-cache"
+    policy = HTTPCachePolicy(logger, make_config(HTTP_CACHE_RECENT_MAX_AGE=60))
+    assert policy.get_cache_control(False) == "public, max-age=60"
+    assert not policy.applies(make_request("/api/v1/ips_by_domain/example.at", "profile=true"))
+    assert not policy.applies(make_request("/api/v1/jobs/1"))
+
+
+def test_not_modified(make_client, main):
+    client = make_client()
+    response = client.get(HISTORICAL)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "public, max-age=%i, immutable" % main.config["HTTP_CACHE_MAX_AGE"]
+    response = client.get(HISTORICAL, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag and response.content == b""
+    assert client.get(HISTORICAL, headers={"If-None-Match": 'W/"other"'}).status_code == 200
+    # a new version of the data
+    main.catalog.version = "reloaded"
+    assert client.get(HISTORICAL, headers={"If-None-Match": etag}).status_code == 200
+    assert main.http_cache_policy.stats()["not_modified"] == 1
+
+
+def test_recent_intervals_are_revalidated(make_client, main):
+    client = make_client()
+    latest_day = main.catalog.latest_day.isoformat()
+    response = client.get("/api/v1/ips_by_domain/example.at?date_from=%s&date_to=%s" % (latest_day, latest_day))
+    assert response.headers["cache-control"] == "no-cache"
+    response = client.post(HISTORICAL_POST, json=["example.at", "example.nl"])
+    assert "immutable" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+    response = client.post(HISTORICAL_POST, json=["example.at", "example.nl"], headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    # snapshots and errors get no validators
+    response = client.post(HISTORICAL_POST + "&snapshot=true", json=["example.at"])
+    assert "etag" not in response.headers
+    assert "etag" not in client.get("/api/v1/ips_by_domain/example.at?date_to=x").headers
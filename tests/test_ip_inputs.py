@@ -0,0 +1,92 @@
+import re
+import random
+import datetime
+import ipaddress
+
+import pytest
+
+from conftest import run
+
+from openintel_sql_calls import get_ipv6_regexp, openintel_select_domains_by_ips, parse_ip_input
+
+
+class RecordingDBConnection(object):
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else []
+        self.queries = []
+
+    async def execute_query_async(self, query, params=None, configuration=None, query_name=None):
+        self.queries.append((query, params))
+        return {'rows': self.rows, 'query_time': 0.0, 'fetch_time': 0.0}
+
+
+def get_text_forms(address):
+    """ the text forms of an IPv6 address, with any run of zero groups elided """
+    groups = ['%x' % int(group, 16) for group in address.exploded.split(':')]
+    forms = {':'.join(groups)}
+    for i in range(8):
+        for j in range(i + 1, 9):
+            if all(group == '0' for group in groups[i:j]):
+                forms.add(':'.join(groups[:i]) + '::' + ':'.join(groups[j:]))
+    return forms
+
+
+@pytest.mark.parametrize("value, message", [
+    ("1.2.3.9-1.2.3.4", "'1.2.3.9-1.2.3.4' is an empty range"),
+    ("1.2.3.4-::1", "'1.2.3.4-::1' mixes IPv4 and IPv6 addresses"),
+    ("1.2.3-1.2.3.4", "'1.2.3-1.2.3.4' is neither an IP address, a CIDR prefix nor an IP range"),
+    ("example.com", "'example.com' is neither an IP address, a CIDR prefix nor an IP range"),
+])
+def test_parse_ip_input_errors(value, message):
+    with pytest.raises(ValueError) as e:
+        parse_ip_input(value)
+    assert str(e.value) == message
+
+
+def test_parse_ip_input():
+    assert parse_ip_input("1.2.3.4-1.2.3.7") == [ipaddress.ip_network("1.2.3.4/30")]
+    assert parse_ip_input("2001:db8::1/32") == [ipaddress.ip_network("2001:db8::/32")]
+
+
+@pytest.mark.parametrize("prefix", [
+    "fe80::/10", "2a00::/12", "::ffff:0:0/96", "64:ff9b::/96", "2001:db8::/33", "2001:0:1::/48",
+    "2001:db8:0:0:1::/80", "2001:db8::/120", "8000::/1", "::/8"
+])
+def test_ipv6_regexp_is_exact(prefix):
+    network = ipaddress.ip_network(prefix)
+    regexp = re.compile(get_ipv6_regexp(network))
+    rnd = random.Random(prefix)
+    for _ in range(500):
+        if rnd.random() < 0.5:
+            address = int(network.network_address) + rnd.getrandbits(128 - network.prefixlen)
+        else:
+            # near misses
+            address = int(network.network_address) ^ (1 << rnd.randrange(128))
+        groups = ipaddress.IPv6Address(address).exploded.split(':')
+        for k in rnd.sample(range(8), rnd.randrange(5)):
+            groups[k] = '0'
+        address = ipaddress.IPv6Address(':'.join(groups))
+        for text in get_text_forms(address):
+            assert bool(regexp.match(text)) == (address in network), text
+
+
+def test_ipv6_prefixes_are_matched_in_sql(logger):
+    db = RecordingDBConnection()
+    day = datetime.date(2021, 1, 1)
+    run(openintel_select_domains_by_ips(
+        db, logger, ["fe80::/10", "2001:db8::/32", "2001:db9::/33"], day, day, 10
+    ))
+    query, params = db.queries[0]
+    assert "(l2.ip6_address IS NOT NULL)" not in query
+    assert query.count("REGEXP") == 2
+    assert query.count("LIKE") == 1
+    assert params["__p0"] == "2001:db8:%"
+    assert query.rstrip().endswith("LIMIT %(limit)s")
+
+
+def test_rows_are_not_filtered_after_the_limit(logger):
+    rows = [{"ip_address": "fe80::%x" % i, "query_name": "a.example"} for i in range(10)]
+    db = RecordingDBConnection(rows)
+    day = datetime.date(2021, 1, 1)
+    result = run(openintel_select_domains_by_ips(db, logger, ["fe80::/10"], day, day, 10))
+    assert result["rows"] == rows
@@ -0,0 +1,127 @@
+import re
+import sqlite3
+import datetime
+
+import pytest
+
+from conftest import run
+
+from config import config
+from openintel_sql_calls import openintel_select_measurements_by_name_and_ip_or_type
+
+
+def to_timestamp(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def to_date(ts):
+    return datetime.date.fromisoformat(ts[:10])
+
+
+class MeasurementsDBConnection(object):
+    """ runs the queries on sqlite, with the impala functions they use """
+    def __init__(self, measurements):
+        self.db = sqlite3.connect(":memory:")
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function("to_timestamp", 1, to_timestamp)
+        self.db.create_function("TO_DATE", 1, lambda ts: ts[:10])
+        self.db.create_function("DATEDIFF", 2, lambda a, b: (to_date(a) - to_date(b)).days)
+        schema, table = config["DB"].split(".")
+        self.db.execute("ATTACH ':memory:' AS %s" % schema)
+        self.db.execute(
+            "CREATE TABLE %s (query_name TEXT, response_name TEXT, query_type TEXT, response_type TEXT, "
+            "ip4_address TEXT, ip6_address TEXT, time INTEGER, year TEXT, month TEXT, day TEXT)" % config["DB"]
+        )
+        for ts, ip4_address in measurements:
+            time = int(ts.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+            self.db.execute(
+                "INSERT INTO %s VALUES ('example.at.', 'example.at.', 'A', 'A', ?, NULL, ?, ?, ?, ?)" % config["DB"],
+                (ip4_address, time, str(ts.year), str(ts.month), str(ts.day))
+            )
+        self.queries = []
+
+    async def execute_query_async(self, query, params=None, configuration=None, query_name=None):
+        self.queries.append((query, params, query_name))
+        rows = self.db.execute(re.sub(r"%\((\w+)\)s", r":\1", query), params).fetchall()
+        return {'rows': [dict(row) for row in rows], 'query_time': 0.0, 'fetch_time': 0.0}
+
+
+def measured(ip4_address, first_day, n_days, hours=(0, )):
+    return [
+        (datetime.datetime(first_day.year, first_day.month, first_day.day, hour) + datetime.timedelta(days=i),
+         ip4_address)
+        for i in range(n_days) for hour in hours
+    ]
+
+
+@pytest.fixture
+def measurements():
+    day = datetime.date(2020, 12, 30)
+    # 192.0.2.1 for 4 days (two measurements a day) across the year, then 192.0.2.2 for 2 days, then 192.0.2.1 again
+    return MeasurementsDBConnection(
+        measured("192.0.2.1", day, 4, hours=(0, 12))
+        + measured("192.0.2.2", day + datetime.timedelta(days=4), 2)
+        + measured("192.0.2.1", day + datetime.timedelta(days=6), 3)
+    )
+
+
+def lookup(db, logger, limit=0, date_to=datetime.date(2021, 1, 31), **kwargs):
+    return run(openintel_select_measurements_by_name_and_ip_or_type(
+        db, logger, "example.at", datetime.date(2020, 12, 1), date_to, limit, collapse=True, **kwargs
+    ))
+
+
+def test_collapsed_query_shape(measurements, logger):
+    lookup(measurements, logger, limit=10)
+    query, params, query_name = measurements.queries[0]
+    assert query_name == "openintel_measurements_collapsed"
+    assert re.search(r"DENSE_RANK\(\) OVER \(\s*PARTITION BY query_name, response_name, query_type, response_type, "
+                     r"ip4_address, ip6_address\s*ORDER BY TO_DATE\(ts\)\s*\)", query)
+    assert "GROUP BY query_name, response_name, query_type, response_type, ip4_address, ip6_address, run" in query
+    # the limit applies to the collapsed rows
+    assert query.count("LIMIT") == 1
+    assert query.index("GROUP BY") < query.index("ORDER BY first_seen") < query.index("LIMIT %(limit)s")
+    assert params["limit"] == 10
+
+
+def test_runs_are_collapsed(measurements, logger):
+    results = lookup(measurements, logger)
+    rows = [(row["ip4_address"], row["first_seen"], row["last_seen"], row["count"]) for row in results["rows"]]
+    assert rows == [
+        ("192.0.2.1", "2020-12-30 00:00:00", "2021-01-02 12:00:00", 8),
+        ("192.0.2.2", "2021-01-03 00:00:00", "2021-01-04 00:00:00", 2),
+        ("192.0.2.1", "2021-01-05 00:00:00", "2021-01-07 00:00:00", 3),
+    ]
+    assert results["columns"] == [
+        "query_name", "response_name", "query_type", "response_type", "ip4_address", "ip6_address",
+        "first_seen", "last_seen", "count"
+    ]
+    assert results["rows"][0]["query_name"] == "example.at" and results["collapse"]
+    # limit and interval
+    assert len(lookup(measurements, logger, limit=2)["rows"]) == 2
+    rows = lookup(measurements, logger, date_to=datetime.date(2021, 1, 5))["rows"]
+    assert [(row["ip4_address"], row["count"]) for row in rows] == [
+        ("192.0.2.1", 8), ("192.0.2.2", 2), ("192.0.2.1", 1)
+    ]
+    rows = lookup(measurements, logger, ip="192.0.2.2")["rows"]
+    assert [(row["ip4_address"], row["count"]) for row in rows] == [("192.0.2.2", 2)]
+
+
+def test_collapse_is_not_supported_with_full(measurements, logger):
+    with pytest.raises(ValueError):
+        lookup(measurements, logger, full=True)
+
+
+def test_collapsed_endpoints(make_client):
+    client = make_client()
+    url = "/api/v1/measurements_by_domain/example.at?date_from=2021-01-01&date_to=2021-01-02&collapse=true&limit=5"
+    results = client.get(url).json()
+    assert results["collapse"] and len(results["data"]) == 5
+    assert {"first_seen", "last_seen", "count"} <= set(results["data"][0].keys())
+    assert client.get(url + "&full=true").status_code == 422
+    response = client.get(url.replace("example.at?", "example.at/csv?"))
+    assert response.headers["content-disposition"] == (
+        "attachment; filename=openintel_msm_history_example.at_collapsed_2021-01-01_2021-01-02.csv"
+    )
+    assert response.text.splitlines()[0].endswith("first_seen;last_seen;count")
+    assert len(response.text.splitlines()) == 6
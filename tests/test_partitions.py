@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+from conftest import run
+
+from partitions import PartitionCatalog
+
+
+def day(month, day_of_month, year=2021):
+    return datetime.date(year, month, day_of_month)
+
+
+class PartitionsDBConnection(object):
+    """ answers SHOW PARTITIONS like impala, with a Total row """
+    def __init__(self, row_counts):
+        self.row_counts = row_counts
+
+    async def execute_query_async(self, query, parameters=None, configuration=None, query_name=None):
+        rows = [
+            {"year": str(d.year), "month": str(d.month), "day": str(d.day), "#Rows": n_rows, "Size": "1.00MB"}
+            for d, n_rows in sorted(self.row_counts.items())
+        ]
+        rows.append({"year": "Total", "month": "", "day": "", "#Rows": -1, "Size": ""})
+        return {"rows": rows}
+
+
+@pytest.fixture
+def catalog(logger, make_config):
+    return PartitionCatalog(logger, make_config())
+
+
+def test_unknown_catalog(catalog):
+    assert not catalog.loaded
+    assert catalog.default_day() == datetime.date.today() - datetime.timedelta(days=1)
+    assert catalog.clamp(day(1, 1), day(1, 5)) == (day(1, 1), day(1, 5))
+
+
+def test_clamp(catalog):
+    # 2020-12-30 to 2021-01-05 without 2021-01-02 and 2021-01-03
+    days = (day(12, 30, 2020), day(12, 31, 2020), day(1, 1), day(1, 4), day(1, 5))
+    db = PartitionsDBConnection({d: 100 for d in days})
+    assert run(catalog.refresh(db)) == []
+    assert catalog.default_day() == catalog.latest_day == day(1, 5)
+    assert catalog.clamp(day(12, 31, 2020), day(1, 4)) == (day(12, 31, 2020), day(1, 4))
+    assert catalog.clamp(day(12, 1, 2020), day(2, 1)) == (day(12, 30, 2020), day(1, 5))
+    # the missing days are skipped at both ends
+    assert catalog.clamp(day(1, 2), day(1, 4)) == (day(1, 4), day(1, 4))
+    assert catalog.clamp(day(12, 31, 2020), day(1, 3)) == (day(12, 31, 2020), day(1, 1))
+    # no loaded day in the interval
+    assert catalog.clamp(day(1, 2), day(1, 3)) is None
+    assert catalog.clamp(day(1, 6), day(1, 9)) is None
+    assert catalog.clamp(day(12, 1, 2020), day(12, 29, 2020)) is None
+    assert catalog.clamp(day(1, 5), day(1, 1)) is None
+    assert catalog.get_days(day(1, 1), day(1, 4)) == [day(1, 1), day(1, 4)]
+
+
+def test_refresh(catalog):
+    row_counts = {day(1, 1): 100, day(1, 2): "n/a"}
+    db = PartitionsDBConnection(row_counts)
+    run(catalog.refresh(db))
+    assert catalog.days == [day(1, 1), day(1, 2)]
+    # partitions without stats
+    assert catalog.row_counts[day(1, 2)] == -1
+    version = catalog.version
+    row_counts[day(1, 3)] = 10
+    row_counts[day(1, 4)] = 10
+    assert run(catalog.refresh(db)) == [day(1, 3), day(1, 4)]
+    assert catalog.version != version
+    version = catalog.version
+    assert run(catalog.refresh(db)) == []
+    assert catalog.version == version
+    # a reloaded partition
+    row_counts[day(1, 2)] = 200
+    assert run(catalog.refresh(db)) == []
+    assert catalog.version != version
+    assert PartitionCatalog.get_version(catalog.row_counts) == catalog.version
+
+
+def test_lookups_of_days_that_are_not_loaded(make_client, main, monkeypatch):
+    client = make_client()
+    queries = []
+    run_lookup = main.run_lookup
+
+    async def record_lookup(lookup_type, inputs, date_from, date_to, *args, **kwargs):
+        queries.append((date_from, date_to))
+        return await run_lookup(lookup_type, inputs, date_from, date_to, *args, **kwargs)
+
+    monkeypatch.setattr(main, "run_lookup", record_lookup)
+    latest_day = main.catalog.latest_day
+    results = client.get("/api/v1/ips_by_domain/example.at").json()
+    assert results["queried_interval"] == [latest_day.isoformat()] * 2
+    results = client.get("/api/v1/ips_by_domain/example.at?date_from=2019-01-01&date_to=2019-01-31").json()
+    assert results["no_partitions"] and results["data"] == []
+    future = (latest_day + datetime.timedelta(days=10)).isoformat()
+    results = client.get("/api/v1/ips_by_domain/example.at?date_from=2019-12-01&date_to=%s" % future).json()
+    assert results["queried_interval"] == [main.catalog.first_day.isoformat(), latest_day.isoformat()]
+    assert results["requested_interval"] == ["2019-12-01", future]
+    assert queries == [(latest_day, latest_day), (main.catalog.first_day, latest_day)]
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from starlette.datastructures import URL
+
+from conftest import run
+
+from profiling import RequestProfiler
+
+
+class StandInRequest(object):
+    method = "GET"
+    url = URL("http://localhost/api/v1/test")
+
+
+class StandInResponse(object):
+    def __init__(self, chunks, streamed=False):
+        self.status_code = 200
+        self.headers = {} if streamed else {"content-length": str(sum(len(chunk) for chunk in chunks))}
+        self.chunks = chunks
+        self.n_read = 0
+
+    async def read(self):
+        for chunk in self.chunks:
+            self.n_read += 1
+            yield chunk
+
+    @property
+    def body_iterator(self):
+        return self.read()
+
+
+@pytest.fixture
+def profiler(logger, make_config, tmp_path):
+    return RequestProfiler(logger, make_config(PROFILE_DIR=str(tmp_path), PROFILE_SAMPLE_RATE="1.0"))
+
+
+def test_profile_collects_the_body(profiler):
+    response = StandInResponse([b"a" * 10, "b" * 5, b"c"])
+
+    async def call_next(request):
+        assert profiler.active
+        assert not profiler.should_sample(request)
+        return response
+
+    response, body, report = run(profiler.profile(StandInRequest(), call_next))
+    assert body == b"a" * 10 + b"b" * 5 + b"c"
+    assert "status 200, 16 bytes" in report
+    assert not profiler.active
+    assert profiler.should_sample(StandInRequest())
+
+
+def test_streamed_responses_are_passed_through(profiler):
+    streamed = StandInResponse([b"event: progress\n\n"] * 3, streamed=True)
+
+    async def call_next(request):
+        return streamed
+
+    response, body, report = run(profiler.profile(StandInRequest(), call_next))
+    assert response is streamed and streamed.n_read == 0
+    assert body is None and report is None
+    assert not profiler.active
+    assert profiler.stats()["streamed"] == 1
+
+
+def test_streamed_responses_are_drained_on_request(profiler):
+    streamed = StandInResponse([b"event: progress\n\n"] * 3, streamed=True)
+
+    async def call_next(request):
+        return streamed
+
+    response, body, report = run(profiler.profile(StandInRequest(), call_next, drain_streamed=True))
+    assert streamed.n_read == 3
+    assert body == b"event: progress\n\n" * 3
+    assert "status 200, %i bytes" % len(body) in report
+    assert profiler.stats()["streamed"] == 0
+
+
+def test_streamed_endpoint_is_profiled(make_client, main):
+    client = make_client(CLIENT_API_KEYS="ops:k1", PROFILE_CLIENTS="ops")
+    response = client.get(
+        "/api/v1/measurements_by_domain/example.at?date_from=2021-01-01&date_to=2021-01-02&profile=true",
+        headers={"X-API-Key": "k1"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-disposition"].startswith("attachment; filename=profile_")
+    assert "GET http://testserver/api/v1/measurements_by_domain/example.at" in response.text
+    assert "select_measurements_by_domain" in response.text
+    # the body has been read under the profiler
+    assert "status 200, 0 bytes" not in response.text
+    # the cleanup of the response has run
+    assert main.result_memory.resident == 0
+    response = client.get(
+        "/api/v1/measurements_by_domain/example.at?date_from=2021-01-01&date_to=2021-01-02&profile=true",
+        headers={"X-API-Key": "other"}
+    )
+    assert response.status_code == 403
+
+
+def test_profiler_is_released_on_errors(profiler):
+    async def call_next(request):
+        await asyncio.sleep(0)
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        run(profiler.profile(StandInRequest(), call_next))
+    assert not profiler.active
@@ -0,0 +1,81 @@
+import json
+import random
+
+import pytest
+
+from conftest import StandInServer, run
+
+from query_options import QueryOptionProfiles
+
+
+PROFILES = json.dumps({
+    "join": {"RUNTIME_FILTER_MODE": "GLOBAL", "DEFAULT_JOIN_DISTRIBUTION_MODE": "BROADCAST"},
+    "scan": {"MT_DOP": 4}
+})
+
+
+@pytest.fixture
+def make_profiles(logger, make_config):
+    def make_profiles(**kwargs):
+        kwargs.setdefault("QUERY_OPTION_PROFILES", PROFILES)
+        return QueryOptionProfiles(logger, make_config(**kwargs))
+    return make_profiles
+
+
+def test_options_of_the_selected_profile(make_profiles):
+    profiles = make_profiles(QUERY_PROFILES="q1:join, q2:scan", QUERY_PROFILES_B="")
+    configuration, variant = profiles.get_configuration("q2")
+    assert configuration == {"MT_DOP": "4"} and variant == "A"
+    # the options are added to those of the query, which are not changed
+    own = {"paramstyle": "format"}
+    configuration, variant = profiles.get_configuration("q1", own)
+    assert configuration == {
+        "paramstyle": "format", "RUNTIME_FILTER_MODE": "GLOBAL", "DEFAULT_JOIN_DISTRIBUTION_MODE": "BROADCAST"
+    }
+    assert own == {"paramstyle": "format"}
+    # other queries keep the defaults of the session
+    assert profiles.get_configuration("q3", own) == (own, "A")
+    assert profiles.get_configuration(None) == (None, "A")
+
+
+def test_unknown_profiles_are_rejected(make_profiles):
+    with pytest.raises(ValueError):
+        make_profiles(QUERY_PROFILES="q1:joins")
+    with pytest.raises(ValueError):
+        make_profiles(QUERY_PROFILES="q1:join", QUERY_PROFILES_B="q1:scan,q2:other")
+    make_profiles(QUERY_OPTION_PROFILES="", QUERY_PROFILES="q1:default")
+
+
+def test_ab_split(make_profiles):
+    profiles = make_profiles(QUERY_PROFILES="q1:join", QUERY_PROFILES_B="q1:default", QUERY_PROFILES_B_SHARE=0.25)
+    random.seed(1)
+    variants = [profiles.get_configuration("q1") for _ in range(4000)]
+    n_b = sum(1 for _, variant in variants if variant == "B")
+    assert 850 < n_b < 1150
+    assert all((configuration is None) == (variant == "B") for configuration, variant in variants)
+    # queries without an alternative always run variant A
+    assert all(profiles.get_profile("q2") == ("A", "default") for _ in range(100))
+    assert all(make_profiles(QUERY_PROFILES_B="q1:scan", QUERY_PROFILES_B_SHARE=0.0).get_profile("q1")[0] == "A"
+               for _ in range(100))
+    assert all(make_profiles(QUERY_PROFILES_B="q1:scan", QUERY_PROFILES_B_SHARE=1.0).get_profile("q1") == ("B", "scan")
+               for _ in range(100))
+
+
+def test_query_times_per_variant(make_profiles):
+    profiles = make_profiles(QUERY_PROFILES="q1:join", QUERY_PROFILES_B="q1:scan")
+    for variant, query_time in (("A", 1.0), ("A", 3.0), ("B", 0.5)):
+        profiles.record("q1", variant, query_time)
+    profiles.record(None, "A", 1.0)
+    assert profiles.stats() == {"q1": {
+        "A": {"profile": "join", "queries": 2, "mean_query_time": 2.0, "max_query_time": 3.0},
+        "B": {"profile": "scan", "queries": 1, "mean_query_time": 0.5, "max_query_time": 0.5}
+    }}
+
+
+def test_options_are_sent_with_the_query(stand_in_db):
+    server = StandInServer()
+    db = stand_in_db({"a:1": server}, QUERY_OPTION_PROFILES=PROFILES, QUERY_PROFILES="q1:scan", QUERY_PROFILES_B="")
+    run(db.execute_query_async("SELECT 1", {}, {"paramstyle": "format"}, query_name="q1"))
+    run(db.execute_query_async("SELECT 2", query_name="q2"))
+    assert [configuration for _, _, configuration in server.queries] == [{"paramstyle": "format", "MT_DOP": "4"}, None]
+    assert db.query_options.stats()["q1"]["A"]["queries"] == 1
@@ -0,0 +1,140 @@
+import pytest
+
+from conftest import StandInServer, run
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, DBUnavailable, is_retryable, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeTime(object):
+    """ stands in for the time module of resilience """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def make_error(name, message=""):
+    return type(name, (Exception, ), {})(message)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(resilience, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(logger, make_config, clock):
+    return CircuitBreaker(logger, make_config(DB_BREAKER_FAILURE_THRESHOLD=3, DB_BREAKER_RESET_TIMEOUT=30.0))
+
+
+def test_breaker_opens_after_consecutive_failures(breaker, clock):
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    # a success resets the count
+    breaker.before_call()
+    breaker.record_success()
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.now += 10.0
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.before_call()
+    assert e.value.retry_after == 20.0
+    assert breaker.stats()["opened"] == 1 and breaker.stats()["rejected"] == 1
+
+
+def test_breaker_lets_one_probe_through(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 30.0
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    # only one probe at a time
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.before_call()
+    assert e.value.retry_after == 1.0
+    # the probe was cancelled, the next call probes again
+    breaker.release()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 30.0
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_retry_classification():
+    assert is_retryable(ConnectionRefusedError("connection refused"))
+    assert is_retryable(TimeoutError())
+    assert is_retryable(make_error("TTransportException", "Could not connect"))
+    assert is_retryable(make_error("InterfaceError", "anything"))
+    assert is_retryable(make_error("HiveServer2Error", "Invalid session id: 1234"))
+    assert is_retryable(make_error("OperationalError", "Admission for query exceeded timeout"))
+    assert is_retryable(make_error("HiveServer2Error", "Rejected query from pool: queue is full"))
+    # errors of the query itself
+    assert not is_retryable(make_error("HiveServer2Error", "AnalysisException: Could not resolve column"))
+    assert not is_retryable(make_error("OperationalError", "Memory limit exceeded"))
+    assert not is_retryable(ValueError("invalid literal"))
+    assert not is_retryable(KeyError("year"))
+
+
+def test_retryable_errors_are_retried(stand_in_db):
+    server = StandInServer()
+    db = stand_in_db({"a:1": server})
+    server.errors = [make_error("HiveServer2Error", "Invalid query handle")]
+    assert run(db.execute_query_async("SELECT 1"))["rows"] == [{"value": 1}]
+    assert len(server.queries) == 2
+    assert db.breaker.n_failures == 0
+
+
+def test_query_errors_are_not_retried(stand_in_db):
+    server = StandInServer()
+    db = stand_in_db({"a:1": server})
+    server.errors = [make_error("HiveServer2Error", "AnalysisException: syntax error")] * 2
+    with pytest.raises(Exception) as e:
+        run(db.execute_query_async("SELECT"))
+    assert type(e.value).__name__ == "HiveServer2Error"
+    assert len(server.queries) == 1
+    assert db.breaker.state == CLOSED
+
+
+def test_unreachable_cluster(stand_in_db):
+    server = StandInServer()
+    db = stand_in_db({"a:1": server}, N_RECONNECT_TRIES=3, DB_BREAKER_FAILURE_THRESHOLD=3)
+    server.errors = [ConnectionResetError("connection reset by peer")] * 3
+    with pytest.raises(DBUnavailable) as e:
+        run(db.execute_query_async("SELECT 1"))
+    assert len(server.queries) == 3
+    assert db.breaker.state == OPEN and e.value.retry_after > 1.0
+    # fails fast now
+    with pytest.raises(CircuitOpenError):
+        run(db.execute_query_async("SELECT 1"))
+    assert len(server.queries) == 3
+
+
+def test_unavailable_is_answered_with_retry_after(make_client, main, monkeypatch):
+    client = make_client()
+
+    async def unavailable(*args, **kwargs):
+        raise DBUnavailable("the database is unavailable", retry_after)
+
+    monkeypatch.setattr(main, "run_lookup", unavailable)
+    for retry_after, header in ((12.4, "12"), (0.2, "1")):
+        response = client.get("/api/v1/ips_by_domain/example.at?date_from=2021-01-01&date_to=2021-01-01")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == header
+        assert response.json() == {"detail": "the database is unavailable"}
@@ -0,0 +1,102 @@
+import time
+import asyncio
+import datetime
+
+import pytest
+
+from conftest import run
+
+from cache import SharedCache
+from rollup import RecordsRollup
+
+
+class RollupDBConnection(object):
+    """ keeps the rolled up partitions, building a day takes build_delay seconds """
+    def __init__(self, build_delay=0.0):
+        self.build_delay = build_delay
+        self.partitions = set()
+        self.built = []
+
+    async def execute_query_async(self, query, parameters=None, configuration=None, query_name=None):
+        if query_name == 'show_rollup_partitions':
+            rows = [{"year": day.year, "month": day.month, "day": day.day} for day in sorted(self.partitions)]
+            return {"rows": rows}
+        if query_name == 'openintel_build_records_rollup':
+            await asyncio.sleep(self.build_delay)
+            day = parameters["day"]
+            self.built.append(day)
+            self.partitions.add(day)
+        return {"rows": []}
+
+
+class StandInCatalog(object):
+    def __init__(self, days):
+        self.days = days
+        self.version = "v1"
+
+
+class StandInResultCache(object):
+    def __init__(self, shared):
+        self.shared = shared
+
+
+@pytest.fixture
+def make_rollup(logger, make_config, tmp_path):
+    days = [datetime.date(2021, 1, 1) + datetime.timedelta(days=i) for i in range(5)]
+
+    def make_rollup(db, **kwargs):
+        config = make_config(
+            ROLLUP=True, ROLLUP_MIN_AGE_DAYS=0, SHARED_CACHE_DIR=str(tmp_path), **kwargs
+        )
+        shared = SharedCache(logger, config)
+        return RecordsRollup(logger, config, db, StandInCatalog(days), StandInResultCache(shared))
+    return make_rollup
+
+
+def test_table_defaults_to_db(logger, make_config):
+    rollup = RecordsRollup(logger, make_config(ROLLUP=True, ROLLUP_TABLE="", DB="openintel.m"), None, None, None)
+    assert rollup.enabled and rollup.table == "openintel.m_records_daily"
+    rollup = RecordsRollup(logger, make_config(ROLLUP=True, ROLLUP_TABLE="", DB=None), None, None, None)
+    assert not rollup.enabled
+
+
+def test_rollups_do_not_block_the_catalog(make_rollup):
+    db = RollupDBConnection(build_delay=0.05)
+    rollup = make_rollup(db, ROLLUP_DAYS_PER_RUN=2)
+
+    async def refresh():
+        await rollup.on_catalog_refresh([])
+        assert db.built == []
+        # refreshes while the rollups run do not start them again
+        await rollup.on_catalog_refresh([])
+        await rollup.task
+        assert not rollup.stats()["running"]
+
+    run(refresh())
+    assert db.built == [datetime.date(2021, 1, 5), datetime.date(2021, 1, 4)]
+
+
+def test_days_are_claimed_once(make_rollup):
+    db = RollupDBConnection()
+    a = make_rollup(db)
+    b = make_rollup(db)
+    day = datetime.date(2021, 1, 5)
+    assert run(a.build(day))
+    # b has not seen the new partition yet and the claim of a is kept after the build
+    assert not run(b.build(day))
+    assert db.built == [day]
+
+
+def test_expired_claims_are_taken_over_and_pruned(make_rollup):
+    db = RollupDBConnection()
+    a = make_rollup(db, ROLLUP_CLAIM_TTL=0.0)
+    shared = a.result_cache.shared
+    day = datetime.date(2021, 1, 5)
+    # a worker that died while building
+    assert shared.claim("rollup:%s" % day.isoformat())
+    shared.claim("prefetch:%s" % day.isoformat())
+    time.sleep(0.01)
+    assert run(a.build(day))
+    time.sleep(0.01)
+    shared.prune_claims("rollup:", 0.0)
+    assert [row[0] for row in shared.db.execute("SELECT name FROM claims")] == ["prefetch:2021-01-05"]
@@ -0,0 +1,28 @@
+from scheduler import TokenBucket, get_client_id
+
+
+class StandInClient(object):
+    host = "10.0.0.1"
+
+
+class StandInRequest(object):
+    def __init__(self, headers):
+        self.headers = headers
+        self.client = StandInClient()
+
+
+def test_client_id():
+    api_keys = {"k1": "ops"}
+    assert get_client_id(StandInRequest({"x-api-key": "k1"}), api_keys) == "ops"
+    assert get_client_id(StandInRequest({"x-api-key": "other"}), api_keys) == "10.0.0.1"
+    request = StandInRequest({"x-forwarded-for": "1.2.3.4, 192.0.2.7"})
+    assert get_client_id(request, api_keys) == "10.0.0.1"
+    # the client can send any X-Forwarded-For, only the address appended by the proxy counts
+    assert get_client_id(request, api_keys, trust_forwarded=True) == "192.0.2.7"
+
+
+def test_token_bucket():
+    assert all(TokenBucket(0, 1).take() == 0.0 for _ in range(100))
+    bucket = TokenBucket(1.0, 3)
+    assert [bucket.take() == 0.0 for _ in range(4)] == [True, True, True, False]
+    assert 0.0 < bucket.take() <= 1.0
@@ -0,0 +1,49 @@
+import datetime
+
+from conftest import run
+
+from slicing import MERGE_SPECS, RowMerger, get_slices, run_sliced
+
+
+def make_row(domain, ip, first_ts, last_ts):
+    return {
+        "domain_name": domain, "record_type": "A", "ip_address": ip, "asn": None, "country": None,
+        "first_ts": first_ts, "last_ts": last_ts, "record_names": domain
+    }
+
+
+def sliced(rows_by_slice, limit):
+    slices = list(rows_by_slice.keys())
+
+    async def lookup(date_from, date_to):
+        return {"rows": rows_by_slice[(date_from, date_to)]}
+
+    return run(run_sliced(lookup, slices, 2, RowMerger(limit=limit, **MERGE_SPECS["ips_by_domains"])))
+
+
+def test_get_slices():
+    day = datetime.date(2021, 1, 30)
+    assert get_slices(day, datetime.date(2021, 2, 2), "month") == [
+        (day, datetime.date(2021, 1, 31)), (datetime.date(2021, 2, 1), datetime.date(2021, 2, 2))
+    ]
+
+
+def test_rows_are_merged():
+    results = sliced({
+        (1, 1): [make_row("a.example", "10.0.0.1", 1, 2), make_row("b.example", "10.0.0.2", 1, 1)],
+        (2, 2): [make_row("a.example", "10.0.0.1", 3, 4)],
+    }, limit=10)
+    assert [(row["domain_name"], row["first_ts"], row["last_ts"]) for row in results["rows"]] == [
+        ("a.example", 1, 4), ("b.example", 1, 1)
+    ]
+    assert not results["truncated"]
+
+
+def test_slice_at_the_limit_is_flagged():
+    # the first slice may have left out a.example, so its first_ts may be wrong
+    results = sliced({
+        (1, 1): [make_row("b.example", "10.0.0.2", 1, 1)],
+        (2, 2): [make_row("a.example", "10.0.0.1", 2, 2)],
+    }, limit=1)
+    assert len(results["rows"]) == 1
+    assert results["truncated"]
@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+from conftest import run
+
+from snapshots import SnapshotStore, filter_and_sort, _parse_datatables_params
+
+
+ROWS = [{"domain_name": "name%i.example" % i, "ip_address": "10.0.0.%i" % i} for i in range(30)]
+
+
+@pytest.fixture
+def store(logger, make_config, tmp_path):
+    return SnapshotStore(logger, make_config(SNAPSHOT_DIR=str(tmp_path), SNAPSHOT_CACHE_SIZE=2))
+
+
+def column_params(*names, **kwargs):
+    params = {}
+    for i, name in enumerate(names):
+        params["columns[%i][data]" % i] = name
+    params.update(kwargs)
+    return params
+
+
+def test_datatables_params():
+    params = column_params("domain_name", "ip_address", "asn", draw="4", start="20", length="-1")
+    params.update({
+        "columns[1][search][value]": " 10.0. ",
+        "columns[2][orderable]": "false",
+        "columns[2][searchable]": "false",
+        "search[value]": " Name ",
+        "order[0][column]": "1", "order[0][dir]": "desc",
+        # not orderable or unknown columns are ignored
+        "order[1][column]": "2",
+        "order[2][column]": "7",
+        "order[3][column]": "0",
+    })
+    request = _parse_datatables_params(params)
+    assert (request["draw"], request["start"], request["length"]) == (4, 20, -1)
+    assert request["search"] == "name"
+    assert [column["data"] for column in request["columns"]] == ["domain_name", "ip_address", "asn"]
+    assert request["columns"][1]["search"] == "10.0."
+    assert not request["columns"][2]["searchable"] and not request["columns"][2]["orderable"]
+    assert request["order"] == [("ip_address", True), ("domain_name", False)]
+    request = _parse_datatables_params({"start": "-5"})
+    assert (request["draw"], request["start"], request["length"]) == (0, 0, 10)
+    assert request["columns"] == [] and request["order"] == []
+    with pytest.raises(ValueError):
+        _parse_datatables_params({"draw": "x"})
+
+
+def test_filter_and_sort():
+    columns = _parse_datatables_params(column_params("name", "asn", "country"))["columns"]
+    rows = [
+        {"name": "b.example", "asn": 2, "country": "AT"},
+        {"name": "A.example", "asn": None, "country": "NL"},
+        {"name": "c.test", "asn": 1, "country": "AT"},
+        {"name": "d.example", "asn": 1, "country": None},
+    ]
+    # case insensitive substrings of any searchable column
+    assert filter_and_sort(rows, "a.ex", columns, []) == [rows[1]]
+    assert filter_and_sort(rows, "at", columns, []) == [rows[0], rows[2]]
+    columns[2]["searchable"] = False
+    assert filter_and_sort(rows, "at", columns, []) == []
+    columns[2]["searchable"] = True
+    columns[0]["search"] = "example"
+    assert filter_and_sort(rows, "", columns, []) == [rows[0], rows[1], rows[3]]
+    columns[0]["search"] = ""
+    # None first, then stable from the most significant column
+    assert filter_and_sort(rows, "", columns, [("asn", False), ("name", True)]) == [rows[1], rows[3], rows[2], rows[0]]
+    assert filter_and_sort(rows, "", columns, [("asn", True)]) == [rows[0], rows[2], rows[3], rows[1]]
+    # mixed types are compared as strings
+    mixed = [{"name": "x", "asn": "64500"}, {"name": "y", "asn": 3}]
+    assert filter_and_sort(mixed, "", columns, [("asn", False)]) == [mixed[1], mixed[0]]
+    # the rows are not changed
+    assert rows[0]["name"] == "b.example"
+
+
+def test_views_are_kept(store, monkeypatch):
+    import snapshots
+    n_sorts = []
+
+    def counting_filter_and_sort(*args):
+        n_sorts.append(1)
+        return filter_and_sort(*args)
+
+    monkeypatch.setattr(snapshots, "filter_and_sort", counting_filter_and_sort)
+    result_id = store.create({"rows": ROWS})
+    params = column_params("domain_name", "ip_address", **{"order[0][column]": "0", "order[0][dir]": "desc"})
+    first = store.datatables_page(result_id, dict(params, start="0", length="10"))
+    second = store.datatables_page(result_id, dict(params, start="10", length="10"))
+    assert len(n_sorts) == 1
+    assert first["data"][0]["domain_name"] == "name9.example"
+    assert second["recordsFiltered"] == second["recordsTotal"] == 30
+    everything = store.datatables_page(result_id, dict(params, **{"search[value]": "name1", "length": "-1"}))
+    assert everything["recordsFiltered"] == len(everything["data"]) == 11
+    # other workers read the snapshot from SNAPSHOT_DIR
+    other = SnapshotStore(store.logger, store.config)
+    assert other.get_rows(result_id) == ROWS
+    with pytest.raises(KeyError):
+        other.get_rows("../" + result_id)
+
+
+def test_snapshots_are_read_and_written_in_the_executor(store, monkeypatch):
+    threads = []
+    for name in ("create", "get_rows", "datatables_page"):
+        def record_thread(*args, method=getattr(store, name)):
+            threads.append(threading.current_thread())
+            return method(*args)
+        monkeypatch.setattr(store, name, record_thread)
+
+    async def page():
+        result_id = await store.create_async({"rows": ROWS})
+        assert len(await store.get_rows_async(result_id)) == 30
+        return await store.datatables_page_async(result_id, {"draw": "1", "start": "10", "length": "5"})
+
+    assert run(page())["data"] == ROWS[10:15]
+    # datatables_page reads the rows with get_rows
+    assert len(threads) == 4
+    assert threading.main_thread() not in threads
+
+
+def test_snapshot_endpoints(make_client):
+    client = make_client()
+    results = client.post(
+        "/api/v1/ips_by_domains/?date_from=2021-01-01&date_to=2021-01-01&snapshot=true", json=["example.at"]
+    )
+    result_id = results.json()["result_id"]
+    page = client.get("/api/v1/results/%s/datatables?draw=3&start=0&length=10" % result_id).json()
+    assert page["draw"] == 3 and len(page["data"]) == 10
+    assert page["recordsTotal"] == results.json()["records_total"]
+    assert client.get("/api/v1/results/%s/datatables" % ("0" * 32)).status_code == 404
@@ -0,0 +1,80 @@
+import pytest
+
+from conftest import StandInServer, run
+
+from spill import ResultMemory, SpilledRows, SpillingConnection
+
+
+def make_rows(n):
+    return [{"query_name": "example.com.", "ip4_address": "192.0.2.%i" % (i % 256), "n": i} for i in range(n)]
+
+
+async def collect(stream):
+    return [(event, value) async for event, value in stream]
+
+
+def test_spilled_rows_by_index(tmp_path):
+    rows = make_rows(2500)
+    spilled = SpilledRows(str(tmp_path))
+    spilled.extend(rows[:1000])
+    spilled.extend(rows[1000:])
+    assert len(spilled) == 2500
+    assert spilled[0] == rows[0]
+    assert spilled[1234] == rows[1234]
+    assert spilled[-1] == rows[-1]
+    with pytest.raises(IndexError):
+        spilled[2500]
+    assert list(spilled) == rows
+    assert [row for batch in spilled.iter_batches(700) for row in batch] == rows
+    spilled.close()
+
+
+def test_spilling_connection(tmp_path, logger, make_config, stand_in_db):
+    rows = make_rows(5000)
+    db = stand_in_db({"a:1": StandInServer(rows)}, FETCH_BATCH_SIZE=1000)
+    memory = ResultMemory(logger, make_config(
+        SPILL_DIR=str(tmp_path), RESULT_MEMORY_REQUEST_LIMIT=100000, RESULT_MEMORY_WORKER_LIMIT=0
+    ))
+    connection = SpillingConnection(db, memory)
+    results = run(connection.execute_query_async("SELECT 1", query_name="test"))
+    assert results["spilled"]
+    assert list(results["rows"]) == rows
+    assert memory.resident == 0
+    results["rows"].close()
+
+
+def test_stream_retries_before_the_first_rows(stand_in_db):
+    server = StandInServer(make_rows(10))
+    server.errors.append(ConnectionResetError("connection reset"))
+    db = stand_in_db({"a:1": server})
+    events = run(collect(db.stream_query_async("SELECT 1", query_name="test")))
+    assert [row for event, value in events if event == "rows" for row in value] == server.rows
+    assert len(server.queries) == 2
+    assert db.coordinators[0].outstanding == 0
+
+
+def test_stream_does_not_retry_after_rows(stand_in_db):
+    server = StandInServer(make_rows(10))
+    server.fetch_errors.append(ConnectionResetError("connection reset"))
+    db = stand_in_db({"a:1": server}, FETCH_BATCH_SIZE=5)
+    with pytest.raises(ConnectionResetError):
+        run(collect(db.stream_query_async("SELECT 1", query_name="test")))
+    assert len(server.queries) == 1
+    assert db.coordinators[0].outstanding == 0
+
+
+def test_stream_does_not_retry_query_errors(stand_in_db):
+    server = StandInServer()
+    server.errors.append(ValueError("syntax error"))
+    db = stand_in_db({"a:1": server})
+    with pytest.raises(ValueError):
+        run(collect(db.stream_query_async("SELECT 1", query_name="test")))
+    assert len(server.queries) == 1
+
+
+def test_stream_is_sticky(stand_in_db):
+    servers = {"a:1": StandInServer(), "b:2": StandInServer(), "c:3": StandInServer()}
+    db = stand_in_db(servers)
+    for _ in range(5):
+        run(collect(db.stream_query_async("SELECT 1", {"x": 1}, query_name="test")))
+    assert sorted(len(server.queries) for server in servers.values()) == [0, 0, 5]
@@ -0,0 +1,107 @@
+import re
+import sqlite3
+import datetime
+
+import pytest
+
+from conftest import run
+
+from sql_templates import TemplateCache, get_bucket_size, get_params, get_placeholders, pad_values
+from openintel_sql_calls import get_date_where_clause, get_spec_for_clause, openintel_select_ips_by_domains
+
+
+FIRST_DAY = datetime.date(2019, 11, 1)
+LAST_DAY = datetime.date(2021, 4, 30)
+
+
+class RecordingDBConnection(object):
+    def __init__(self):
+        self.queries = []
+
+    async def execute_query_async(self, query, params=None, configuration=None, query_name=None):
+        self.queries.append((query, params))
+        return {'rows': [], 'query_time': 0.0, 'fetch_time': 0.0}
+
+
+def select(db, where, params):
+    """ runs a clause with impyla parameters (%(name)s) on sqlite """
+    return [row[0] for row in db.execute(
+        "SELECT value FROM t WHERE %s ORDER BY value" % re.sub(r"%\((\w+)\)s", r":\1", where), params
+    )]
+
+
+@pytest.fixture
+def partitions():
+    """ a table with the partition columns (strings, as in the tables of the cluster) of every day """
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE t (value TEXT, year TEXT, month TEXT, day TEXT)")
+    day = FIRST_DAY
+    while day <= LAST_DAY:
+        db.execute("INSERT INTO t VALUES (?, ?, ?, ?)", (day.isoformat(), str(day.year), str(day.month), str(day.day)))
+        day += datetime.timedelta(days=1)
+    return db
+
+
+def test_buckets():
+    assert [get_bucket_size(n) for n in (1, 2, 3, 4, 5, 8, 9, 1000)] == [1, 2, 4, 4, 8, 8, 16, 1024]
+    for n in range(1, 40):
+        values = ["v%i" % i for i in range(n)]
+        padded = pad_values(values)
+        assert len(padded) == get_bucket_size(n)
+        assert padded[:n] == values and set(padded) == set(values)
+    assert get_placeholders("__n", 3) == "%(__n0)s,%(__n1)s,%(__n2)s"
+    assert get_params("__n", ["a", "b"]) == {"__n0": "a", "__n1": "b"}
+
+
+def test_padded_in_lists_keep_their_semantics():
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE t (value TEXT)")
+    db.executemany("INSERT INTO t VALUES (?)", [("v%i" % i, ) for i in range(50)])
+    for n in (1, 3, 5, 17):
+        values = ["v%i" % (i * 2) for i in range(n)] + ["absent"]
+        padded = pad_values(values)
+        expected = select(db, "value IN (%s)" % get_placeholders("__v", len(values)), get_params("__v", values))
+        assert select(db, "value IN (%s)" % get_placeholders("__v", len(padded)), get_params("__v", padded)) == expected
+        assert len(expected) == n
+
+
+def test_lookups_share_the_text_of_their_bucket(monkeypatch, logger):
+    import openintel_sql_calls
+    monkeypatch.setattr(openintel_sql_calls, "templates", TemplateCache(10))
+    db = RecordingDBConnection()
+    day = datetime.date(2021, 1, 1)
+    for domains in (["a.example", "b.example", "c.example"], ["d.example", "e.example", "f.example", "g.example"]):
+        run(openintel_select_ips_by_domains(db, logger, domains, day, day, 10))
+    (query3, params3), (query4, params4) = db.queries
+    assert query3 == query4
+    assert query3.count("%(__domain_name") == 4
+    padded = [params3["__domain_name%i" % i] for i in range(4)]
+    assert padded == ["a.example.", "b.example.", "c.example.", "c.example."]
+    assert openintel_sql_calls.templates.stats()["misses"] == 1
+    run(openintel_select_ips_by_domains(db, logger, ["a.example"] * 5, day, day, 0))
+    assert db.queries[-1][0].count("%(__domain_name") == 8 and "LIMIT" not in db.queries[-1][0]
+
+
+@pytest.mark.parametrize("date_from, date_to", [
+    (datetime.date(2020, 3, 15), datetime.date(2020, 3, 15)),
+    (datetime.date(2020, 1, 31), datetime.date(2020, 2, 1)),
+    (datetime.date(2020, 2, 27), datetime.date(2020, 3, 2)),
+    (datetime.date(2019, 12, 30), datetime.date(2020, 1, 2)),
+    (datetime.date(2019, 12, 31), datetime.date(2021, 1, 1)),
+    (datetime.date(2020, 9, 30), datetime.date(2020, 12, 1)),
+    (datetime.date(2020, 11, 10), datetime.date(2021, 2, 9)),
+])
+def test_date_clause_selects_the_days_of_the_interval(partitions, date_from, date_to):
+    where = get_date_where_clause("t", date_from, date_to)
+    days = select(partitions, where, get_spec_for_clause({"from": date_from, "to": date_to}))
+    expected = [
+        (date_from + datetime.timedelta(days=i)).isoformat() for i in range((date_to - date_from).days + 1)
+    ]
+    assert days == expected
+
+
+def test_date_clause_is_the_same_for_all_intervals():
+    day = datetime.date(2020, 1, 1)
+    assert get_date_where_clause("l1", day, day) == get_date_where_clause("l1", day, datetime.date(2021, 5, 6))
+    with pytest.raises(ValueError):
+        get_date_where_clause("l1", "2020-01-01", day)
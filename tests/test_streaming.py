@@ -0,0 +1,39 @@
+import asyncio
+
+from conftest import StandInServer, run
+
+from streaming import StreamingConnection
+
+
+def collect(db, send_rows):
+    async def query():
+        queue = asyncio.Queue(2)
+        connection = StreamingConnection(db, queue, send_rows=send_rows)
+        task = asyncio.ensure_future(connection.execute_query_async("SELECT 1", query_name="test"))
+        events = []
+        while not (task.done() and queue.empty()):
+            try:
+                events.append(await asyncio.wait_for(queue.get(), 0.1))
+            except asyncio.TimeoutError:
+                pass
+            # the queue is bounded, fetching waits for the consumer
+            assert queue.qsize() <= 2
+        return events, task.result()
+    return run(query())
+
+
+def test_rows_are_streamed(stand_in_db):
+    rows = [{"value": i} for i in range(10)]
+    db = stand_in_db({"a:1": StandInServer(rows)}, FETCH_BATCH_SIZE=3)
+    events, result = collect(db, send_rows=True)
+    assert [value for event, value in events if event == "rows"] == [rows[0:3], rows[3:6], rows[6:9], rows[9:]]
+    assert result["rows"] == rows
+
+
+def test_snapshot_only_counts_rows(stand_in_db):
+    rows = [{"value": i} for i in range(10)]
+    db = stand_in_db({"a:1": StandInServer(rows)}, FETCH_BATCH_SIZE=3)
+    events, result = collect(db, send_rows=False)
+    assert all(event != "rows" for event, value in events)
+    assert [value["rows"] for event, value in events if event == "fetched"] == [3, 6, 9, 10]
+    assert result["rows"] == rows
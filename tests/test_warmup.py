@@ -0,0 +1,121 @@
+import random
+import datetime
+from collections import Counter
+
+import pytest
+
+from conftest import run
+
+from cache import ResultCache
+from warmup import HotKeyTracker, SpaceSaving, Warmer
+
+
+DAY = datetime.date(2021, 1, 10)
+NEW_DAY = datetime.date(2021, 1, 11)
+
+
+class StandInCatalog(object):
+    def __init__(self, latest_day):
+        self.latest_day = latest_day
+
+
+class LookupRecorder(object):
+    """ stands in for execute_lookup """
+    def __init__(self):
+        self.lookups = []
+
+    async def execute_lookup(self, lookup_type, inputs, date_from, date_to, limit, options=None, track=True,
+                             guard=True):
+        assert not track and not guard
+        self.lookups.append((lookup_type, inputs, date_from, date_to, limit, options))
+        return {"rows": []}
+
+
+@pytest.fixture
+def make_warmer(logger, make_config, tmp_path):
+    def make_warmer(shared=False, **kwargs):
+        config = make_config(
+            RESULT_CACHE=True, SHARED_CACHE=shared, SHARED_CACHE_DIR=str(tmp_path), WARMUP=True, **kwargs
+        )
+        recorder = LookupRecorder()
+        warmer = Warmer(
+            logger, config, None, {}, recorder.execute_lookup, ResultCache(logger, config), HotKeyTracker(100),
+            StandInCatalog(DAY)
+        )
+        return warmer, recorder
+    return make_warmer
+
+
+def test_space_saving_is_exact_below_its_capacity():
+    sketch = SpaceSaving(10)
+    for item in "abracadabra":
+        sketch.add(item)
+    # ties keep the order of the first occurrence
+    assert sketch.top(2) == [("a", 5), ("b", 2)]
+    assert dict(sketch.top(10)) == Counter("abracadabra")
+
+
+def test_space_saving_finds_the_heavy_hitters():
+    rng = random.Random(7)
+    # 5 heavy hitters and a long tail of rare items
+    stream = ["hot%i" % (i % 5) for i in range(5000)] + ["cold%i" % rng.randrange(20000) for _ in range(5000)]
+    rng.shuffle(stream)
+    sketch = SpaceSaving(50)
+    for item in stream:
+        sketch.add(item)
+    assert len(sketch) == 50
+    assert sorted(item for item, _ in sketch.top(5)) == ["hot%i" % i for i in range(5)]
+    # counts are overestimated by at most n / capacity
+    true_counts = Counter(stream)
+    for item, count in sketch.top(50):
+        assert true_counts[item] <= count <= true_counts[item] + len(stream) // 50
+    assert sum(count for _, count in sketch.top(50)) == len(stream)
+
+
+def test_hot_keys_are_relative_to_the_latest_day():
+    tracker = HotKeyTracker(10)
+    for _ in range(3):
+        tracker.record("ips_by_domains", ["b.example", "a.example"], DAY - datetime.timedelta(days=6), DAY, 10, {}, DAY)
+    tracker.record("ips_by_domains", ["a.example", "b.example"], DAY - datetime.timedelta(days=6), DAY, 10, {}, DAY)
+    tracker.record("domains_by_ips", ["192.0.2.1"], DAY, DAY, 100, {"window": "day"}, DAY)
+    # historical intervals and an unknown catalog are not counted
+    tracker.record("domains_by_ips", ["192.0.2.2"], DAY, DAY - datetime.timedelta(days=1), 100, {}, DAY)
+    tracker.record("domains_by_ips", ["192.0.2.3"], DAY, DAY, 100, {}, None)
+    assert len(tracker.sketch) == 2
+    key, count = tracker.drain()[0]
+    assert count == 4 and key[2:4] == (-6, 10)
+    assert tracker.top(10) == []
+
+
+def test_prefetch_the_top_keys_for_the_new_day(make_warmer):
+    warmer, recorder = make_warmer(PREFETCH_TOP_K=2)
+    for i, n in enumerate((1, 5, 3)):
+        for _ in range(n):
+            warmer.hot_keys.record(
+                "ips_by_domains", ["name%i.example" % i], DAY - datetime.timedelta(days=1), DAY, 100, {}, DAY
+            )
+    run(warmer.on_catalog_refresh([NEW_DAY]))
+    assert recorder.lookups == [
+        ("ips_by_domains", ["name1.example"], NEW_DAY - datetime.timedelta(days=1), NEW_DAY, 100, {}),
+        ("ips_by_domains", ["name2.example"], NEW_DAY - datetime.timedelta(days=1), NEW_DAY, 100, {}),
+    ]
+    assert warmer.stats()["prefetched"] == 2
+    assert len(warmer.hot_keys.sketch) == 0
+    # refreshes without new days do not prefetch
+    run(warmer.on_catalog_refresh([]))
+    assert len(recorder.lookups) == 2
+
+
+def test_one_worker_prefetches_the_merged_top_keys(make_warmer):
+    workers = [make_warmer(shared=True, PREFETCH_TOP_K=1) for _ in range(2)]
+    # name0 is the most popular lookup over both workers, not on either one alone
+    for (warmer, _), counts in zip(workers, ((3, 4, 0), (3, 0, 4))):
+        for i, n in enumerate(counts):
+            for _ in range(n):
+                warmer.hot_keys.record("ips_by_domains", ["name%i.example" % i], DAY, DAY, 100, {}, DAY)
+    # refreshes without a new day hand the counts to the shared cache
+    run(workers[1][0].on_catalog_refresh([]))
+    for warmer, _ in workers:
+        run(warmer.on_catalog_refresh([NEW_DAY]))
+    lookups = workers[0][1].lookups + workers[1][1].lookups
+    assert lookups == [("ips_by_domains", ["name0.example"], NEW_DAY, NEW_DAY, 100, {})]